@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""Benchmark bluepill commands end to end against a fake Docker Engine"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence
+
+from fake_docker import FakeDockerServer, FakeEngine
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from bluepill.commands.base import Command  # noqa: E402
+from bluepill.commands.cmd_build import BuildCmd  # noqa: E402
+from bluepill.commands.cmd_commit import CommitCmd  # noqa: E402
+from bluepill.commands.cmd_delete import DeleteCmd  # noqa: E402
+from bluepill.commands.cmd_enter import EnterCmd  # noqa: E402
+from bluepill.commands.cmd_run import RunCmd  # noqa: E402
+from bluepill.config import Config  # noqa: E402
+from bluepill.daemon import (  # noqa: E402
+    DaemonClient,
+    DaemonUnavailable,
+    get_socket_path,
+)
+
+
+class BenchEnterCmd(EnterCmd):
+    """EnterCmd that runs a non-interactive exec instead of attaching a PTY"""
+
+    def exec_shell(self, container: Any) -> None:
+        exec_id = self.client.api.exec_create(container.id, ["true"])
+        self.client.api.exec_start(exec_id)
+
+
+@contextmanager
+def chdir(path: str) -> Iterator[None]:
+    start = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(start)
+
+
+@contextmanager
+def bluepill_daemon() -> Iterator[None]:
+    """Run 'bluepill daemon' in a subprocess, with the same environment"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.argv = ['bluepill', 'daemon']; "
+            "import bluepill; bluepill.main()",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    client = DaemonClient(get_socket_path())
+    try:
+        while True:
+            try:
+                client.call("ping")
+                break
+            except DaemonUnavailable:
+                if proc.poll() is not None:
+                    raise
+                time.sleep(0.05)
+        yield
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+# Endpoint names (as counted by the fake engine) for the expectations below
+PULL = "POST /images/create"
+REGISTRY = "GET /distribution/(?P<name>.+)/json"
+# Pinned by digest, so it should never be looked up in the registry
+PINNED_DIGEST = "sha256:" + "2" * 64
+
+
+def after(setup: Callable[[], Any], factory: Callable[[], Command]) -> Any:
+    """Factory that prepares the fake engine before creating the command"""
+
+    def make() -> Command:
+        setup()
+        return factory()
+
+    return make
+
+
+def check_calls(result: Dict[str, Any], expect: Dict[str, int]) -> List[str]:
+    errors = []
+    for endpoint, count in expect.items():
+        actual = result["endpoints"].get(endpoint, 0)
+        if actual != count:
+            errors.append(
+                f"{result['command']}: expected {count} x {endpoint}, got {actual}"
+            )
+    return errors
+
+
+def run_command(engine: FakeEngine, factory: Callable[[], Command]) -> Dict[str, Any]:
+    engine.reset_calls()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    cmd = factory()
+    cmd.live_progress = False
+    cmd.run()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    return {
+        "wall_ms": wall * 1000,
+        "cpu_ms": cpu * 1000,
+        "api_calls": sum(engine.calls.values()),
+        "endpoints": dict(engine.calls),
+    }
+
+
+def bench(image_count: int, latency: float, workdir: str) -> List[Dict[str, Any]]:
+    engine = FakeEngine(latency / 1000)
+    engine.populate(image_count)
+    server = FakeDockerServer(os.path.join(workdir, "docker.sock"), engine)
+    server.start()
+    os.environ["DOCKER_HOST"] = server.docker_host
+    os.environ["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+    os.environ["XDG_CONFIG_HOME"] = os.path.join(workdir, "config")
+    projects = [os.path.join(workdir, f"project{i}") for i in range(2)]
+    for project in projects:
+        os.makedirs(project, exist_ok=True)
+    config = Config()
+    image = config.default_image
+    pinned = f"{image.split(':')[0]}@{PINNED_DIGEST}"
+
+    scenarios = [
+        ("build (cold)", projects[0], lambda: BuildCmd(None, config, image=image)),
+        (
+            "build (cached layer)",
+            projects[1],
+            lambda: BuildCmd(None, config, image=image),
+        ),
+        (
+            "enter (create)",
+            projects[0],
+            lambda: BenchEnterCmd(None, config, image=image),
+        ),
+        (
+            "enter (running)",
+            projects[0],
+            lambda: BenchEnterCmd(None, config, image=image),
+        ),
+        (
+            "run (running)",
+            projects[0],
+            lambda: RunCmd(None, config, args=["--", "true"], image=image),
+        ),
+        # Refreshing the source image only pulls when the registry has changed
+        (
+            "build --pull (current)",
+            projects[1],
+            lambda: BuildCmd(None, config, image=image, replace=True, pull=True),
+            {PULL: 0, REGISTRY: 1},
+        ),
+        (
+            "build --pull (changed)",
+            projects[1],
+            after(
+                lambda: engine.push(image),
+                lambda: BuildCmd(None, config, image=image, replace=True, pull=True),
+            ),
+            {PULL: 1, REGISTRY: 1},
+        ),
+        (
+            "build (pinned digest)",
+            projects[1],
+            lambda: BuildCmd(None, config, image=pinned, replace=True, pull=True),
+            {PULL: 1, REGISTRY: 0},
+        ),
+        (
+            "build --pull (pinned)",
+            projects[1],
+            lambda: BuildCmd(None, config, image=pinned, replace=True, pull=True),
+            {PULL: 0, REGISTRY: 0},
+        ),
+        ("commit", projects[0], lambda: CommitCmd(None, config)),
+        ("rm -i", projects[0], lambda: DeleteCmd(None, config, i=True, force=True)),
+    ]
+    # The same commands when 'bluepill daemon' is running
+    daemon_scenarios = [
+        (
+            "enter (create) [daemon]",
+            projects[1],
+            lambda: BenchEnterCmd(None, config, image=image),
+        ),
+        (
+            "enter (running) [daemon]",
+            projects[1],
+            lambda: BenchEnterCmd(None, config, image=image),
+        ),
+        (
+            "rm -i [daemon]",
+            projects[1],
+            lambda: DeleteCmd(None, config, i=True, force=True),
+        ),
+    ]
+    results = []
+
+    def run_scenarios(scenarios: Sequence[Any]) -> None:
+        for name, project, factory, *expect in scenarios:
+            with chdir(project):
+                result = run_command(engine, factory)
+            result.update(
+                {"command": name, "images": image_count, "latency_ms": latency}
+            )
+            result["errors"] = check_calls(result, expect[0]) if expect else []
+            results.append(result)
+
+    try:
+        run_scenarios(scenarios)
+        with bluepill_daemon():
+            run_scenarios(daemon_scenarios)
+    finally:
+        server.stop()
+    return results
+
+
+def print_results(results: Sequence[Dict[str, Any]], verbose: bool) -> None:
+    print(
+        f"{'images':>7} {'command':<26} {'wall ms':>9} {'cpu ms':>9} {'api calls':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['images']:>7} {result['command']:<26} "
+            f"{result['wall_ms']:>9.1f} {result['cpu_ms']:>9.1f} {result['api_calls']:>9}"
+        )
+        if verbose:
+            for endpoint, count in sorted(result["endpoints"].items()):
+                print(f"{'':>35}{count:>4} {endpoint}")
+
+
+def main() -> None:
+    """Run bluepill commands against a fake Docker Engine and report their cost"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "-n",
+        "--images",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="Image inventory sizes to benchmark (default %(default)s)",
+    )
+    parser.add_argument(
+        "-l",
+        "--latency",
+        type=float,
+        default=0,
+        help="Latency to add to each API request, in milliseconds (default 0)",
+    )
+    parser.add_argument(
+        "-o", "--output", help="Also write the results to this json file"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Show per-endpoint call counts"
+    )
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    for count in args.images:
+        with tempfile.TemporaryDirectory() as workdir:
+            results.extend(bench(count, args.latency, workdir))
+    print_results(results, args.verbose)
+    if args.output:
+        with open(args.output, "w") as ofile:
+            json.dump(results, ofile, indent=2)
+    errors = [error for result in results for error in result["errors"]]
+    if errors:
+        print("\nUnexpected docker API calls:", file=sys.stderr)
+        for error in errors:
+            print(f"  {error}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
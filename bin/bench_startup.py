@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Benchmark the startup time of bluepill commands that don't need docker
+
+With --exe, also time standalone executables built by bin/install.py. Cold runs
+start with an empty PEX_ROOT, so they include unpacking (and for --venv builds,
+creating the virtualenv). Warm runs reuse one that has already been set up.
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence, Tuple
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Commands that should never touch the docker daemon
+COMMANDS: List[List[str]] = [
+    ["help"],
+    ["config", "list"],
+    ["config", "get", "default_image"],
+    ["ls"],
+    # What the shell hooks run on every cd into a directory without bluepill
+    ["prewarm", "--quiet"],
+]
+# Modules that must not be imported by the commands above
+HEAVY_MODULES = ("docker", "dockerpty", "requests")
+
+PROBE = """
+import sys
+sys.argv = ["bluepill"] + sys.argv[1:]
+import bluepill
+try:
+    bluepill.main()
+finally:
+    heavy = [m for m in {heavy!r} if m in sys.modules]
+    sys.stderr.write("\\nIMPORTED:" + ",".join(heavy) + "\\n")
+"""
+
+
+def run_once(args: Sequence[str]) -> Tuple[float, List[str]]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES), *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    elapsed = time.perf_counter() - start
+    imported: List[str] = []
+    for line in proc.stderr.splitlines():
+        if line.startswith("IMPORTED:"):
+            imported = [m for m in line[len("IMPORTED:") :].split(",") if m]
+    return elapsed, imported
+
+
+def time_exe(exe: str, args: Sequence[str], pex_root: str) -> float:
+    env = dict(os.environ, PEX_ROOT=pex_root)
+    start = time.perf_counter()
+    subprocess.run(
+        [exe, *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def bench_exe(exe: str, iterations: int, cold_iterations: int) -> None:
+    warm_root = tempfile.mkdtemp(prefix="bluepill-bench-")
+    try:
+        for command in COMMANDS:
+            cold = []
+            for _ in range(cold_iterations):
+                cold_root = tempfile.mkdtemp(prefix="bluepill-bench-")
+                try:
+                    cold.append(time_exe(exe, command, cold_root))
+                finally:
+                    shutil.rmtree(cold_root)
+            time_exe(exe, command, warm_root)
+            warm = [time_exe(exe, command, warm_root) for _ in range(iterations)]
+            label = f"{os.path.basename(exe)} " + " ".join(command)
+            print(
+                f"{label:<32} cold {statistics.median(cold) * 1000:8.1f}ms  "
+                f"warm {statistics.median(warm) * 1000:8.1f}ms"
+            )
+    finally:
+        shutil.rmtree(warm_root)
+
+
+def baseline() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Time bluepill commands that should start without importing docker"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "-n",
+        "--iterations",
+        type=int,
+        default=20,
+        help="Number of runs per command (default %(default)s)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cold-iterations",
+        type=int,
+        default=3,
+        help="Number of cold runs per command for --exe (default %(default)s)",
+    )
+    parser.add_argument(
+        "-e",
+        "--exe",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Also time this executable cold and warm, e.g. one built by "
+        "bin/install.py and one built with --legacy. Can be repeated.",
+    )
+    args = parser.parse_args()
+
+    interpreter = statistics.median(baseline() for _ in range(args.iterations))
+    print(f"{'python -c pass':<32} {interpreter * 1000:8.1f}ms")
+    failures: Dict[str, List[str]] = {}
+    for command in COMMANDS:
+        timings = []
+        for _ in range(args.iterations):
+            elapsed, imported = run_once(command)
+            timings.append(elapsed)
+            if imported:
+                failures[" ".join(command)] = imported
+        label = "bluepill " + " ".join(command)
+        median = statistics.median(timings)
+        print(
+            f"{label:<32} {median * 1000:8.1f}ms "
+            f"(+{(median - interpreter) * 1000:.1f}ms over interpreter)"
+        )
+    for exe in args.exe:
+        print()
+        bench_exe(os.path.abspath(exe), args.iterations, args.cold_iterations)
+    for command_str, imported in failures.items():
+        sys.stderr.write(f"'{command_str}' imported {', '.join(imported)}\n")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
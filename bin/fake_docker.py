@@ -0,0 +1,1069 @@
+#!/usr/bin/env python
+"""A stand-in for the Docker Engine API, served on a unix socket
+
+This implements just enough of the API for bluepill's commands to run end to
+end. It keeps an in-memory inventory of images and containers, can add a fixed
+latency to every request, and counts the requests it serves.
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import socketserver
+import struct
+import tarfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+API_VERSION = "1.43"
+DEFAULT_FILES = {
+    "/etc/passwd": b"root:x:0:0:root:/root:/bin/bash\n",
+    "/etc/group": b"root:x:0:\n",
+    "/etc/shadow": b"root:*:19000:0:99999:7:::\n",
+}
+
+Handler = Callable[["RequestHandler", Dict[str, str], bytes], Any]
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Stream:
+    """Marks a handler result that should be sent as a chunked stream"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = chunks
+
+
+class Raw:
+    """Marks a handler result that should be sent as-is"""
+
+    def __init__(
+        self,
+        body: bytes,
+        headers: Optional[Dict[str, str]] = None,
+        hijack: bool = False,
+    ):
+        self.body = body
+        self.headers = headers or {}
+        # Hijacked connections are read until EOF, so close them afterwards
+        self.hijack = hijack
+
+
+def _digest(*parts: Any) -> str:
+    return "sha256:" + hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def _split_ref(ref: str) -> Tuple[str, str]:
+    slash = ref.rfind("/")
+    colon = ref.rfind(":")
+    if colon > slash:
+        return ref[:colon], ref[colon + 1 :]
+    return ref, "latest"
+
+
+def _ndjson(events: Iterable[Dict[str, Any]]) -> Stream:
+    return Stream(json.dumps(event).encode("utf-8") + b"\r\n" for event in events)
+
+
+class FakeEngine:
+    """In-memory image and container inventory"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.calls: Counter = Counter()
+        self.images: Dict[str, Dict[str, Any]] = {}
+        self.containers: Dict[str, Dict[str, Any]] = {}
+        self.execs: Dict[str, Dict[str, Any]] = {}
+        self.volumes: Dict[str, Dict[str, Any]] = {}
+        self.events: List[Dict[str, Any]] = []
+        self.registry: Dict[str, str] = {}
+        self._counter = itertools.count()
+
+    def reset_calls(self) -> None:
+        with self.lock:
+            self.calls.clear()
+
+    def _event(self, type_: str, action: str, id_: str) -> None:
+        now = time.time()
+        self.events.append(
+            {
+                "Type": type_,
+                "Action": action,
+                "status": action,
+                "id": id_,
+                "time": int(now),
+                "timeNano": int(now * 1e9),
+            }
+        )
+
+    def add_image(
+        self,
+        tags: Iterable[str] = (),
+        parent: Optional[str] = None,
+        files: Optional[Dict[str, bytes]] = None,
+        entrypoint: Optional[List[str]] = None,
+        labels: Optional[Dict[str, str]] = None,
+        layers: int = 1,
+        size: int = 50 * 1024 * 1024,
+    ) -> str:
+        with self.lock:
+            image_id = _digest("image", next(self._counter))
+            parent_image = self.images.get(parent) if parent else None
+            base_layers = parent_image["RootFS"]["Layers"] if parent_image else []
+            image = {
+                "Id": image_id,
+                "RepoTags": [],
+                "RepoDigests": [],
+                "Parent": parent or "",
+                "Created": int(time.time()),
+                "Size": size + (parent_image["Size"] if parent_image else 0),
+                "Config": {
+                    "Entrypoint": (
+                        entrypoint
+                        if entrypoint is not None
+                        else (
+                            parent_image["Config"]["Entrypoint"]
+                            if parent_image
+                            else None
+                        )
+                    ),
+                    "Labels": dict(
+                        (
+                            (parent_image["Config"]["Labels"] or {})
+                            if parent_image
+                            else {}
+                        ),
+                        **(labels or {}),
+                    ),
+                    "Env": [],
+                },
+                "RootFS": {
+                    "Type": "layers",
+                    "Layers": base_layers
+                    + [_digest("layer", image_id, i) for i in range(layers)],
+                },
+                "_files": dict(
+                    parent_image["_files"] if parent_image else DEFAULT_FILES,
+                    **(files or {}),
+                ),
+            }
+            self.images[image_id] = image
+            for tag in tags:
+                self.tag(image_id, tag)
+            return image_id
+
+    def push(self, ref: str) -> str:
+        """Publish a new version of a tag to the fake registry"""
+        repo, tag = _split_ref(ref)
+        with self.lock:
+            digest = _digest("manifest", ref, next(self._counter))
+            self.registry[f"{repo}:{tag}"] = digest
+        return digest
+
+    def populate(self, count: int) -> None:
+        """Fill the inventory with unrelated images"""
+        for i in range(count):
+            self.add_image([f"example.com:5000/filler/image{i}:v{i % 7}"], layers=3)
+
+    def find_image(self, name: str) -> Dict[str, Any]:
+        with self.lock:
+            if name in self.images:
+                return self.images[name]
+            repo, tag = _split_ref(name.split("@")[0])
+            full = f"{repo}:{tag}"
+            for image in self.images.values():
+                if full in image["RepoTags"] or name in image["RepoDigests"]:
+                    return image
+            for image_id, image in self.images.items():
+                if len(name) >= 12 and image_id.startswith(
+                    name if name.startswith("sha256:") else "sha256:" + name
+                ):
+                    return image
+        raise ApiError(404, f"No such image: {name}")
+
+    def tag(self, image_id: str, ref: str) -> None:
+        repo, tag = _split_ref(ref)
+        full = f"{repo}:{tag}"
+        with self.lock:
+            for image in self.images.values():
+                if full in image["RepoTags"]:
+                    image["RepoTags"].remove(full)
+            self.images[image_id]["RepoTags"].append(full)
+            self._event("image", "tag", image_id)
+
+    def add_volume(
+        self, name: str, labels: Optional[Dict[str, str]] = None
+    ) -> Dict[str, Any]:
+        with self.lock:
+            if name not in self.volumes:
+                self.volumes[name] = {
+                    "Name": name,
+                    "Driver": "local",
+                    "Mountpoint": f"/var/lib/docker/volumes/{name}/_data",
+                    "Labels": labels or {},
+                    "Scope": "local",
+                    "Options": {},
+                    "CreatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                }
+                self._event("volume", "create", name)
+            return self.volumes[name]
+
+    def find_container(self, name: str) -> Dict[str, Any]:
+        with self.lock:
+            for container in self.containers.values():
+                if container["Name"] == "/" + name or container["Id"].startswith(name):
+                    return container
+        raise ApiError(404, f"No such container: {name}")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeDockerServer"
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip() or b"0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _dispatch(self, method: str) -> None:
+        engine = self.server.engine
+        url = urlparse(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self._read_body()
+        if engine.latency:
+            time.sleep(engine.latency)
+        for route_method, pattern, name, handler in ROUTES:
+            match = pattern.match(path) if route_method == method else None
+            if match is None:
+                continue
+            with engine.lock:
+                engine.calls[f"{method} {name}"] += 1
+            try:
+                result = handler(self, dict(params, **match.groupdict()), body)
+            except ApiError as e:
+                self._send_json(e.status, {"message": str(e)})
+            else:
+                self._send_result(result)
+            return
+        with engine.lock:
+            engine.calls[f"{method} <unknown>"] += 1
+        self._send_json(404, {"message": f"page not found: {method} {path}"})
+
+    def _send_result(self, result: Any) -> None:
+        if isinstance(result, Stream):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in result.chunks:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif isinstance(result, Raw):
+            self.send_response(200)
+            for key, value in result.headers.items():
+                self.send_header(key, value)
+            if result.hijack:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            else:
+                self.send_header("Content-Length", str(len(result.body)))
+            self.end_headers()
+            if result.hijack:
+                # The client reads hijacked output straight from the socket, so
+                # anything that arrives along with the headers gets lost in the
+                # http response buffer. A real process takes a moment to start.
+                self.wfile.flush()
+                time.sleep(0.005)
+            self.wfile.write(result.body)
+        elif result is None:
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self._send_json(200, result)
+
+    def _send_json(self, status: int, data: Any) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_HEAD(self) -> None:
+        self._dispatch("HEAD")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def do_PUT(self) -> None:
+        self._dispatch("PUT")
+
+    def do_DELETE(self) -> None:
+        self._dispatch("DELETE")
+
+    @property
+    def engine(self) -> FakeEngine:
+        return self.server.engine
+
+
+def _public(image: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in image.items() if not k.startswith("_")}
+
+
+def version(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    return {"ApiVersion": API_VERSION, "Version": "24.0.0", "Os": "linux"}
+
+
+def ping(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    return Raw(b"OK", {"Api-Version": API_VERSION})
+
+
+def list_images(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    with h.engine.lock:
+        return [
+            {
+                "Id": image["Id"],
+                "ParentId": image["Parent"],
+                "RepoTags": image["RepoTags"],
+                "RepoDigests": image["RepoDigests"],
+                "Created": image["Created"],
+                "Size": image["Size"],
+                "SharedSize": -1,
+                "Labels": image["Config"]["Labels"],
+                "Containers": -1,
+            }
+            for image in h.engine.images.values()
+        ]
+
+
+def inspect_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    return _public(h.engine.find_image(unquote(p["name"])))
+
+
+def image_history(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    image: Optional[Dict[str, Any]] = h.engine.find_image(unquote(p["name"]))
+    history = []
+    while image is not None:
+        parent = h.engine.images.get(image["Parent"])
+        history.append(
+            {
+                "Id": image["Id"],
+                "Created": image["Created"],
+                "CreatedBy": "",
+                "Tags": image["RepoTags"],
+                "Size": image["Size"] - parent["Size"] if parent else image["Size"],
+            }
+        )
+        image = parent
+    return history
+
+
+def tag_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    image = h.engine.find_image(unquote(p["name"]))
+    h.engine.tag(image["Id"], f"{p['repo']}:{p.get('tag') or 'latest'}")
+    return Raw(b"", {})
+
+
+def remove_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    engine = h.engine
+    name = unquote(p["name"])
+    image = engine.find_image(name)
+    with engine.lock:
+        repo, tag = _split_ref(name)
+        full = f"{repo}:{tag}"
+        if full in image["RepoTags"] and len(image["RepoTags"]) > 1:
+            image["RepoTags"].remove(full)
+            engine._event("image", "untag", image["Id"])
+            return [{"Untagged": full}]
+        del engine.images[image["Id"]]
+        engine._event("image", "delete", image["Id"])
+    return [{"Deleted": image["Id"]}]
+
+
+def pull_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    engine = h.engine
+    repo = p["fromImage"]
+    tag = p.get("tag") or "latest"
+    ref = f"{repo}@{tag}" if tag.startswith("sha256:") else f"{repo}:{tag}"
+    with engine.lock:
+        if tag.startswith("sha256:"):
+            digest = tag
+        else:
+            digest = engine.registry.setdefault(ref, _digest("manifest", ref))
+        image_id = engine.add_image(
+            [] if tag.startswith("sha256:") else [ref],
+            entrypoint=None,
+            layers=3,
+        )
+        engine.images[image_id]["RepoDigests"].append(f"{repo}@{digest}")
+        engine._event("image", "pull", ref)
+    layers = engine.images[image_id]["RootFS"]["Layers"]
+
+    def events() -> Iterable[Dict[str, Any]]:
+        yield {"status": f"Pulling from {repo}", "id": tag}
+        for layer in layers:
+            short = layer[7:19]
+            yield {"status": "Pulling fs layer", "id": short}
+            for current in (1024, 4096):
+                yield {
+                    "status": "Downloading",
+                    "id": short,
+                    "progressDetail": {"current": current, "total": 4096},
+                }
+            yield {"status": "Pull complete", "id": short}
+        yield {"status": f"Digest: {digest}"}
+        yield {"status": f"Status: Downloaded newer image for {ref}"}
+
+    return _ndjson(events())
+
+
+def inspect_distribution(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    name = unquote(p["name"])
+    repo, tag = _split_ref(name)
+    with h.engine.lock:
+        digest = h.engine.registry.setdefault(
+            f"{repo}:{tag}", _digest("manifest", f"{repo}:{tag}")
+        )
+    return {
+        "Descriptor": {
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "digest": digest,
+        },
+        "Platforms": [{"architecture": "amd64", "os": "linux"}],
+    }
+
+
+def build_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    engine = h.engine
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+        dockerfile_member = tar.getmember(p.get("dockerfile") or "Dockerfile")
+        dockerfile_obj = tar.extractfile(dockerfile_member)
+        assert dockerfile_obj is not None
+        dockerfile = dockerfile_obj.read().decode("utf-8")
+    lines = [line for line in dockerfile.splitlines() if line.strip()]
+    parent = engine.find_image(lines[0].split()[1])
+    entrypoint = None
+    for line in lines:
+        if line.startswith("ENTRYPOINT"):
+            entrypoint = json.loads(line[len("ENTRYPOINT") :])
+    tags = [p["t"]] if p.get("t") else []
+    image_id = engine.add_image(
+        tags,
+        parent=parent["Id"],
+        entrypoint=entrypoint,
+        labels=json.loads(p.get("labels") or "{}"),
+        layers=len(lines) - 1,
+    )
+    with engine.lock:
+        engine._event("image", "build", image_id)
+
+    def events() -> Iterable[Dict[str, Any]]:
+        for i, line in enumerate(lines):
+            yield {"stream": f"Step {i + 1}/{len(lines)} : {line}\n"}
+            yield {"stream": f" ---> {_digest('step', image_id, i)[7:19]}\n"}
+        yield {"aux": {"ID": image_id}}
+        yield {"stream": f"Successfully built {image_id[7:19]}\n"}
+
+    return _ndjson(events())
+
+
+def commit(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    engine = h.engine
+    container = engine.find_container(p["container"])
+    tags = [f"{p['repo']}:{p.get('tag') or 'latest'}"] if p.get("repo") else []
+    labels = {}
+    change = p.get("changes") or ""
+    if change.startswith("LABEL "):
+        key, _, value = change[len("LABEL ") :].partition("=")
+        labels[key] = value
+    image_id = engine.add_image(
+        tags, parent=container["Image"], labels=labels, size=1024 * 1024
+    )
+    return {"Id": image_id}
+
+
+def container_changes(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    container = h.engine.find_container(p["id"])
+    image = h.engine.images[container["Image"]]
+    return [
+        {"Path": path, "Kind": 0 if path in image["_files"] else 1}
+        for path in container["_files"]
+        if container["_files"][path] != image["_files"].get(path)
+    ] or None
+
+
+def _layer_tar(name: str) -> bytes:
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(name)
+        tar.addfile(info, io.BytesIO(name.encode("utf-8")))
+    return output.getvalue()
+
+
+def _add_tar_file(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def save_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    image = h.engine.find_image(unquote(p["name"]))
+    layers = image["RootFS"]["Layers"]
+    config = {
+        "config": image["Config"],
+        "rootfs": {"type": "layers", "diff_ids": layers},
+        "history": [{"created_by": f"layer {i}"} for i in range(len(layers))],
+    }
+    manifest = {
+        "Config": image["Id"][7:] + ".json",
+        "RepoTags": image["RepoTags"],
+        # Docker 25+ names layers by their digest
+        "Layers": [f"blobs/sha256/{layer[7:]}" for layer in layers],
+    }
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        for layer, path in zip(layers, manifest["Layers"]):
+            _add_tar_file(tar, path, _layer_tar(layer[7:]))
+        _add_tar_file(tar, manifest["Config"], json.dumps(config).encode("utf-8"))
+        _add_tar_file(tar, "manifest.json", json.dumps([manifest]).encode("utf-8"))
+    return Raw(output.getvalue(), {"Content-Type": "application/x-tar"})
+
+
+def load_image(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    engine = h.engine
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+        manifest_file = tar.extractfile("manifest.json")
+        assert manifest_file is not None
+        manifest = json.load(manifest_file)[0]
+        config_file = tar.extractfile(manifest["Config"])
+        assert config_file is not None
+        config_data = config_file.read()
+        sizes = {member.name: member.size for member in tar.getmembers()}
+    config = json.loads(config_data)
+    layers = config["rootfs"]["diff_ids"]
+    image_id = "sha256:" + hashlib.sha256(config_data).hexdigest()
+    with engine.lock:
+        if image_id in engine.images:
+            # Docker keeps the image it has and only adds the new tags
+            engine._event("image", "load", image_id)
+            for tag in manifest["RepoTags"]:
+                engine.tag(image_id, tag)
+            return _load_result(image_id, manifest["RepoTags"])
+        # Layers that aren't in the archive have to be in the engine already
+        parent = None
+        for image in engine.images.values():
+            image_layers = image["RootFS"]["Layers"]
+            if layers[: len(image_layers)] == image_layers and (
+                parent is None or len(image_layers) > len(parent["RootFS"]["Layers"])
+            ):
+                parent = image
+        known = len(parent["RootFS"]["Layers"]) if parent else 0
+        for path in manifest["Layers"][known:]:
+            if path not in sizes:
+                raise ApiError(500, f"open {path}: no such file or directory")
+        tmp_id = engine.add_image(
+            parent=parent["Id"] if parent else None,
+            entrypoint=config["config"].get("Entrypoint"),
+            labels=config["config"].get("Labels"),
+            layers=0,
+            size=sum(sizes[path] for path in manifest["Layers"][known:]),
+        )
+        image = engine.images.pop(tmp_id)
+        image["Id"] = image_id
+        image["RootFS"]["Layers"] = layers
+        engine.images[image_id] = image
+        engine._event("image", "load", image_id)
+        for tag in manifest["RepoTags"]:
+            engine.tag(image_id, tag)
+    return _load_result(image_id, manifest["RepoTags"])
+
+
+def _load_result(image_id: str, tags: List[str]) -> Any:
+    if not tags:
+        return _ndjson([{"stream": f"Loaded image ID: {image_id}\n"}])
+    return _ndjson([{"stream": f"Loaded image: {tag}\n"} for tag in tags])
+
+
+def events(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    since = float(p.get("since") or 0)
+    filters = json.loads(p.get("filters") or "{}")
+    types = filters.get("type")
+    if not p.get("until"):
+        return _ndjson(_follow_events(h.engine, p.get("since"), types))
+    until = float(p["until"])
+    with h.engine.lock:
+        matching = [
+            event
+            for event in h.engine.events
+            if since <= event["time"] <= until and (not types or event["Type"] in types)
+        ]
+    return _ndjson(matching)
+
+
+def _follow_events(
+    engine: FakeEngine, since: Optional[str], types: Optional[List[str]]
+) -> Iterable[Dict[str, Any]]:
+    """Stream events as they happen, like the daemon does without 'until'"""
+    with engine.lock:
+        seen = 0 if since else len(engine.events)
+    while True:
+        with engine.lock:
+            new = engine.events[seen:]
+            seen = len(engine.events)
+        for event in new:
+            if event["time"] >= float(since or 0) and (
+                not types or event["Type"] in types
+            ):
+                yield event
+        time.sleep(0.01)
+
+
+def list_containers(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    show_all = p.get("all") in ("1", "true", "True")
+    with h.engine.lock:
+        return [
+            {
+                "Id": c["Id"],
+                "Names": [c["Name"]],
+                "Image": c["Config"]["Image"],
+                "ImageID": c["Image"],
+                "Labels": c["Config"]["Labels"],
+                "State": c["State"]["Status"],
+                "Status": c["State"]["Status"],
+                "Created": c["_created"],
+                "SizeRw": 0,
+            }
+            for c in h.engine.containers.values()
+            if show_all or c["State"]["Running"]
+        ]
+
+
+def create_container(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    engine = h.engine
+    config = json.loads(body or b"{}")
+    image = engine.find_image(config["Image"])
+    name = p.get("name") or f"fake_{len(engine.containers)}"
+    with engine.lock:
+        if any(c["Name"] == "/" + name for c in engine.containers.values()):
+            raise ApiError(
+                409, f"Conflict. The container name /{name} is already in use"
+            )
+        container_id = _digest("container", next(engine._counter))[7:]
+        labels = dict(image["Config"]["Labels"] or {}, **(config.get("Labels") or {}))
+        mounts = []
+        for bind in (config.get("HostConfig") or {}).get("Binds") or []:
+            source, destination, mode = (bind.split(":") + ["rw"])[:3]
+            is_volume = not source.startswith("/")
+            if is_volume:
+                engine.add_volume(source)
+            mounts.append(
+                {
+                    "Type": "volume" if is_volume else "bind",
+                    "Name": source if is_volume else "",
+                    "Source": source,
+                    "Destination": destination,
+                    "Mode": mode,
+                    "RW": mode != "ro",
+                }
+            )
+        engine.containers[container_id] = {
+            "Id": container_id,
+            "Name": "/" + name,
+            "Image": image["Id"],
+            "Created": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "_created": int(time.time()),
+            "State": {
+                "Status": "created",
+                "Running": False,
+                "Pid": 0,
+                "StartedAt": "0001-01-01T00:00:00Z",
+            },
+            "Config": dict(config, Labels=labels, Image=config["Image"]),
+            "HostConfig": config.get("HostConfig") or {},
+            "Mounts": mounts,
+            "ExecIDs": None,
+            "_files": dict(image["_files"]),
+        }
+        engine._event("container", "create", container_id)
+    return {"Id": container_id, "Warnings": []}
+
+
+def inspect_container(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    return _public(h.engine.find_container(p["id"]))
+
+
+def _set_state(h: RequestHandler, container_id: str, status: str, action: str) -> None:
+    container = h.engine.find_container(container_id)
+    with h.engine.lock:
+        container["State"] = {
+            "Status": status,
+            "Running": status == "running",
+            "Pid": 4242 if status == "running" else 0,
+            "StartedAt": container["State"].get("StartedAt", "0001-01-01T00:00:00Z"),
+        }
+        if status == "running":
+            container["State"]["StartedAt"] = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime()
+            )
+        h.engine._event("container", action, container["Id"])
+
+
+def start_container(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    _set_state(h, p["id"], "running", "start")
+    # Running processes leave scratch files behind
+    container = h.engine.find_container(p["id"])
+    with h.engine.lock:
+        container["_files"].setdefault(f"/tmp/{container['Id'][:12]}.pid", b"4242")
+
+
+def stop_container(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    _set_state(h, p["id"], "exited", "die")
+
+
+def container_stats(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    container = h.engine.find_container(p["id"])
+    if not container["State"]["Running"]:
+        return {"memory_stats": {}, "cpu_stats": {"cpu_usage": {"total_usage": 0}}}
+    # Every exec has done a bit of work, and the container holds some memory
+    execs = len(container["ExecIDs"] or [])
+    return {
+        "read": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "memory_stats": {
+            "usage": (200 + 10 * execs) << 20,
+            "stats": {"anon": (150 + 10 * execs) << 20, "inactive_file": 40 << 20},
+        },
+        "cpu_stats": {"cpu_usage": {"total_usage": execs * 50_000_000}},
+    }
+
+
+def remove_container(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    container = h.engine.find_container(p["id"])
+    if container["State"]["Running"] and p.get("force") not in ("1", "true", "True"):
+        raise ApiError(409, "You cannot remove a running container")
+    with h.engine.lock:
+        del h.engine.containers[container["Id"]]
+        h.engine._event("container", "destroy", container["Id"])
+
+
+def get_archive(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    container = h.engine.find_container(p["id"])
+    path = p["path"].rstrip("/") or "/"
+    files = container["_files"]
+    is_mount = any(m["Destination"] == path for m in container["Mounts"])
+    children = {
+        name: data for name, data in files.items() if name.startswith(path + "/")
+    }
+    if path not in files and not children and not is_mount:
+        raise ApiError(404, f"Could not find the file {path} in container")
+    base = os.path.basename(path)
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        if path in files:
+            _add_tar_file(tar, base, files[path])
+        else:
+            info = tarfile.TarInfo(base)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            for name, data in sorted(children.items()):
+                _add_tar_file(tar, base + name[len(path) :], data)
+    size = len(files[path]) if path in files else 4096
+    stat = {"name": base, "size": size, "mode": 0o644}
+    encoded = base64.b64encode(json.dumps(stat).encode("utf-8")).decode("ascii")
+    return Raw(
+        output.getvalue(),
+        {"Content-Type": "application/x-tar", "X-Docker-Container-Path-Stat": encoded},
+    )
+
+
+def put_archive(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    container = h.engine.find_container(p["id"])
+    path = p["path"].rstrip("/")
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar, h.engine.lock:
+        for member in tar.getmembers():
+            fileobj = tar.extractfile(member) if member.isfile() else None
+            if fileobj is not None:
+                container["_files"][f"{path}/{member.name}"] = fileobj.read()
+    return Raw(b"", {})
+
+
+def create_exec(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    container = h.engine.find_container(p["id"])
+    if not container["State"]["Running"]:
+        raise ApiError(409, f"Container {container['Id']} is not running")
+    config = json.loads(body or b"{}")
+    with h.engine.lock:
+        exec_id = _digest("exec", next(h.engine._counter))[7:]
+        h.engine.execs[exec_id] = {
+            "ID": exec_id,
+            "ContainerID": container["Id"],
+            "Running": False,
+            "ExitCode": None,
+            "ProcessConfig": {"tty": config.get("Tty", False)},
+            "_cmd": config.get("Cmd"),
+        }
+        container["ExecIDs"] = (container["ExecIDs"] or []) + [exec_id]
+    return {"Id": exec_id}
+
+
+def start_exec(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    exec_info = h.engine.execs.get(p["id"])
+    if exec_info is None:
+        raise ApiError(404, "No such exec instance")
+    exec_info["ExitCode"] = 1 if (exec_info["_cmd"] or [""])[0] == "false" else 0
+    output = " ".join(exec_info["_cmd"] or []).encode("utf-8") + b"\n"
+    if exec_info["ProcessConfig"]["tty"]:
+        return Raw(
+            output, {"Content-Type": "application/vnd.docker.raw-stream"}, hijack=True
+        )
+    frame = struct.pack(">BxxxL", 1, len(output)) + output
+    return Raw(
+        frame,
+        {"Content-Type": "application/vnd.docker.multiplexed-stream"},
+        hijack=True,
+    )
+
+
+def inspect_exec(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    exec_info = h.engine.execs.get(p["id"])
+    if exec_info is None:
+        raise ApiError(404, "No such exec instance")
+    return {k: v for k, v in exec_info.items() if not k.startswith("_")}
+
+
+def system_df(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    with h.engine.lock:
+        images = list_images(h, p, body)
+        for image in images:
+            parent = h.engine.images.get(image["ParentId"])
+            image["SharedSize"] = parent["Size"] if parent else 0
+        return {
+            "LayersSize": sum(i["Size"] for i in h.engine.images.values()),
+            "Images": images,
+            "Containers": list_containers(h, {"all": "1"}, body),
+            "Volumes": [
+                dict(
+                    volume,
+                    UsageData={
+                        "Size": 1024 * len(volume["Name"]),
+                        "RefCount": sum(
+                            1
+                            for c in h.engine.containers.values()
+                            for m in c["Mounts"]
+                            if m["Name"] == volume["Name"]
+                        ),
+                    },
+                )
+                for volume in h.engine.volumes.values()
+            ],
+        }
+
+
+def _match_labels(labels: Dict[str, str], filters: Dict[str, Any]) -> bool:
+    for label in filters.get("label") or []:
+        key, sep, value = label.partition("=")
+        if key not in labels or (sep and labels[key] != value):
+            return False
+    return True
+
+
+def prune_images(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    filters = json.loads(p.get("filters") or "{}")
+    dangling = filters.get("dangling") or []
+    only_dangling = "true" in dangling or "1" in dangling
+    deleted = []
+    reclaimed = 0
+    with h.engine.lock:
+        parents = {image["Parent"] for image in h.engine.images.values()}
+        for image_id, image in list(h.engine.images.items()):
+            if only_dangling and image["RepoTags"]:
+                continue
+            if image_id in parents or not _match_labels(
+                image["Config"]["Labels"] or {}, filters
+            ):
+                continue
+            if any(c["Image"] == image_id for c in h.engine.containers.values()):
+                continue
+            del h.engine.images[image_id]
+            h.engine._event("image", "delete", image_id)
+            deleted.append({"Deleted": image_id})
+            reclaimed += image["Size"]
+    return {"ImagesDeleted": deleted, "SpaceReclaimed": reclaimed}
+
+
+def create_volume(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    config = json.loads(body or b"{}")
+    return h.engine.add_volume(config["Name"], config.get("Labels"))
+
+
+def list_volumes(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    filters = json.loads(p.get("filters") or "{}")
+    with h.engine.lock:
+        volumes = [
+            volume
+            for volume in h.engine.volumes.values()
+            if _match_labels(volume["Labels"], filters)
+        ]
+    return {"Volumes": volumes, "Warnings": []}
+
+
+def inspect_volume(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    volume = h.engine.volumes.get(unquote(p["name"]))
+    if volume is None:
+        raise ApiError(404, f"get {p['name']}: no such volume")
+    return volume
+
+
+def remove_volume(h: RequestHandler, p: Dict[str, str], body: bytes) -> Any:
+    name = unquote(p["name"])
+    with h.engine.lock:
+        if name not in h.engine.volumes:
+            raise ApiError(404, f"get {name}: no such volume")
+        in_use = any(
+            m["Name"] == name for c in h.engine.containers.values() for m in c["Mounts"]
+        )
+        if in_use and p.get("force") not in ("1", "true", "True"):
+            raise ApiError(409, f"remove {name}: volume is in use")
+        del h.engine.volumes[name]
+        h.engine._event("volume", "destroy", name)
+
+
+def _route(
+    method: str, pattern: str, handler: Handler
+) -> Tuple[str, Any, str, Handler]:
+    return (method, re.compile("^" + pattern + "$"), pattern, handler)
+
+
+ROUTES = [
+    _route("GET", r"/version", version),
+    _route("GET", r"/_ping", ping),
+    _route("HEAD", r"/_ping", ping),
+    _route("GET", r"/images/json", list_images),
+    _route("GET", r"/images/(?P<name>.+)/json", inspect_image),
+    _route("GET", r"/images/(?P<name>.+)/history", image_history),
+    _route("POST", r"/images/(?P<name>.+)/tag", tag_image),
+    _route("DELETE", r"/images/(?P<name>.+)", remove_image),
+    _route("POST", r"/images/create", pull_image),
+    _route("POST", r"/images/prune", prune_images),
+    _route("POST", r"/images/load", load_image),
+    _route("GET", r"/images/(?P<name>.+)/get", save_image),
+    _route("GET", r"/distribution/(?P<name>.+)/json", inspect_distribution),
+    _route("POST", r"/build", build_image),
+    _route("POST", r"/commit", commit),
+    _route("GET", r"/events", events),
+    _route("GET", r"/system/df", system_df),
+    _route("GET", r"/containers/json", list_containers),
+    _route("POST", r"/containers/create", create_container),
+    _route("GET", r"/containers/(?P<id>[^/]+)/json", inspect_container),
+    _route("POST", r"/containers/(?P<id>[^/]+)/start", start_container),
+    _route("POST", r"/containers/(?P<id>[^/]+)/stop", stop_container),
+    _route("POST", r"/containers/(?P<id>[^/]+)/kill", stop_container),
+    _route("GET", r"/containers/(?P<id>[^/]+)/stats", container_stats),
+    _route("DELETE", r"/containers/(?P<id>[^/]+)", remove_container),
+    _route("GET", r"/containers/(?P<id>[^/]+)/archive", get_archive),
+    _route("PUT", r"/containers/(?P<id>[^/]+)/archive", put_archive),
+    _route("GET", r"/containers/(?P<id>[^/]+)/changes", container_changes),
+    _route("POST", r"/containers/(?P<id>[^/]+)/exec", create_exec),
+    _route("POST", r"/exec/(?P<id>[^/]+)/start", start_exec),
+    _route("GET", r"/exec/(?P<id>[^/]+)/json", inspect_exec),
+    _route("POST", r"/volumes/create", create_volume),
+    _route("GET", r"/volumes", list_volumes),
+    _route("GET", r"/volumes/(?P<name>[^/]+)", inspect_volume),
+    _route("DELETE", r"/volumes/(?P<name>[^/]+)", remove_volume),
+]
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, engine: FakeEngine):
+        self.engine = engine
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, RequestHandler)
+
+    def get_request(self) -> Tuple[Any, Any]:
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ("fake-docker", 0)
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    @property
+    def docker_host(self) -> str:
+        return "unix://" + self.socket_path
+
+
+def main() -> None:
+    """Run a fake Docker Engine API on a unix socket"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("socket", help="Path of the unix socket to listen on")
+    parser.add_argument(
+        "-n",
+        "--images",
+        type=int,
+        default=100,
+        help="Number of filler images (default %(default)s)",
+    )
+    parser.add_argument(
+        "-l",
+        "--latency",
+        type=float,
+        default=0,
+        help="Latency to add to each request, in milliseconds",
+    )
+    args = parser.parse_args()
+    engine = FakeEngine(args.latency / 1000)
+    engine.populate(args.images)
+    server = FakeDockerServer(args.socket, engine)
+    print(f"export DOCKER_HOST={server.docker_host}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
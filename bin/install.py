@@ -31,11 +31,28 @@ def main() -> None:
         help="Where to put the binary (default %(default)s)",
         default=os.curdir,
     )
+    parser.add_argument(
+        "-l",
+        "--local",
+        metavar="DIR",
+        help="Build from a local checkout instead of downloading the ref",
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Build a zipped pex that unpacks itself and imports setuptools on "
+        "every run, like older versions of this script did. This is only useful "
+        "for comparing startup times with bin/bench_startup.py.",
+    )
     args = parser.parse_args()
 
     with tempfile.TemporaryDirectory() as tempdir:
         with tempfile.TemporaryDirectory() as venv_dir:
-            build_exe(args.ref, venv_dir, tempdir, args.dest)
+            if args.local:
+                bluepill = os.path.abspath(args.local)
+            else:
+                bluepill = download(args.ref, tempdir)
+            build_exe(bluepill, venv_dir, args.dest, args.legacy)
 
 
 @contextmanager
@@ -48,7 +65,8 @@ def pushd(dest: str) -> Iterator[None]:
         os.chdir(start)
 
 
-def build_exe(ref: str, venv_dir: str, workdir: str, dest: str) -> None:
+def download(ref: str, workdir: str) -> str:
+    """Download and extract bluepill from github and return its directory"""
     print("Downloading bluepill")
     url = f"https://github.com/stevearc/bluepill/archive/{ref}.tar.gz"
     bundle = urlretrieve(url)[0]
@@ -84,18 +102,34 @@ def build_exe(ref: str, venv_dir: str, workdir: str, dest: str) -> None:
                 tar.extractall(path, members, numeric_owner=numeric_owner)
 
             safe_extract(tar)
-    bluepill = os.path.join(workdir, package_dir.name)
+    return os.path.join(workdir, package_dir.name)
+
 
+def build_exe(bluepill: str, venv_dir: str, dest: str, legacy: bool = False) -> None:
     print("Creating virtualenv")
     venv.create(venv_dir, with_pip=True)
     pip = os.path.join(venv_dir, "bin", "pip")
-    subprocess.check_call([pip, "install", "pex", "wheel"])
+    subprocess.check_call([pip, "install", "pex>=2.1.25", "wheel"])
     pex = os.path.join(venv_dir, "bin", "pex")
     print("Building executable")
+    os.makedirs(dest, exist_ok=True)
     exe = os.path.join(dest, "bluepill")
-    subprocess.check_call(
-        [pex, "setuptools", bluepill, "-m", "bluepill:main", "-o", exe]
-    )
+    if legacy:
+        cmd = [pex, "setuptools", bluepill]
+    else:
+        # Nothing needs setuptools (or pkg_resources) at runtime, so leave it out
+        cmd = [
+            pex,
+            bluepill,
+            # On the first run, install into a virtualenv in ~/.pex. Every run
+            # after that execs the virtualenv's python directly, instead of
+            # bootstrapping pex and checking the unpacked zip.
+            "--venv",
+            # Include bytecode, so that the first run doesn't compile every module
+            "--compile",
+            "--no-emit-warnings",
+        ]
+    subprocess.check_call(cmd + ["-m", "bluepill:main", "-o", exe])
     print(f"executable written to {exe}")
 
 
@@ -1,11 +1,12 @@
 import argparse
 import logging
+import os
 import sys
-
-import docker
+import time
 
 from .commands import HelpCmd, add_parser_commands, all_commands
 from .config import Config
+from .profile import enable as enable_profiling
 
 
 def _setup_logging(args: argparse.Namespace) -> None:
@@ -19,6 +20,7 @@ def _setup_logging(args: argparse.Namespace) -> None:
 
 def main() -> None:
     """Create and manage per-directory docker images and containers"""
+    start = time.perf_counter()
     parser = argparse.ArgumentParser(description=main.__doc__)
     parser.add_argument(
         "--log-level",
@@ -26,15 +28,48 @@ def main() -> None:
         default=logging.WARNING,
         help="Stdout logging level (default 'warning')",
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Trace docker API requests and time spent in bluepill, and write "
+        "a Chrome trace file (open it with chrome://tracing or ui.perfetto.dev)",
+    )
+    parser.add_argument(
+        "--profile-output",
+        metavar="FILE",
+        help="Where to write the --profile trace "
+        "(default a new file in the bluepill cache dir)",
+    )
     parser.set_defaults(root_parser=parser)
+    config_start = time.perf_counter()
     config = Config.load()
+    parser_start = time.perf_counter()
     add_parser_commands(parser, config, all_commands, "command", HelpCmd)
     args = parser.parse_args()
+    parser_end = time.perf_counter()
     _setup_logging(args)
 
-    client = docker.from_env(timeout=360)
-    cmd = args.command(client, config, **vars(args))
-    cmd.run()
+    if not args.profile:
+        cmd = args.command(None, config, **vars(args))
+        cmd.run()
+        return
+
+    profiler = enable_profiling(start)
+    profiler.add("load config", config_start, parser_start)
+    profiler.add("construct parser", parser_start, parser_end)
+    try:
+        with profiler.phase("run", command=args.command.name()):
+            cmd = args.command(None, config, **vars(args))
+            cmd.run()
+    finally:
+        output = args.profile_output or os.path.join(
+            Config.get_cache_dir(),
+            "profiles",
+            f"{args.command.name()}-{time.strftime('%Y%m%d-%H%M%S')}.json",
+        )
+        profiler.write(output)
+        profiler.print_summary()
+        sys.stderr.write(f"Wrote trace to {output}\n")
 
 
 if __name__ == "__main__":
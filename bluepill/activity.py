@@ -0,0 +1,77 @@
+import calendar
+import sys
+import time
+from typing import Any, Dict, Optional
+
+from .util import JsonCache
+
+if sys.version_info < (3, 8):
+    from typing_extensions import TypedDict
+else:
+    from typing import TypedDict
+
+# A container that uses less CPU than this (as a fraction of one core) between
+# two samples is considered idle. The process that keeps it alive uses none.
+IDLE_CPU = 0.01
+
+
+class Activity(TypedDict, total=False):
+    # When the container was last seen doing something
+    active: float
+    # Total CPU time of the container in nanoseconds, and when it was sampled
+    cpu: int
+    sampled: float
+    # When it was last stopped for being idle, and how much memory that freed
+    stopped: float
+    reclaimed: int
+    # Memory freed by stopping it for being idle, over all time
+    reclaimed_total: int
+
+
+class ActivityCache(JsonCache[Activity]):
+    """Records when each environment's container was last active"""
+
+    filename = "activity.json"
+
+
+def resident_memory(stats: Dict[str, Any]) -> Optional[int]:
+    """Memory that a container holds, from the docker stats endpoint
+
+    This is anonymous memory (which only stopping the container frees) and
+    leaves out the page cache, like 'docker stats' does.
+    """
+    memory = stats.get("memory_stats") or {}
+    if not memory.get("usage"):
+        return None
+    detail = memory.get("stats") or {}
+    # cgroup v2 calls it anon, v1 calls it rss
+    for key in ("anon", "total_rss", "rss"):
+        if key in detail:
+            return int(detail[key])
+    inactive = detail.get("inactive_file", detail.get("total_inactive_file", 0))
+    return max(0, int(memory["usage"]) - int(inactive))
+
+
+def cpu_usage(stats: Dict[str, Any]) -> int:
+    return int(
+        ((stats.get("cpu_stats") or {}).get("cpu_usage") or {}).get("total_usage") or 0
+    )
+
+
+def is_busy(entry: Activity, cpu: int, now: float) -> bool:
+    """True if the container used CPU since the last sample"""
+    if "cpu" not in entry or "sampled" not in entry or cpu < entry["cpu"]:
+        # Not sampled before, or restarted since
+        return False
+    elapsed = max(now - entry["sampled"], 1e-3)
+    return (cpu - entry["cpu"]) / 1e9 > IDLE_CPU * elapsed
+
+
+def parse_docker_time(value: Optional[str]) -> Optional[float]:
+    """Parse a timestamp like 2021-01-02T03:04:05.123456789Z"""
+    if not value or value.startswith("0001-"):
+        return None
+    try:
+        return float(calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")))
+    except ValueError:
+        return None
@@ -0,0 +1,236 @@
+import io
+import json
+import queue
+import sys
+import tarfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, Optional
+
+from .progress import ProgressPrinter
+from .util import format_bytes
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSIONS = ("zstd", "gzip")
+
+# Layout of a bluepill archive. The metadata comes first so that loading can
+# check it before streaming the rest.
+ARCHIVE_VERSION = 1
+METADATA_FILE = "bluepill.json"
+IMAGE_PREFIX = "image/"
+VOLUMES_PREFIX = "volumes/"
+
+
+def default_compression(file: str) -> str:
+    """Pick the compression from the file extension, preferring zstd"""
+    if file.endswith((".gz", ".tgz")):
+        return "gzip"
+    if file.endswith((".zst", ".zstd")):
+        return "zstd"
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return "gzip"
+    return "zstd"
+
+
+def _import_zstandard() -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(
+            "zstd compression requires the 'zstandard' package "
+            "(pip install zstandard), or use gzip"
+        )
+    return zstandard
+
+
+class IterReader(io.RawIOBase):
+    """Readable file over an iterator of byte chunks, such as a docker stream"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class Meter(io.RawIOBase):
+    """File wrapper that counts the bytes passing through and shows throughput"""
+
+    def __init__(self, fileobj: IO[bytes], printer: ProgressPrinter, verb: str):
+        self.fileobj = fileobj
+        self.printer = printer
+        self.verb = verb
+        self.bytes = 0
+        self.start = time.perf_counter()
+        self._last_report = 0.0
+
+    def _count(self, size: int) -> None:
+        self.bytes += size
+        now = time.perf_counter()
+        if now - self._last_report > 0.2:
+            self._last_report = now
+            self.printer.status(f"{self.verb} {self.summary()}")
+
+    def summary(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-6)
+        return (
+            f"{format_bytes(self.bytes)} in {elapsed:.1f}s "
+            f"({format_bytes(int(self.bytes / elapsed))}/s)"
+        )
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        data = self.fileobj.read(len(b))
+        b[: len(data)] = data
+        self._count(len(data))
+        return len(data)
+
+    def write(self, b: Any) -> int:
+        self.fileobj.write(b)
+        self._count(len(b))
+        return len(b)
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+
+@contextmanager
+def open_writer(fileobj: IO[bytes], compression: str) -> Iterator[tarfile.TarFile]:
+    """Open a tar stream that is compressed into fileobj as it is written"""
+    if compression == "gzip":
+        with tarfile.open(fileobj=fileobj, mode="w|gz") as tar:
+            yield tar
+        return
+    if compression != "zstd":
+        raise ValueError(f"Unknown compression '{compression}'")
+    zstandard = _import_zstandard()
+    compressor = zstandard.ZstdCompressor(threads=-1).stream_writer(
+        fileobj, closefd=False
+    )
+    with compressor, tarfile.open(fileobj=compressor, mode="w|") as tar:
+        yield tar
+
+
+@contextmanager
+def open_reader(fileobj: io.BufferedReader) -> Iterator[tarfile.TarFile]:
+    """Open a compressed tar stream, detecting gzip or zstd from its header"""
+    magic = fileobj.peek(4)[:4]
+    if magic.startswith(GZIP_MAGIC):
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+            yield tar
+    elif magic == ZSTD_MAGIC:
+        zstandard = _import_zstandard()
+        reader = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+        with reader, tarfile.open(fileobj=reader, mode="r|") as tar:
+            yield tar
+    else:
+        raise ValueError("Not a gzip or zstd compressed bluepill archive")
+
+
+def add_json(tar: tarfile.TarFile, name: str, data: Any) -> None:
+    encoded = json.dumps(data, indent=2).encode("utf-8")
+    info = tarfile.TarInfo(name)
+    info.size = len(encoded)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(encoded))
+
+
+def read_json(tar: tarfile.TarFile, member: tarfile.TarInfo) -> Dict[str, Any]:
+    fileobj = tar.extractfile(member)
+    if fileobj is None:
+        raise ValueError(f"'{member.name}' in the archive is not a file")
+    data: Dict[str, Any] = json.load(fileobj)
+    return data
+
+
+class TarPipe:
+    """Tar stream that is written in this thread and consumed in another
+
+    The consumer (e.g. a docker API call that uploads the tar) is called with
+    an iterator of chunks in a background thread. At most a few chunks are
+    queued, so the whole stream is never held in memory.
+    """
+
+    def __init__(self, consume: Callable[[Iterator[bytes]], Any]):
+        self._consume = consume
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=16)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.result: Any = None
+
+    def _chunks(self) -> Iterator[bytes]:
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def _run(self) -> None:
+        try:
+            self.result = self._consume(self._chunks())
+        except BaseException as e:
+            self._error = e
+
+    def write(self, data: bytes) -> int:
+        chunk = bytes(data)
+        while True:
+            if not self._thread.is_alive():
+                raise self._error or BrokenPipeError("The tar stream was closed")
+            try:
+                self._queue.put(chunk, timeout=0.1)
+                return len(chunk)
+            except queue.Full:
+                continue
+
+    def __enter__(self) -> tarfile.TarFile:
+        self._thread.start()
+        self._tar = tarfile.open(fileobj=self, mode="w|")  # type: ignore
+        return self._tar
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        if exc_type is None:
+            self._tar.close()
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self._thread.join()
+        if exc_type is None and self._error is not None:
+            raise self._error
+
+
+@contextmanager
+def open_file(file: str, mode: str) -> Iterator[IO[bytes]]:
+    """Open a file for binary reading or writing, where '-' is stdin/stdout"""
+    if file != "-":
+        with open(file, mode + "b") as fileobj:
+            yield fileobj
+    elif mode.startswith("r"):
+        yield sys.stdin.buffer
+    else:
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
@@ -1,21 +1,29 @@
-from typing import List, Type
+from typing import List
 
-from .base import Command
+from .base import CommandSpec, LazyCommand
 from .base import add_parser_commands as add_parser_commands
-from .cmd_build import BuildCmd
-from .cmd_commit import CommitCmd
-from .cmd_config import ConfigCmd
-from .cmd_delete import DeleteCmd
-from .cmd_enter import EnterCmd
 from .cmd_help import HelpCmd as HelpCmd
 
 __all__ = ["all_commands"]
 
-all_commands: List[Type[Command]] = [
-    BuildCmd,
-    ConfigCmd,
+# Commands are only imported when selected, so that cheap commands don't pay
+# for importing docker and friends
+all_commands: List[CommandSpec] = [
+    LazyCommand("build", ".cmd_build", "BuildCmd"),
+    LazyCommand("config", ".cmd_config", "ConfigCmd"),
     HelpCmd,
-    DeleteCmd,
-    EnterCmd,
-    CommitCmd,
+    LazyCommand("rm", ".cmd_delete", "DeleteCmd"),
+    LazyCommand("enter", ".cmd_enter", "EnterCmd"),
+    LazyCommand("run", ".cmd_run", "RunCmd"),
+    LazyCommand("foreach", ".cmd_foreach", "ForeachCmd"),
+    LazyCommand("commit", ".cmd_commit", "CommitCmd"),
+    LazyCommand("volumes", ".cmd_volumes", "VolumesCmd"),
+    LazyCommand("gc", ".cmd_gc", "GcCmd"),
+    LazyCommand("ls", ".cmd_list", "ListCmd"),
+    LazyCommand("save", ".cmd_save", "SaveCmd"),
+    LazyCommand("load", ".cmd_load", "LoadCmd"),
+    LazyCommand("prewarm", ".cmd_prewarm", "PrewarmCmd"),
+    LazyCommand("hook", ".cmd_hook", "HookCmd"),
+    LazyCommand("daemon", ".cmd_daemon", "DaemonCmd"),
+    LazyCommand("stats", ".cmd_stats", "StatsCmd"),
 ]
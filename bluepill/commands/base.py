@@ -1,24 +1,94 @@
+import fcntl
 import getpass
 import hashlib
+import importlib
+import json
+import logging
 import os
+import re
+import shlex
 import sys
+import threading
 from abc import ABC, abstractmethod
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from functools import partial
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Sequence, Type, cast
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 
-from docker import DockerClient
-from docker.errors import ContainerError, NotFound
-from docker.models.containers import Container
-from docker.models.images import Image
-
-from ..config import Config
+from ..activity import parse_docker_time
+from ..config import Config, ProjectConfig
+from ..daemon import DEFAULT_TIMEOUT, DaemonClient, DaemonUnavailable
+from ..environments import PROJECT_LABEL, Environments
+from ..images import DEFAULT_TAG, ImageIndex, parse_image_ref
+from ..profile import get_profiler, phase
+from ..progress import ProgressPrinter, TimingLog, follow_build, follow_pull
+from ..provision import (
+    PROVISION_LABEL,
+    build_with_cli,
+    has_buildkit,
+    make_dockerfile,
+    parse_steps,
+    steps_digest,
+)
+from ..resources import make_resource_args, merge_resources
+from ..userlayer import (
+    ImageFiles,
+    ImageUsers,
+    ImageUsersCache,
+    UserLayerCache,
+    UserSpec,
+    make_files_build_context,
+    make_user_archive,
+    read_image_users,
+    user_layer_key,
+    user_layer_tag,
+)
 
 if sys.version_info < (3, 8):
     from typing_extensions import TypedDict
 else:
     from typing import TypedDict
 
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from docker import DockerClient
+    from docker.models.containers import Container
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHELL = "/bin/bash"
+# Label that marks containers that keep running and have shells exec'd into them.
+# Containers without it run the shell as PID 1 and are attached to instead.
+MODE_LABEL = "bluepill.mode"
+SHELL_LABEL = "bluepill.shell"
+# The resource settings that a container was created with, to detect changes
+RESOURCES_LABEL = "bluepill.resources"
+KEEPALIVE_COMMAND = ["tail", "-f", "/dev/null"]
+# Label on every image that bluepill builds, so that dangling ones can be pruned
+MANAGED_LABEL = "bluepill.managed"
+# Labels on the named volumes that bluepill creates for home and cache dirs
+VOLUME_LABEL = "bluepill.volume"
+# Logs of background processes are truncated when they grow past this
+MAX_LOG_SIZE = 1024 * 1024
+
 
 class Volume(TypedDict):
     bind: str
@@ -36,17 +106,86 @@ class ContainerArgs(TypedDict):
     working_dir: str
 
 
+class CacheVolume(NamedTuple):
+    name: str
+    path: str
+    # Empty for volumes that are shared by all projects
+    project: str
+
+
+class LazyCommand:
+    """Reference to a Command that is only imported if it is selected"""
+
+    def __init__(
+        self, name: str, module: str, class_name: str, aliases: Sequence[str] = ()
+    ):
+        self.name = name
+        self.aliases = aliases
+        self._module = module
+        self._class_name = class_name
+
+    def load(self) -> Type["Command"]:
+        module = importlib.import_module(self._module, __package__)
+        return cast(Type["Command"], getattr(module, self._class_name))
+
+
+CommandSpec = Union[Type["Command"], LazyCommand]
+
+
+class CommandParser(ArgumentParser):
+    """ArgumentParser that configures a lazy command the first time it parses"""
+
+    def __init__(
+        self,
+        *args: Any,
+        lazy_command: Optional[LazyCommand] = None,
+        config: Optional[Config] = None,
+        command_name: str = "command",
+        **kwargs: Any,
+    ):
+        super().__init__(*args, **kwargs)
+        self._lazy_command = lazy_command
+        self._config = config
+        self._command_name = command_name
+
+    def _load_command(self) -> None:
+        if self._lazy_command is None or self._config is None:
+            return
+        command = self._lazy_command.load()
+        self._lazy_command = None
+        self.description = command.description()
+        command.configure(self._config, self)
+        self.set_defaults(**{self._command_name: command})
+
+    def parse_known_args(  # type: ignore[override]
+        self,
+        args: Optional[Sequence[str]] = None,
+        namespace: Optional[Namespace] = None,
+    ) -> Tuple[Namespace, List[str]]:
+        self._load_command()
+        return super().parse_known_args(args, namespace)
+
+
 def add_parser_commands(
     parser: ArgumentParser,
     config: Config,
-    commands: Sequence[Type["Command"]],
+    commands: Sequence[CommandSpec],
     command_name: str,
     default_command: Optional[Type["Command"]] = None,
 ) -> None:
     if default_command is not None:
         parser.set_defaults(**{command_name: default_command})
-    subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers(parser_class=CommandParser)
     for command in commands:
+        if isinstance(command, LazyCommand):
+            subparsers.add_parser(
+                command.name,
+                aliases=command.aliases,
+                lazy_command=command,
+                config=config,
+                command_name=command_name,
+            )
+            continue
         subparser = subparsers.add_parser(
             command.name(),
             description=command.description(),
@@ -57,10 +196,38 @@ def add_parser_commands(
 
 
 class Command(ABC):
-    def __init__(self, client: DockerClient, config: Config, **kwargs: Any):
+    def __init__(self, client: Optional["DockerClient"], config: Config, **kwargs: Any):
         self._kwargs = kwargs
-        self.client = client
+        self._client = client
         self.config = config
+        self._image_index: Optional[ImageIndex] = None
+        self._user_layers: Optional[UserLayerCache] = None
+        self._image_users: Optional[ImageUsersCache] = None
+        self._environments: Optional[Environments] = None
+        self._executor: Optional["ThreadPoolExecutor"] = None
+        self._daemon: Optional[DaemonClient] = None
+        # Set to False to never use 'bluepill daemon', even if it is running
+        self.use_daemon = True
+        # Guards lazy attributes that are used from the executor's threads
+        self._init_lock = threading.RLock()
+        self.timings = TimingLog()
+        # Set to False to print progress as plain lines (e.g. when running
+        # several builds at once). None means 'if stdout is a tty'.
+        self.live_progress: Optional[bool] = None
+
+    @property
+    def client(self) -> "DockerClient":
+        """The docker client, which is only created when a command first needs it"""
+        with self._init_lock:
+            if self._client is None:
+                with phase("connect to docker"):
+                    import docker
+
+                    self._client = docker.from_env(timeout=360)
+                    profiler = get_profiler()
+                    if profiler is not None:
+                        profiler.instrument(self._client)
+            return self._client
 
     @classmethod
     @abstractmethod
@@ -85,97 +252,705 @@ class Command(ABC):
     def run(self) -> None:
         raise NotImplementedError
 
-    def get_hostname(self, name: Optional[str] = None) -> str:
+    def get_hostname(
+        self, name: Optional[str] = None, directory: Optional[str] = None
+    ) -> str:
         if name is not None:
             return name
-        return os.path.basename(os.path.abspath(os.getcwd()))
+        return os.path.basename(os.path.abspath(directory or os.getcwd()))
 
-    def get_unique_dir_name(self, name: Optional[str] = None) -> str:
+    def get_unique_dir_name(
+        self, name: Optional[str] = None, directory: Optional[str] = None
+    ) -> str:
         if name is not None:
             return name
-        curdir = os.path.realpath(os.path.abspath(os.getcwd()))
-        md5 = hashlib.md5()
-        md5.update(curdir.encode("utf-8"))
-        return f"bluepill-{os.path.basename(curdir)}-{md5.hexdigest()}"
+        with phase("get_unique_dir_name"):
+            curdir = os.path.realpath(os.path.abspath(directory or os.getcwd()))
+            md5 = hashlib.md5()
+            md5.update(curdir.encode("utf-8"))
+            return f"bluepill-{os.path.basename(curdir)}-{md5.hexdigest()}"
+
+    @property
+    def image_index(self) -> ImageIndex:
+        with self._init_lock:
+            if self._image_index is None:
+                self._image_index = ImageIndex(self.client)
+            return self._image_index
+
+    @property
+    def user_layers(self) -> UserLayerCache:
+        if self._user_layers is None:
+            self._user_layers = UserLayerCache()
+        return self._user_layers
+
+    @property
+    def image_users(self) -> ImageUsersCache:
+        if self._image_users is None:
+            self._image_users = ImageUsersCache()
+        return self._image_users
+
+    @property
+    def environments(self) -> Environments:
+        if self._environments is None:
+            self._environments = Environments()
+        return self._environments
+
+    def get_printer(self, name: str) -> ProgressPrinter:
+        return ProgressPrinter(name, live=self.live_progress)
+
+    def call_daemon(
+        self, method: str, timeout: Optional[float] = DEFAULT_TIMEOUT, **params: Any
+    ) -> Any:
+        """Send a request to 'bluepill daemon'
+
+        Raises DaemonUnavailable if it isn't running, in which case the caller
+        should do the work itself.
+        """
+        if self.use_daemon and self._daemon is None:
+            self._daemon = DaemonClient.connect()
+            self.use_daemon = self._daemon is not None
+        if not self.use_daemon or self._daemon is None:
+            raise DaemonUnavailable("The bluepill daemon is not running")
+        with phase("daemon", method=method):
+            try:
+                return self._daemon.call(method, timeout, **params)
+            except DaemonUnavailable:
+                logger.debug("Not using the bluepill daemon", exc_info=True)
+                self.use_daemon = False
+                raise
+
+    def detach(self, log_name: str) -> bool:
+        """Continue in a background process that logs to a file in the cache dir
+
+        Returns True in the background process and False in the original one
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork():
+            return False
+        # Leave the shell's session, so that the process isn't killed with it
+        os.setsid()
+        log_file = os.path.join(Config.get_cache_dir(), log_name)
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        mode = "a"
+        if os.path.exists(log_file) and os.path.getsize(log_file) > MAX_LOG_SIZE:
+            mode = "w"
+        with open(log_file, mode) as log, open(os.devnull, "r") as devnull:
+            os.dup2(devnull.fileno(), 0)
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        self.live_progress = False
+        return True
+
+    @contextmanager
+    def exclusive(self, key: str) -> Iterator[bool]:
+        """Hold a lock for work that shouldn't be done twice at once
+
+        The lock is shared by all threads and bluepill processes. Yields True if
+        it had to wait for someone else, who may have done the work already.
+        """
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        lock_file = os.path.join(Config.get_cache_dir(), "locks", digest)
+        os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+        # flock locks belong to the open file, so this also excludes other
+        # threads of this process
+        with open(lock_file, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                waited = False
+            except BlockingIOError:
+                with phase("wait for lock", key=key):
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                waited = True
+            yield waited
+
+    def concurrently(self, *calls: Callable[[], Any]) -> List[Any]:
+        """Make independent daemon requests at the same time
+
+        Returns the results in order, and raises the first exception. The calls
+        must not use concurrently themselves, or they could wait forever for a
+        free thread.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if len(calls) <= 1:
+            return [call() for call in calls]
+        with self._init_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(8, thread_name_prefix="bluepill")
+        futures = [self._executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
 
     def has_image(self, name: str) -> bool:
-        include_version = ":" in name
-        images = self.client.images.list()
-        for image in images:
-            image = cast(Image, image)
-            if image.id == name:
-                return True
-            for tag in image.tags:
-                if include_version and name == tag:
-                    return True
-                elif not include_version and name == tag.split(":")[0]:
-                    return True
-        return False
-
-    def get_container(self, name: str) -> Optional[Container]:
+        with phase("resolve image", image=name):
+            return self.image_index.has(name)
+
+    def get_cache_volumes(self, name: str) -> List[CacheVolume]:
+        """The named volumes for a project's home and cache directories"""
+        home = os.environ.get("HOME", "/")
+        volumes: List[CacheVolume] = []
+        if self.config.home_volume:
+            volumes.append(CacheVolume(f"{name}-home", home, name))
+        for path in self.config.cache_volumes:
+            if path == "~" or path.startswith("~/"):
+                path = os.path.join(home, path[2:])
+            elif not os.path.isabs(path):
+                logger.warning("Ignoring cache volume '%s': not an absolute path", path)
+                continue
+            slug = re.sub(r"[^a-zA-Z0-9_.-]+", "-", os.path.relpath(path, home))
+            slug = slug.strip("-.") or "home"
+            if self.config.share_volumes:
+                volumes.append(CacheVolume(f"bluepill-cache-{slug}", path, ""))
+            else:
+                volumes.append(CacheVolume(f"{name}-cache-{slug}", path, name))
+        return volumes
+
+    def create_volume(self, volume: CacheVolume) -> None:
+        """Create a named volume, if it doesn't exist already"""
+        self.client.volumes.create(
+            volume.name,
+            labels={VOLUME_LABEL: volume.path, PROJECT_LABEL: volume.project},
+        )
+
+    def create_volumes(self, name: str) -> None:
+        """Create the named volumes for a project, if they don't exist already"""
+        self.concurrently(
+            *[partial(self.create_volume, v) for v in self.get_cache_volumes(name)]
+        )
+
+    def get_project_volumes(self, name: str) -> List[str]:
+        """Names of all volumes that belong to a single project"""
+        volumes = self.client.volumes.list(filters={"label": f"{PROJECT_LABEL}={name}"})
+        return [volume.name for volume in volumes]
+
+    @contextmanager
+    def volume_container(
+        self, image: str, volumes: Sequence[CacheVolume]
+    ) -> Iterator[str]:
+        """A temporary container with volumes mounted, for copying files in and out
+
+        The container is never started. Yields its ID.
+        """
+        container = self.client.api.create_container(
+            image,
+            ["true"],
+            entrypoint=[],
+            host_config=self.client.api.create_host_config(
+                binds=[f"{volume.name}:{volume.path}" for volume in volumes]
+            ),
+        )
         try:
-            return cast(Container, self.client.containers.get(name))
-        except NotFound:
-            return None
+            yield container["Id"]
+        finally:
+            self.client.api.remove_container(container["Id"], force=True)
+
+    def inspect_image(self, image: str) -> Optional[Dict[str, Any]]:
+        """Get the details of a local image, or None if it doesn't exist"""
+        from docker.errors import ImageNotFound
+
+        with phase("inspect image", image=image):
+            try:
+                return cast(Dict[str, Any], self.client.api.inspect_image(image))
+            except ImageNotFound:
+                return None
+
+    def get_container(self, name: str) -> Optional["Container"]:
+        from docker.errors import NotFound
+
+        with phase("find container"):
+            try:
+                return cast("Container", self.client.containers.get(name))
+            except NotFound:
+                return None
+
+    def get_registry_digest(self, image: str) -> Optional[str]:
+        """Get the digest of the manifest that the registry has for an image"""
+        from docker.errors import APIError
 
-    def add_user_to_image(self, source_image: str, dest_image: str) -> None:
-        uid = os.getuid()
-        gid = os.getgid()
-        user = getpass.getuser()
-        if not self.has_image(source_image):
-            self.client.images.pull(*source_image.split(":"))
         try:
-            stdout = (
-                self.client.containers.run(
-                    source_image, f"-u {user}", entrypoint="id", remove=True
-                )
-                .decode("utf-8")
-                .strip()
+            data = self.client.api.inspect_distribution(image)
+        except APIError as e:
+            logger.warning("Could not check registry for %s: %s", image, e)
+            return None
+        return cast(Optional[str], data.get("Descriptor", {}).get("digest"))
+
+    def is_image_current(self, image: str, image_id: str) -> bool:
+        """Check if a local image matches the registry's version of the tag"""
+        ref = parse_image_ref(image)
+        if ref.digest is not None:
+            # Digests are immutable, so a local copy is always current
+            return True
+        remote = self.get_registry_digest(ref.tagged())
+        if remote is None:
+            return True
+        return remote in self.image_index.get_digests(image_id, ref.repository)
+
+    def pull_image(self, image: str, refresh: bool = False) -> str:
+        """Make sure an image exists locally and return its ID
+
+        If refresh is True, also pull if the registry has a newer version
+        """
+        with phase("resolve image", image=image):
+            image_id = self.image_index.verify(image)
+            if image_id is not None and (
+                not refresh or self.is_image_current(image, image_id)
+            ):
+                return image_id
+        with self.exclusive(f"pull {image}") as waited:
+            if waited:
+                # Someone else was pulling the same image, so it's probably
+                # there now
+                info = self.inspect_image(image)
+                if info is not None and info["Id"] != image_id:
+                    self.image_index.invalidate()
+                    return cast(str, info["Id"])
+            ref = parse_image_ref(image)
+            events = self.client.api.pull(
+                ref.repository,
+                tag=ref.digest or ref.tag or DEFAULT_TAG,
+                stream=True,
+                decode=True,
             )
-        except ContainerError:
-            has_user = False
-        else:
-            has_user = stdout == str(uid)
+            follow_pull(events, image, self.get_printer(image), self.timings)
+            self.image_index.invalidate()
+            image_id = self.image_index.get(image)
+        if image_id is None:
+            raise ValueError(f"Could not find image '{image}' after pull")
+        return image_id
+
+    def add_user_to_image(
+        self,
+        source_image: str,
+        dest_image: str,
+        mode: Optional[str] = None,
+        refresh: bool = False,
+    ) -> str:
+        """Build (or reuse) an image with the user added and tag it as dest_image
+
+        Returns the ID of the image
+        """
+        layer_id, _ = self.get_user_layer(source_image, mode, refresh)
+        self.tag_image(layer_id, dest_image)
+        return layer_id
+
+    def get_user_layer(
+        self, source_image: str, mode: Optional[str] = None, refresh: bool = False
+    ) -> Tuple[str, str]:
+        """Build (or reuse) an image with the user added
+
+        Returns its ID and its tag, which only depends on the source image and
+        the user
+        """
+        if mode is None:
+            mode = self.config.user_layer
+        spec = UserSpec(os.getuid(), os.getgid(), getpass.getuser())
+        source_id = self.pull_image(source_image, refresh)
+        # The user layer only depends on the source image and the user, so it can
+        # be shared by every project image built from the same source
+        key = user_layer_key(source_id, spec, mode)
+        layer_id = self.user_layers.get(key)
+        tag = user_layer_tag(key)
+        if layer_id is not None and self.image_index.verify(tag) != layer_id:
+            if self.image_index.verify(layer_id) is None:
+                layer_id = None
+            else:
+                self.tag_image(layer_id, tag)
+        if layer_id is None:
+            with self.exclusive(f"user layer {key}") as waited:
+                # Another build of the same layer may have just finished
+                info = self.inspect_image(tag) if waited else None
+                if info is not None:
+                    layer_id = cast(str, info["Id"])
+                elif mode == "files":
+                    layer_id = self.build_user_layer_from_files(source_id, spec, tag)
+                else:
+                    layer_id = self.build_user_layer(source_id, spec, tag)
+            self.user_layers.set(key, layer_id)
+        return layer_id, tag
+
+    def build_project_image(
+        self,
+        source_image: str,
+        dest_image: str,
+        mode: Optional[str] = None,
+        refresh: bool = False,
+        directory: Optional[str] = None,
+    ) -> str:
+        """Build the image for a project and tag it as dest_image
+
+        This is the user layer, plus a layer for each provisioning step in the
+        project's .bluepill.json. Returns the ID of the image.
+        """
+        steps = parse_steps(ProjectConfig.load(directory).provision)
+        if not steps:
+            return self.add_user_to_image(source_image, dest_image, mode, refresh)
+        # Only tag the image once it's provisioned, so that a failed step doesn't
+        # leave behind an image that looks complete
+        # BuildKit resolves FROM as a reference, so it needs the tag
+        _, base_tag = self.get_user_layer(source_image, mode, refresh)
+        spec = UserSpec(os.getuid(), os.getgid(), getpass.getuser())
+        home = os.environ.get("HOME", "/")
+        labels = {MANAGED_LABEL: "true", PROVISION_LABEL: steps_digest(steps)}
+        with phase("provision", image=dest_image):
+            if has_buildkit():
+                dockerfile = make_dockerfile(base_tag, steps, spec, home, True)
+                live = self.live_progress
+                if live is None:
+                    live = sys.stdout.isatty()
+                image_id = build_with_cli(
+                    dockerfile, dest_image, labels, quiet=not live
+                )
+            else:
+                # The legacy builder still caches each step's layer, but every
+                # step that reruns downloads its packages again
+                logger.info("BuildKit is not available, building without caches")
+                dockerfile = make_dockerfile(base_tag, steps, spec, home, False)
+                image_id = self.build_image(
+                    BytesIO(dockerfile.encode("utf-8")), dest_image, labels=labels
+                )
+        self.image_index.invalidate()
+        return image_id
+
+    def get_image_users(self, image_id: str) -> ImageUsers:
+        """Find the users and groups in an image without running it"""
+        users = self.image_users.get(image_id)
+        if users is None:
+            with ImageFiles(self.client, image_id) as files:
+                users = read_image_users(files)
+            self.image_users.set(image_id, users)
+        return users
+
+    def build_user_layer(self, source_image: str, spec: UserSpec, tag: str) -> str:
+        uid, gid, user = spec
+        image_users = self.get_image_users(source_image)
+        has_user = image_users["users"].get(user) == uid
 
         if has_user:
             text = BytesIO(f"FROM {source_image}".encode("utf-8"))
         else:
+            groupadd = ""
+            if gid not in image_users["gids"]:
+                groupadd = f"groupadd -g {gid} {user} && "
             text = BytesIO(
                 f"""FROM {source_image}
 RUN apt-get update -q && \
   apt-get install -y -q sudo && \
-  groupadd -g {gid} {user} && \
-  useradd -m -u {uid} -g {gid} -s /bin/bash {user} && \
+  {groupadd}useradd -m -u {uid} -g {gid} -s /bin/bash {user} && \
   echo "{user} ALL = (ALL) NOPASSWD: ALL" >> /etc/sudoers.d/user
 ENTRYPOINT ["/bin/bash", "-l"]
 """.encode(
                     "utf-8"
                 )
             )
-        self.client.images.build(fileobj=text, tag=dest_image)
+        return self.build_image(text, tag)
+
+    def build_user_layer_from_files(
+        self, source_image: str, spec: UserSpec, tag: str
+    ) -> str:
+        with ImageFiles(self.client, source_image) as files:
+            archive = make_user_archive(files, spec, self.config.static_sudo)
+        context = make_files_build_context(source_image, archive)
+        return self.build_image(context, tag, custom_context=True)
+
+    def build_image(
+        self,
+        fileobj: BinaryIO,
+        tag: str,
+        custom_context: bool = False,
+        labels: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Build an image, streaming the progress, and return its ID"""
+        events = self.client.api.build(
+            fileobj=fileobj,
+            tag=tag,
+            custom_context=custom_context,
+            labels=labels or {MANAGED_LABEL: "true"},
+            rm=True,
+            decode=True,
+        )
+        try:
+            return follow_build(events, tag, self.get_printer(tag), self.timings)
+        finally:
+            self.image_index.invalidate()
+
+    def tag_image(self, image: str, dest_image: str) -> None:
+        ref = parse_image_ref(dest_image)
+        self.client.api.tag(image, ref.repository, ref.tag or DEFAULT_TAG)
+        self.image_index.invalidate()
+
+    def get_login_shell(
+        self, image: str, image_info: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """The shell from the image's entrypoint, as set up by add_user_to_image"""
+        if image_info is None:
+            image_info = self.client.api.inspect_image(image)
+        entrypoint = image_info["Config"].get("Entrypoint")
+        if entrypoint and entrypoint[0].endswith("sh"):
+            return cast(str, entrypoint[0])
+        return DEFAULT_SHELL
 
     def create_container(
-        self, image: str, name: Optional[str], hostname: str, mount: bool = False
-    ) -> Container:
-        if name is not None:
+        self,
+        image: str,
+        name: Optional[str],
+        hostname: str,
+        mount: bool = False,
+        directory: Optional[str] = None,
+        replace: bool = True,
+        image_info: Optional[Dict[str, Any]] = None,
+    ) -> "Container":
+        """Create a long-running container that shells are exec'd into
+
+        If mount is True, the directory (default: the current directory) is
+        mounted into the container's home directory. If replace is True, an
+        existing container with the same name is deleted first.
+        """
+        with phase("create container", image=image):
+            return self._create_container(
+                image, name, hostname, mount, directory, replace, image_info
+            )
+
+    def _create_container(
+        self,
+        image: str,
+        name: Optional[str],
+        hostname: str,
+        mount: bool,
+        directory: Optional[str],
+        replace: bool,
+        image_info: Optional[Dict[str, Any]],
+    ) -> "Container":
+        from docker.errors import NotFound
+
+        if name is not None and replace:
             try:
-                container = cast(Container, self.client.containers.get(name))
+                container = cast("Container", self.client.containers.get(name))
             except NotFound:
                 pass
             else:
-                container.remove()
-        args = self.get_container_args(mount)
+                container.remove(force=True)
+        # The volumes and the image's shell are independent, so get them in one
+        # round of requests
+        calls: List[Callable[[], Any]] = [
+            partial(self.get_login_shell, image, image_info)
+        ]
+        if name is not None:
+            calls.extend(
+                partial(self.create_volume, v) for v in self.get_cache_volumes(name)
+            )
+        shell = self.concurrently(*calls)[0]
+        args = self.get_container_args(mount, name, directory)
+        resources = self.get_resources(directory)
+        # Nothing attaches to the main process, it just keeps the container alive
+        args["stdin_open"] = False
+        args["tty"] = False
         container = self.client.containers.create(
             image,
-            "-l",
+            KEEPALIVE_COMMAND,
             name=name,
             hostname=hostname,
-            entrypoint="/bin/bash",
+            entrypoint=[],
+            init=True,
+            labels={
+                MODE_LABEL: "exec",
+                SHELL_LABEL: shell,
+                RESOURCES_LABEL: json.dumps(resources, sort_keys=True),
+            },
             **args,
+            **make_resource_args(resources, os.environ.get("HOME", "/")),
         )
-        return cast(Container, container)
+        return cast("Container", container)
 
-    def get_container_args(self, mount: bool = False) -> ContainerArgs:
+    def get_resources(self, directory: Optional[str] = None) -> Dict[str, Any]:
+        """Resource settings for a project, from the config and .bluepill.json"""
+        project = ProjectConfig.load(directory)
+        return merge_resources(self.config.resources, project.resources)
+
+    def resources_changed(
+        self, container: "Container", directory: Optional[str] = None
+    ) -> bool:
+        """True if the resource settings changed since the container was created"""
+        created_with = container.labels.get(RESOURCES_LABEL)
+        if created_with is None:
+            return bool(self.get_resources(directory))
+        return created_with != json.dumps(self.get_resources(directory), sort_keys=True)
+
+    def lookup_container(
+        self, name: str, image: str
+    ) -> Tuple[Optional["Container"], Optional[Dict[str, Any]]]:
+        """Get a project's container and inspect its image
+
+        The image is only needed if there is no container, but getting both at
+        the same time saves a round trip when it is.
+        """
+        try:
+            found = self.call_daemon("lookup", container=name, image=image)
+        except DaemonUnavailable:
+            container, image_info = self.concurrently(
+                partial(self.get_container, name), partial(self.inspect_image, image)
+            )
+            return container, image_info
+        container = None
+        if found["container"] is not None:
+            # The daemon's copy is current, so there's no need to inspect it again
+            container = self.client.containers.prepare_model(found["container"])
+        return container, found["image"]
+
+    def provisioning_changed(
+        self, image_info: Dict[str, Any], directory: Optional[str] = None
+    ) -> bool:
+        """True if the project's provisioning steps differ from the image's"""
+        steps = parse_steps(ProjectConfig.load(directory).provision)
+        built_with = (image_info["Config"].get("Labels") or {}).get(PROVISION_LABEL)
+        return built_with != (steps_digest(steps) if steps else None)
+
+    def get_or_create_container(
+        self,
+        name: str,
+        image: str,
+        hostname: str,
+        source_image: str,
+        directory: Optional[str] = None,
+        used: bool = True,
+    ) -> "Container":
+        """Get the container for a project, building the image if necessary
+
+        If used is False, this doesn't count as using the environment, so its
+        last use time (for 'gc --days' and idle containers) stays the same
+        """
+        container, image_info = self.lookup_container(name, image)
+        if container is None:
+            built_from = None
+            if image_info is None:
+                self.build_project_image(source_image, image, directory=directory)
+                built_from = source_image
+            elif self.provisioning_changed(image_info, directory):
+                sys.stderr.write(
+                    "The provisioning steps have changed since the image was built. "
+                    "Run 'bluepill build -r' to apply them.\n"
+                )
+            container = self.create_container(
+                image,
+                name,
+                hostname,
+                True,
+                directory,
+                replace=False,
+                image_info=image_info,
+            )
+            if used or self.environments.get(name) is None:
+                self.environments.record(
+                    name, directory, built_from, container.attrs["Image"], container.id
+                )
+            else:
+                fields = {"image_id": container.attrs["Image"]}
+                if built_from is not None:
+                    fields["source_image"] = built_from
+                self.environments.update(name, container_id=container.id, **fields)
+        elif used:
+            self.environments.touch(name, directory, container.id)
+        return container
+
+    def ensure_running(self, container: "Container") -> None:
+        if container.status != "running":
+            # The volumes only need new owners the first time it starts
+            started = parse_docker_time(container.attrs["State"].get("StartedAt"))
+            with phase("start container"):
+                container.start()
+                if started is None:
+                    self.chown_volumes(container)
+
+    def chown_volumes(self, container: "Container") -> None:
+        """Give the user ownership of the volumes mounted in their home directory
+
+        Docker creates mount points, and the volumes for paths that don't exist
+        in the image, as owned by root.
+        """
+        home = os.environ.get("HOME", "/")
+        paths = set()
+        for mount in container.attrs.get("Mounts") or []:
+            if mount.get("Type") != "volume":
+                continue
+            path = mount["Destination"]
+            while (path == home or path.startswith(home + "/")) and home != "/":
+                paths.add(path)
+                path = os.path.dirname(path)
+        if not paths:
+            return
+        exec_id = self.client.api.exec_create(
+            container.id,
+            ["chown", f"{os.getuid()}:{os.getgid()}", *sorted(paths)],
+            user="root",
+        )
+        self.client.api.exec_start(exec_id)
+
+    def create_exec(
+        self, container: "Container", cmd: Sequence[str], **kwargs: Any
+    ) -> Dict[str, Any]:
+        """Create an exec in a running container
+
+        The daemon's copy of the container may still say that it's running
+        after it has stopped (e.g. for being idle). If docker says that it
+        isn't running, this forgets that copy, starts it, and tries again once.
+        """
+        from docker.errors import APIError
+
+        try:
+            return cast(
+                Dict[str, Any], self.client.api.exec_create(container.id, cmd, **kwargs)
+            )
+        except APIError as e:
+            if e.status_code != 409:
+                raise
+            logger.debug("Container %s has stopped: %s", container.name, e)
+        try:
+            self.call_daemon("forget", container=container.name)
+        except DaemonUnavailable:
+            pass
+        container.reload()
+        self.ensure_running(container)
+        return cast(
+            Dict[str, Any], self.client.api.exec_create(container.id, cmd, **kwargs)
+        )
+
+    def exec_shell(self, container: "Container") -> None:
+        """Start an interactive login shell in a running container"""
+        import dockerpty
+
+        shell = container.labels.get(SHELL_LABEL, DEFAULT_SHELL)
+        exec_id = self.create_exec(container, [shell, "-l"], tty=True, stdin=True)
+        with phase("attach"):
+            dockerpty.start_exec(self.client.api, exec_id)
+
+    def exec_command(
+        self,
+        container: "Container",
+        cmd: Sequence[str],
+        handle_output: Callable[[Optional[bytes], Optional[bytes]], None],
+        login: bool = False,
+    ) -> int:
+        """Run a command in a running container without a tty
+
+        Output is passed to handle_output as (stdout, stderr) chunks as it
+        arrives. Returns the command's exit code.
+        """
+        if login:
+            shell = container.labels.get(SHELL_LABEL, DEFAULT_SHELL)
+            cmd = [shell, "-l", "-c", " ".join(shlex.quote(arg) for arg in cmd)]
+        exec_id = self.create_exec(container, cmd, tty=False)
+        with phase("exec", cmd=cmd):
+            output = self.client.api.exec_start(exec_id, stream=True, demux=True)
+            for stdout, stderr in output:
+                handle_output(stdout, stderr)
+        exit_code = self.client.api.exec_inspect(exec_id)["ExitCode"]
+        return 1 if exit_code is None else cast(int, exit_code)
+
+    def get_container_args(
+        self,
+        mount: bool = False,
+        name: Optional[str] = None,
+        directory: Optional[str] = None,
+    ) -> ContainerArgs:
         user = getpass.getuser()
         environment = {"USER": user}
         volumes: Dict[str, Volume] = {}
@@ -200,12 +975,18 @@ ENTRYPOINT ["/bin/bash", "-l"]
             }
         working_dir = home
         if mount:
-            here = os.path.abspath(os.curdir)
+            here = os.path.abspath(directory or os.curdir)
             working_dir = os.path.join(home, os.path.basename(here))
             volumes[here] = {
                 "bind": working_dir,
                 "mode": "rw",
             }
+        if name is not None:
+            for volume in self.get_cache_volumes(name):
+                volumes[volume.name] = {
+                    "bind": volume.path,
+                    "mode": "rw",
+                }
         return {
             "environment": environment,
             "stdin_open": True,
@@ -1,28 +1,81 @@
+import json
+import sys
+import time
 from argparse import ArgumentParser
-from typing import Any, Optional
-
-from docker import DockerClient
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Sequence
 
 from ..config import Config
+from ..userlayer import USER_LAYER_MODES
 from ..util import confirm
 from .base import Command
 
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+class BuildTarget(NamedTuple):
+    name: str
+    image: str
+
+
+class BuildResult(NamedTuple):
+    target: BuildTarget
+    status: str
+    duration: float
+    error: Optional[str] = None
+
+
+def parse_manifest(file: str, default_image: str) -> List[BuildTarget]:
+    """Load build targets from a json manifest
+
+    The manifest can either be a mapping of image name to source image, or a list
+    of objects with 'name' and (optionally) 'image' keys.
+    """
+    with open(file, "r") as ifile:
+        data = json.load(ifile)
+    if isinstance(data, dict):
+        return [
+            BuildTarget(name, image or default_image) for name, image in data.items()
+        ]
+    return [
+        BuildTarget(entry["name"], entry.get("image") or default_image)
+        for entry in data
+    ]
+
 
 class BuildCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         name: Optional[str] = None,
         image: str = "",
         replace: bool = False,
+        user_layer: Optional[str] = None,
+        target: Sequence[str] = (),
+        manifest: Optional[str] = None,
+        jobs: int = 4,
+        pull: bool = False,
         **kwargs: Any,
     ):
         super().__init__(client, config, **kwargs)
+        self._has_name = name is not None
         self._image_name = self.get_unique_dir_name(name)
         self._hostname = self.get_hostname(name)
         self._source_image = image
         self._replace = replace
+        self._user_layer = user_layer
+        self._jobs = max(1, jobs)
+        self._pull = pull
+        targets: List[BuildTarget] = []
+        for spec in target:
+            target_name, _, target_image = spec.partition("=")
+            targets.append(BuildTarget(target_name, target_image or image))
+        if manifest is not None:
+            targets.extend(parse_manifest(manifest, image))
+        # A target that is listed twice is only built once
+        self._targets = list(dict.fromkeys(targets))
 
     @classmethod
     def name(cls) -> str:
@@ -51,10 +104,131 @@ class BuildCmd(Command):
             action="store_true",
             help="If named image already exists, replace it",
         )
+        parser.add_argument(
+            "-u",
+            "--user-layer",
+            choices=USER_LAYER_MODES,
+            default=config.user_layer,
+            help="How to add the user to the image. 'apt' installs sudo with apt, "
+            "'files' writes the user directly and works on any image "
+            "(default %(default)s)",
+        )
+        parser.add_argument(
+            "-p",
+            "--pull",
+            action="store_true",
+            help="Pull the source image if the registry has a newer version. "
+            "Images pinned by digest (image@sha256:...) are never re-pulled.",
+        )
+        parser.add_argument(
+            "-t",
+            "--target",
+            action="append",
+            default=[],
+            metavar="NAME[=IMAGE]",
+            help="Build multiple images concurrently. May be specified multiple times.",
+        )
+        parser.add_argument(
+            "-m",
+            "--manifest",
+            help="Json file with images to build concurrently, "
+            'e.g. {"name": "source_image"}',
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=4,
+            help="Maximum number of concurrent pulls/builds (default %(default)s)",
+        )
 
     def run(self) -> None:
-        if self.has_image(self._image_name) and not confirm(
-            f"Image '{self._image_name}' already exists:", False
+        if self._targets:
+            if self._has_name:
+                sys.stderr.write("Pass either a name or targets (-t/-m), not both\n")
+                sys.exit(2)
+            images: Dict[str, str] = {}
+            for target in self._targets:
+                if images.setdefault(target.name, target.image) != target.image:
+                    sys.stderr.write(
+                        f"Target '{target.name}' is listed with different images: "
+                        f"{images[target.name]} and {target.image}\n"
+                    )
+                    sys.exit(2)
+            self.build_all(self._targets)
+            return
+        if (
+            self.has_image(self._image_name)
+            and not self._replace
+            and not confirm(f"Image '{self._image_name}' already exists:", False)
         ):
             return
-        self.add_user_to_image(self._source_image, self._image_name)
+        image_id = self.build_project_image(
+            self._source_image, self._image_name, self._user_layer, self._pull
+        )
+        self.environments.record(
+            self._image_name, source_image=self._source_image, image_id=image_id
+        )
+
+    def build_all(self, targets: Sequence[BuildTarget]) -> None:
+        # Live progress lines from concurrent builds would clobber each other
+        self.live_progress = False
+        results: Dict[BuildTarget, BuildResult] = {}
+        todo: List[BuildTarget] = []
+        for target in targets:
+            if not self._replace and self.has_image(target.name):
+                results[target] = BuildResult(target, "exists", 0)
+            else:
+                todo.append(target)
+
+        # Pull each source image once, no matter how many targets use it
+        sources = sorted({target.image for target in todo})
+        pull_errors: Dict[str, str] = {}
+        pull_times: Dict[str, float] = {}
+
+        def pull(source: str) -> None:
+            start = time.perf_counter()
+            try:
+                self.pull_image(source, self._pull)
+            except Exception as e:
+                pull_errors[source] = str(e)
+            pull_times[source] = time.perf_counter() - start
+
+        def build(target: BuildTarget) -> None:
+            source = target.image
+            start = time.perf_counter()
+            if source in pull_errors:
+                results[target] = BuildResult(
+                    target, "failed", pull_times[source], pull_errors[source]
+                )
+                return
+            status, error = "built", None
+            try:
+                # Targets that share a source image also share its user layer,
+                # which is only built once (see get_user_layer)
+                self.add_user_to_image(source, target.name, self._user_layer)
+            except Exception as e:
+                status, error = "failed", str(e)
+            duration = time.perf_counter() - start + pull_times[source]
+            results[target] = BuildResult(target, status, duration, error)
+            print(f"{target.name}: {status} ({duration:.1f}s)")
+
+        with ThreadPoolExecutor(self._jobs) as executor:
+            list(executor.map(pull, sources))
+            list(executor.map(build, todo))
+
+        self.print_summary([results[target] for target in targets])
+        if any(result.status == "failed" for result in results.values()):
+            sys.exit(1)
+
+    def print_summary(self, results: Sequence[BuildResult]) -> None:
+        width = max(len(result.target.name) for result in results)
+        print()
+        for result in results:
+            line = (
+                f"{result.target.name:<{width}}  {result.status:<7} "
+                f"{result.duration:7.1f}s  {result.target.image}"
+            )
+            if result.error is not None:
+                line += f"  ({result.error})"
+            print(line)
@@ -1,24 +1,42 @@
+import os
 import sys
+import tarfile
+import tempfile
 from argparse import ArgumentParser
-from typing import Any, Optional
-
-from docker import DockerClient
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence
 
 from ..config import Config
+from ..images import DEFAULT_TAG
+from ..profile import phase
+from ..progress import StreamError
+from ..util import format_bytes
 from .base import Command
 
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from docker.models.containers import Container
+
+# Label on committed images with the ID of the image that the commits are stacked on
+BASE_LABEL = "bluepill.base"
+# 'Kind' of a file in the output of the container changes endpoint
+CHANGE_ADDED = 1
+
 
 class CommitCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         name: Optional[str] = None,
+        squash: Optional[bool] = None,
+        exclude: bool = False,
         **kwargs: Any,
     ):
         super().__init__(client, config, **kwargs)
         self._container_name = self.get_unique_dir_name(name)
         self._image_name = self.get_unique_dir_name(name)
+        self._squash = squash
+        self._exclude = exclude
 
     @classmethod
     def name(cls) -> str:
@@ -35,11 +53,162 @@ class CommitCmd(Command):
             nargs="?",
             help="Name of the container/image (if omitted, will use a unique name generated from the current directory)",
         )
+        parser.add_argument(
+            "--squash",
+            action="store_true",
+            default=None,
+            help="Squash all commits into a single layer on top of the original "
+            "image (by default this happens once there are more than "
+            f"{config.squash_depth} layers or {config.squash_size_mb}MB of them)",
+        )
+        parser.add_argument(
+            "--no-squash",
+            action="store_false",
+            dest="squash",
+            help="Never squash the commits",
+        )
+        parser.add_argument(
+            "-x",
+            "--exclude",
+            action="store_true",
+            help="Leave the changes in the commit_exclude paths "
+            f"({', '.join(config.commit_exclude)}) out of the new layer. This "
+            "saves and reloads the image, so it takes longer.",
+        )
 
     def run(self) -> None:
         container = self.get_container(self._container_name)
         if container is None:
             sys.stderr.write(f"Container {self._container_name} not found\n")
             return
-        container.commit(*self._image_name.split(":"))
-        print(f"Committed changes to {self._image_name}")
+        base_id = self.get_base_image(container)
+        excluded = self.find_excluded(container) if self._exclude else 0
+        image = container.commit(
+            *self._image_name.split(":"), changes=[f"LABEL {BASE_LABEL}={base_id}"]
+        )
+        attrs = image.attrs
+        if excluded:
+            # Rewrite the new layer without the excluded paths, so that nothing
+            # is deleted from the container, which may still be in use
+            layers = len(attrs["RootFS"]["Layers"])
+            image_id = self.rewrite_layers(
+                attrs,
+                layers - 1,
+                self.get_excluded_paths(),
+                "bluepill commit without the commit_exclude paths",
+            )
+            attrs = self.client.api.inspect_image(image_id)
+            print(f"Left out {excluded} new files and directories in excluded paths")
+        history = self.client.api.history(attrs["Id"])
+        layer_size = history[0]["Size"] if history else 0
+        print(
+            f"Committed changes to {self._image_name} "
+            f"(new layer: {format_bytes(layer_size)})"
+        )
+        image_id = attrs["Id"]
+        if self.should_squash(attrs, base_id):
+            image_id = self.squash(attrs, base_id)
+        self.environments.update(self._container_name, image_id=image_id)
+
+    def get_base_image(self, container: "Container") -> str:
+        """Get the ID of the image that the container's commits are stacked on"""
+        image_id: str = container.attrs["Image"]
+        info = self.inspect_image(image_id)
+        if info is None:
+            sys.stderr.write(
+                f"The image that container {container.name} was created from "
+                f"({image_id}) no longer exists\n"
+            )
+            sys.exit(1)
+        labels = info["Config"].get("Labels") or {}
+        return labels.get(BASE_LABEL) or image_id
+
+    def get_excluded_paths(self) -> List[str]:
+        home = os.environ.get("HOME", "/")
+        paths = []
+        for path in self.config.commit_exclude:
+            if path == "~" or path.startswith("~/"):
+                path = os.path.join(home, path[2:])
+            paths.append(path.rstrip("/") or "/")
+        return paths
+
+    def find_excluded(self, container: "Container") -> int:
+        """Count the files that were added under the excluded paths"""
+        excluded = self.get_excluded_paths()
+        added = set()
+        for change in container.diff() or []:
+            path = change["Path"]
+            if change["Kind"] == CHANGE_ADDED and any(
+                path.startswith(prefix + "/") for prefix in excluded
+            ):
+                added.add(path)
+        # Only count the top directory of a new tree
+        return sum(1 for path in added if os.path.dirname(path) not in added)
+
+    def should_squash(self, image: Dict[str, Any], base_id: str) -> bool:
+        if self._squash is not None:
+            return self._squash
+        base = self.client.api.inspect_image(base_id)
+        depth = len(image["RootFS"]["Layers"]) - len(base["RootFS"]["Layers"])
+        size = image["Size"] - base["Size"]
+        return (
+            depth > self.config.squash_depth
+            or size > self.config.squash_size_mb * 1024 * 1024
+        )
+
+    def squash(self, image: Dict[str, Any], base_id: str) -> str:
+        """Replace the layers on top of the base image with a single layer"""
+        base_layers = len(self.client.api.inspect_image(base_id)["RootFS"]["Layers"])
+        if len(image["RootFS"]["Layers"]) - base_layers < 2:
+            return str(image["Id"])
+        image_id = self.rewrite_layers(
+            image,
+            base_layers,
+            comment=f"Squashed {len(image['RootFS']['Layers']) - base_layers} layers",
+        )
+        squashed = self.client.api.inspect_image(image_id)
+        print(
+            f"Squashed {len(image['RootFS']['Layers']) - base_layers} layers into one "
+            f"({format_bytes(image['Size'])} -> {format_bytes(squashed['Size'])})"
+        )
+        return image_id
+
+    def rewrite_layers(
+        self,
+        image: Dict[str, Any],
+        base_layers: int,
+        exclude: Sequence[str] = (),
+        comment: Optional[str] = None,
+    ) -> str:
+        """Merge the layers above the first base_layers into one and load it
+
+        Changes inside the directories in exclude are left out. The new image
+        is tagged as the committed image, and its ID is returned. If there's
+        only one layer and nothing was left out, the image is returned as is.
+        """
+        from ..squash import squash_image
+
+        tag = self._image_name
+        if ":" not in tag:
+            tag += f":{DEFAULT_TAG}"
+        with tempfile.TemporaryDirectory(prefix="bluepill-") as workdir:
+            saved_file = os.path.join(workdir, "saved.tar")
+            with phase("save image"), open(saved_file, "wb") as ofile:
+                for chunk in self.client.api.get_image(image["Id"]):
+                    ofile.write(chunk)
+            load_file = os.path.join(workdir, "load.tar")
+            with phase("rewrite layers"), tarfile.open(saved_file) as saved, open(
+                load_file, "wb"
+            ) as ofile:
+                image_id, skipped = squash_image(
+                    saved, base_layers, tag, ofile, workdir, comment, exclude
+                )
+            if not skipped and len(image["RootFS"]["Layers"]) - base_layers < 2:
+                return str(image["Id"])
+            with phase("load image"), open(load_file, "rb") as ifile:
+                log: List[Dict[str, Any]] = []
+                for event in self.client.api.load_image(ifile):
+                    log.append(event)
+                    if "error" in event:
+                        raise StreamError(event["error"], log)
+        return image_id
@@ -1,11 +1,14 @@
+import json
 from argparse import ArgumentParser
-from typing import Any
-
-from docker import DockerClient
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence
 
 from ..config import Config
+from ..userlayer import USER_LAYER_MODES
 from .base import Command, add_parser_commands
 
+if TYPE_CHECKING:
+    from docker import DockerClient
+
 
 class ConfigCmd(Command):
     @classmethod
@@ -26,7 +29,7 @@ class ConfigCmd(Command):
         )
 
     def run(self) -> None:
-        cmd = ConfigListCmd(self.client, self.config, **self._kwargs)
+        cmd = ConfigListCmd(self._client, self.config, **self._kwargs)
         cmd.run()
 
 
@@ -51,7 +54,7 @@ class ConfigListCmd(Command):
 class ConfigGetCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         key: str,
         **kwargs: Any,
@@ -78,10 +81,42 @@ class ConfigGetCmd(Command):
         print(str(self.config.asdict()[self._key]))
 
 
+# Config keys that only have a few valid values
+CHOICES: Dict[str, Sequence[str]] = {"user_layer": USER_LAYER_MODES}
+
+
+def parse_value(key: str, value: str) -> Any:
+    """Parse a value for a config key, with the type of its default"""
+    default = Config().asdict()[key]
+    if default is None:
+        # Optional strings
+        return None if value == "null" else value
+    if isinstance(default, str):
+        if key in CHOICES and value not in CHOICES[key]:
+            raise ValueError(f"'{key}' must be one of {', '.join(CHOICES[key])}")
+        return value
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        parsed = value
+    if isinstance(default, bool) or isinstance(parsed, bool):
+        valid = isinstance(default, bool) and isinstance(parsed, bool)
+    elif isinstance(default, (int, float)):
+        valid = isinstance(parsed, (int, float))
+    else:
+        valid = isinstance(parsed, type(default))
+    if not valid:
+        raise ValueError(
+            f"'{key}' must be a json {type(default).__name__}, "
+            f"e.g. {json.dumps(default)}"
+        )
+    return parsed
+
+
 class ConfigSetCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         key: str,
         value: str,
@@ -105,8 +140,15 @@ class ConfigSetCmd(Command):
             "key",
             help="Config key to set",
         )
-        parser.add_argument("value", help="New config value")
+        parser.add_argument(
+            "value",
+            help="New config value. Settings that aren't strings are parsed as "
+            "json (e.g. true, 30, or '[\"~/.cache\"]'). Use null to unset "
+            "optional settings.",
+        )
 
     def run(self) -> None:
-        setattr(self.config, self._key, self._value)
+        if self._key not in self.config.asdict():
+            raise ValueError(f"Unknown config key '{self._key}'")
+        setattr(self.config, self._key, parse_value(self._key, self._value))
         self.config.save()
@@ -0,0 +1,344 @@
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+from ..config import Config
+from ..daemon import (
+    PROTOCOL_VERSION,
+    DaemonClient,
+    DaemonUnavailable,
+    encode_message,
+    get_socket_path,
+)
+from ..environments import Inventory
+from ..images import IMAGE_MUTATING_EVENTS
+from .base import Command
+from .cmd_delete import DeleteCmd
+from .cmd_stats import StatsCmd
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+logger = logging.getLogger(__name__)
+
+# Container events that don't change what 'docker inspect' returns. Exec events
+# are by far the most common ones.
+READ_ONLY_EVENTS = {"attach", "detach", "resize", "top", "export", "archive-path"}
+# The environment registry is refreshed this long after the last change, so
+# that a burst of events only costs one (slow) disk usage request
+REFRESH_DELAY = 30
+# How often containers are checked for activity. Anything that uses less CPU
+# than activity.IDLE_CPU in between counts as idle.
+IDLE_CHECK_INTERVAL = 60
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, daemon: "DaemonCmd"):
+        self.daemon = daemon
+        super().__init__(path, _RequestHandler)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: _Server
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return
+        response: Dict[str, Any]
+        try:
+            request = json.loads(line)
+            if request.get("version") != PROTOCOL_VERSION:
+                response = {
+                    "error": f"The daemon speaks protocol version {PROTOCOL_VERSION}",
+                    "unavailable": True,
+                }
+            else:
+                result = self.server.daemon.handle(
+                    request["method"], request.get("params") or {}
+                )
+                response = {"result": result}
+        except Exception as e:
+            logger.exception("Error handling request")
+            response = {"error": str(e)}
+        self.wfile.write(encode_message(response))
+
+
+class DaemonCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        background: bool = False,
+        stop: bool = False,
+        status: bool = False,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._background = background
+        self._stop = stop
+        self._status = status
+        # The daemon must never send requests to itself
+        self.use_daemon = False
+        self._started = time.time()
+        self._lock = threading.Lock()
+        # Containers and images by name, as returned by inspect (None if they
+        # don't exist). They are dropped when an event says they may have
+        # changed, and only cached while the event stream is connected.
+        self._containers: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._images: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._states: Optional[Dict[str, str]] = None
+        self._generation = 0
+        self._synced = False
+        self._refresh_at: Optional[float] = None
+        self._refresh_lock = threading.Lock()
+        self._server: Optional[_Server] = None
+
+    @classmethod
+    def name(cls) -> str:
+        return "daemon"
+
+    @classmethod
+    def description(cls) -> str:
+        return (
+            "Run a background process that keeps a docker connection open and "
+            "tracks containers and images, so that commands like enter, ls, and "
+            "rm don't have to start from scratch. Commands work the same without it."
+        )
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "-b",
+            "--background",
+            action="store_true",
+            help="Run in the background. Its output goes to daemon.log in the "
+            "bluepill cache dir.",
+        )
+        parser.add_argument(
+            "--stop", action="store_true", help="Stop the running daemon"
+        )
+        parser.add_argument(
+            "--status", action="store_true", help="Check if the daemon is running"
+        )
+
+    def run(self) -> None:
+        client = DaemonClient(get_socket_path())
+        try:
+            info = client.call("ping")
+        except DaemonUnavailable:
+            info = None
+        if self._stop or self._status:
+            if info is None:
+                print("The daemon is not running")
+                if self._status:
+                    sys.exit(1)
+            elif self._stop:
+                client.call("shutdown")
+                print(f"Stopped the daemon (pid {info['pid']})")
+            else:
+                uptime = time.time() - info["started"]
+                print(f"The daemon is running (pid {info['pid']}, up {uptime:.0f}s)")
+            return
+        if info is not None:
+            print(f"The daemon is already running (pid {info['pid']})")
+            return
+        if self._background and not self.detach("daemon.log"):
+            print("Started the daemon")
+            return
+        self.serve()
+
+    def serve(self) -> None:
+        path = get_socket_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.unlink(path)
+        old_umask = os.umask(0o077)
+        try:
+            self._server = _Server(path, self)
+        finally:
+            os.umask(old_umask)
+        # Connect before accepting requests, so the first one isn't slow
+        self.client.ping()
+        for target in (self.follow_events, self.refresh_when_due, self.stop_idle):
+            threading.Thread(target=target, daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda *_: self.shutdown())
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} Listening on {path}")
+        sys.stdout.flush()
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+            if os.path.exists(path):
+                os.unlink(path)
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} Stopped")
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            # shutdown() waits for serve_forever() to return, so it can't be
+            # called from the thread that runs it
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def handle(self, method: str, params: Dict[str, Any]) -> Any:
+        handler: Optional[Callable[..., Any]] = getattr(self, f"handle_{method}", None)
+        if handler is None:
+            raise ValueError(f"Unknown method '{method}'")
+        return handler(**params)
+
+    def handle_ping(self) -> Dict[str, Any]:
+        return {"pid": os.getpid(), "started": self._started}
+
+    def handle_shutdown(self) -> None:
+        self.shutdown()
+
+    def handle_lookup(self, container: str, image: str) -> Dict[str, Any]:
+        return {
+            "container": self.cached(self._containers, container, self.fetch_container),
+            "image": self.cached(self._images, image, self.inspect_image),
+        }
+
+    def handle_containers(self) -> Dict[str, str]:
+        """The state of every container, by name"""
+        with self._lock:
+            if self._states is not None:
+                return self._states
+            generation = self._generation
+        states = {}
+        for container in self.client.api.containers(all=True):
+            for name in container.get("Names") or []:
+                states[name.lstrip("/")] = container["State"]
+        with self._lock:
+            if self._synced and generation == self._generation:
+                self._states = states
+        return states
+
+    def handle_rm(self, name: str, image: bool, volumes: bool, force: bool) -> Any:
+        cmd = DeleteCmd(
+            self.client, self.config, name=name, i=image, volumes=volumes, force=force
+        )
+        cmd.use_daemon = False
+        return list(cmd.delete())
+
+    def handle_forget(self, container: str) -> None:
+        """Drop a container that a client found to be out of date"""
+        with self._lock:
+            self._containers.pop(container, None)
+            self._states = None
+
+    def handle_refresh(self) -> None:
+        with self._refresh_lock:
+            self._refresh_at = None
+            self.environments.refresh(Inventory.from_df(self.client.df()))
+
+    def fetch_container(self, name: str) -> Optional[Dict[str, Any]]:
+        from docker.errors import NotFound
+
+        try:
+            attrs: Dict[str, Any] = self.client.api.inspect_container(name)
+        except NotFound:
+            return None
+        return attrs
+
+    def cached(
+        self,
+        cache: Dict[str, Optional[Dict[str, Any]]],
+        key: str,
+        fetch: Callable[[str], Optional[Dict[str, Any]]],
+    ) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key in cache:
+                return cache[key]
+            generation = self._generation
+        value = fetch(key)
+        with self._lock:
+            # Don't cache it if an event came in while fetching it, because the
+            # value may be from before the change
+            if self._synced and generation == self._generation:
+                cache[key] = value
+        return value
+
+    def invalidate(self, containers: bool = True, images: bool = True) -> None:
+        with self._lock:
+            self._generation += 1
+            if containers:
+                self._containers.clear()
+                self._states = None
+            if images:
+                self._images.clear()
+            if self._refresh_at is None:
+                self._refresh_at = time.time() + REFRESH_DELAY
+
+    def follow_events(self) -> None:
+        """Drop cached state whenever docker says that it may have changed"""
+        since: Optional[float] = None
+        while True:
+            try:
+                events = self.client.api.events(
+                    since=None if since is None else int(since),
+                    filters={"type": ["container", "image"]},
+                    decode=True,
+                )
+                # Anything that happened while disconnected was missed
+                self.invalidate()
+                with self._lock:
+                    self._synced = True
+                for event in events:
+                    since = event.get("time", since)
+                    action = event.get("Action", event.get("status", ""))
+                    if event.get("Type") == "container" and not (
+                        action.startswith("exec_") or action in READ_ONLY_EVENTS
+                    ):
+                        self.invalidate(images=False)
+                    elif (
+                        event.get("Type") == "image" and action in IMAGE_MUTATING_EVENTS
+                    ):
+                        self.invalidate(containers=False)
+            except Exception as e:
+                # The stream also times out when there haven't been any events
+                logger.info("Reconnecting to the docker event stream: %s", e)
+            # Stop caching until the stream is back, and resume it from the last
+            # event seen so that nothing is missed
+            with self._lock:
+                self._synced = False
+            since = since or time.time()
+            time.sleep(1)
+
+    def refresh_when_due(self) -> None:
+        """Keep the environment registry (and so 'bluepill ls') up to date"""
+        self._refresh_at = time.time()
+        while True:
+            time.sleep(1)
+            due = self._refresh_at
+            if due is None or time.time() < due:
+                continue
+            try:
+                self.handle_refresh()
+            except Exception:
+                logger.warning("Error refreshing environments", exc_info=True)
+                self._refresh_at = time.time() + REFRESH_DELAY
+
+    def stop_idle(self) -> None:
+        """Stop containers that have been idle for idle_timeout_minutes"""
+        cmd = StatsCmd(self.client, self.config)
+        cmd.use_daemon = False
+        while True:
+            time.sleep(IDLE_CHECK_INTERVAL)
+            if self.config.idle_timeout_minutes <= 0:
+                continue
+            try:
+                cmd.stop_idle(cmd.collect(), self.config.idle_timeout_minutes)
+            except Exception:
+                logger.warning("Error stopping idle containers", exc_info=True)
+            sys.stdout.flush()
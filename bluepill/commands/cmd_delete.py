@@ -1,26 +1,30 @@
 from argparse import ArgumentParser
-from typing import Any, Optional
-
-from docker import DockerClient
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Optional
 
 from ..config import Config
-from .base import Command
+from ..daemon import DaemonUnavailable
+from .base import MODE_LABEL, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
 
 
 class DeleteCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         name: Optional[str] = None,
         i: bool = False,
         force: bool = False,
+        volumes: bool = False,
         **kwargs: Any,
     ):
         super().__init__(client, config, **kwargs)
         self._container_name = self.get_unique_dir_name(name)
         self._image_name = self.get_unique_dir_name(name)
         self._del_image = i
+        self._del_volumes = volumes
         self._force = force
 
     @classmethod
@@ -39,14 +43,50 @@ class DeleteCmd(Command):
             help="Name of the container/image (if omitted, will use a unique name generated from the current directory)",
         )
         parser.add_argument("-i", action="store_true", help="Delete the image as well")
+        parser.add_argument(
+            "-v",
+            "--volumes",
+            action="store_true",
+            help="Delete the home and cache volumes as well (shared volumes are kept)",
+        )
         parser.add_argument("-f", "--force", action="store_true", help="Force delete")
 
     def run(self) -> None:
+        try:
+            messages: Iterable[str] = self.call_daemon(
+                "rm",
+                timeout=None,
+                name=self._container_name,
+                image=self._del_image,
+                volumes=self._del_volumes,
+                force=self._force,
+            )
+        except DaemonUnavailable:
+            messages = self.delete()
+        for message in messages:
+            print(message)
+
+    def delete(self) -> Iterator[str]:
+        """Delete the container (and image and volumes), yielding what was deleted"""
+        from docker.errors import ImageNotFound
+
         container = self.get_container(self._container_name)
         if container is not None:
+            if container.status == "running" and container.labels.get(MODE_LABEL):
+                # The main process only keeps the container alive for 'enter'
+                container.stop(timeout=1)
             container.remove(force=self._force)
-            print(f"Deleted container {container.name}")
+            yield f"Deleted container {container.name}"
+            self.environments.update(self._container_name, container_id=None)
         if self._del_image:
-            if self.has_image(self._image_name):
+            try:
                 self.client.images.remove(self._image_name, force=self._force)
-                print(f"Deleted image {self._image_name}")
+            except ImageNotFound:
+                pass
+            else:
+                yield f"Deleted image {self._image_name}"
+            self.environments.delete(self._container_name)
+        if self._del_volumes:
+            for volume in self.get_project_volumes(self._container_name):
+                self.client.api.remove_volume(volume, force=self._force)
+                yield f"Deleted volume {volume}"
@@ -1,17 +1,23 @@
+import sys
 from argparse import ArgumentParser
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Optional
 
 import dockerpty
-from docker import DockerClient
 
 from ..config import Config
-from .base import Command
+from ..profile import phase
+from ..resources import describe_limits
+from .base import MODE_LABEL, RESOURCES_LABEL, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from docker.models.containers import Container
 
 
 class EnterCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         name: Optional[str] = None,
         image: str = "",
@@ -46,11 +52,27 @@ class EnterCmd(Command):
         )
 
     def run(self) -> None:
-        container = self.get_container(self._container_name)
-        if container is None:
-            if not self.has_image(self._image_name):
-                self.add_user_to_image(self._source_image, self._image_name)
-            container = self.create_container(
-                self._image_name, self._container_name, self._hostname, True
+        container = self.get_or_create_container(
+            self._container_name, self._image_name, self._hostname, self._source_image
+        )
+        if container.labels.get(MODE_LABEL) != "exec":
+            # Container was created by an older version of bluepill
+            with phase("attach"):
+                dockerpty.start(self.client.api, container.name)
+            return
+        self.ensure_running(container)
+        self.show_limits(container)
+        self.exec_shell(container)
+
+    def show_limits(self, container: "Container") -> None:
+        # Docker sets some limits (like the size of /dev/shm) on every
+        # container, so only show them if any were configured
+        if container.labels.get(RESOURCES_LABEL, "{}") != "{}":
+            limits = describe_limits(container.attrs.get("HostConfig") or {})
+            if limits:
+                sys.stderr.write(f"Limits: {', '.join(limits)}\n")
+        if self.resources_changed(container):
+            sys.stderr.write(
+                "The resource settings have changed since this container was "
+                "created. Run 'bluepill rm' to recreate it with the new ones.\n"
             )
-        dockerpty.start(self.client.api, container.name)
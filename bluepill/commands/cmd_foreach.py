@@ -0,0 +1,221 @@
+import glob
+import os
+import sys
+import threading
+import time
+from argparse import REMAINDER, ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from ..config import Config
+from .base import Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+class ForeachResult(NamedTuple):
+    directory: str
+    status: str
+    duration: float
+    exit_code: Optional[int] = None
+    error: Optional[str] = None
+
+
+def expand_dirs(patterns: Sequence[str]) -> List[str]:
+    """Expand globs into a sorted, de-duplicated list of directories"""
+    dirs: Dict[str, None] = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern))) or [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                dirs[os.path.realpath(match)] = None
+            else:
+                sys.stderr.write(f"Skipping '{match}': not a directory\n")
+    return list(dirs)
+
+
+class OutputWriter:
+    """Writes the output of one environment, either line by line with a prefix
+    or all at once when the command is done"""
+
+    def __init__(self, label: str, lock: threading.Lock, capture: bool):
+        self.label = label
+        self.lock = lock
+        self.capture = capture
+        self._pending = {1: b"", 2: b""}
+        self._captured: List[Tuple[int, bytes]] = []
+
+    def _stream(self, fd: int) -> BinaryIO:
+        return sys.stdout.buffer if fd == 1 else sys.stderr.buffer
+
+    def __call__(self, stdout: Optional[bytes], stderr: Optional[bytes]) -> None:
+        for fd, data in ((1, stdout), (2, stderr)):
+            if not data:
+                continue
+            if self.capture:
+                self._captured.append((fd, data))
+                continue
+            data = self._pending[fd] + data
+            lines = data.split(b"\n")
+            self._pending[fd] = lines.pop()
+            if lines:
+                self._write_lines(fd, lines)
+
+    def _write_lines(self, fd: int, lines: Sequence[bytes]) -> None:
+        prefix = f"[{self.label}] ".encode("utf-8")
+        stream = self._stream(fd)
+        with self.lock:
+            stream.write(b"".join(prefix + line + b"\n" for line in lines))
+            stream.flush()
+
+    def close(self) -> None:
+        if not self.capture:
+            for fd, data in self._pending.items():
+                if data:
+                    self._write_lines(fd, [data])
+            return
+        with self.lock:
+            sys.stdout.buffer.write(f"==> {self.label} <==\n".encode("utf-8"))
+            sys.stdout.buffer.flush()
+            for fd, data in self._captured:
+                self._stream(fd).write(data)
+                self._stream(fd).flush()
+
+
+class ForeachCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        args: Sequence[str] = (),
+        image: str = "",
+        login: bool = False,
+        jobs: int = 4,
+        capture: bool = False,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        args = list(args)
+        if "--" in args:
+            idx = args.index("--")
+            self._patterns, self._cmd = args[:idx], args[idx + 1 :]
+        else:
+            self._patterns, self._cmd = [], args
+        self._source_image = image
+        self._login = login
+        self._jobs = max(1, jobs)
+        self._capture = capture
+        self._lock = threading.Lock()
+
+    @classmethod
+    def name(cls) -> str:
+        return "foreach"
+
+    @classmethod
+    def description(cls) -> str:
+        return "Run a command in the containers for many directories concurrently"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.usage = (
+            "%(prog)s [-h] [-i IMAGE] [-l] [-j JOBS] [-c] dir ... -- cmd [args ...]"
+        )
+        parser.add_argument(
+            "-i",
+            "--image",
+            help="Source image to use for directories that don't have an image "
+            "yet (default %(default)s)",
+            default=config.default_image,
+        )
+        parser.add_argument(
+            "-l",
+            "--login",
+            action="store_true",
+            help="Run the command in a login shell",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=4,
+            help="Maximum number of directories to run in at once (default %(default)s)",
+        )
+        parser.add_argument(
+            "-c",
+            "--capture",
+            action="store_true",
+            help="Print each directory's output in one block when its command "
+            "finishes, instead of prefixing each line",
+        )
+        parser.add_argument(
+            "args",
+            nargs=REMAINDER,
+            metavar="dir ... -- cmd",
+            help="Directories (or globs) and the command to run in each of them",
+        )
+
+    def run(self) -> None:
+        if not self._patterns or not self._cmd:
+            sys.stderr.write("Usage: bluepill foreach dir ... -- cmd [args ...]\n")
+            sys.exit(2)
+        dirs = expand_dirs(self._patterns)
+        if not dirs:
+            sys.stderr.write("No directories to run in\n")
+            sys.exit(2)
+        # Live progress lines from concurrent builds would clobber each other
+        self.live_progress = False
+        with ThreadPoolExecutor(self._jobs) as executor:
+            results = list(executor.map(self.run_in_dir, dirs))
+        self.print_summary(results)
+        if any(result.status != "passed" for result in results):
+            sys.exit(1)
+
+    def run_in_dir(self, directory: str) -> ForeachResult:
+        start = time.perf_counter()
+        label = os.path.relpath(directory)
+        writer = OutputWriter(label, self._lock, self._capture)
+        name = self.get_unique_dir_name(directory=directory)
+        try:
+            container = self.get_or_create_container(
+                name,
+                name,
+                self.get_hostname(directory=directory),
+                self._source_image,
+                directory,
+            )
+            self.ensure_running(container)
+            exit_code = self.exec_command(container, self._cmd, writer, self._login)
+        except Exception as e:
+            return ForeachResult(
+                directory, "error", time.perf_counter() - start, error=str(e)
+            )
+        finally:
+            writer.close()
+        status = "passed" if exit_code == 0 else "failed"
+        return ForeachResult(directory, status, time.perf_counter() - start, exit_code)
+
+    def print_summary(self, results: Sequence[ForeachResult]) -> None:
+        cwd = os.getcwd()
+        names = [os.path.relpath(result.directory, cwd) for result in results]
+        width = max(len(name) for name in names)
+        print()
+        for name, result in zip(names, results):
+            line = f"{name:<{width}}  {result.status:<6} {result.duration:7.1f}s"
+            if result.exit_code:
+                line += f"  (exit {result.exit_code})"
+            if result.error is not None:
+                line += f"  ({result.error})"
+            print(line)
+        passed = sum(1 for result in results if result.status == "passed")
+        print(f"{passed}/{len(results)} passed")
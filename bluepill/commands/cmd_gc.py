@@ -0,0 +1,287 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Sequence
+
+from ..config import Config
+from ..environments import Inventory
+from ..images import DEFAULT_TAG
+from ..userlayer import USER_LAYER_REPOSITORY
+from ..util import confirm, format_bytes
+from .base import MANAGED_LABEL, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+class StaleEnvironment(NamedTuple):
+    name: str
+    reason: str
+    directory: str
+    size: int
+    container: Optional[Dict[str, Any]]
+    image: Optional[Dict[str, Any]]
+    volumes: List[Dict[str, Any]]
+
+
+class GcCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        days: Optional[float] = None,
+        dry_run: bool = False,
+        yes: bool = False,
+        untracked: bool = False,
+        jobs: int = 4,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._days = days
+        self._dry_run = dry_run
+        self._yes = yes
+        self._untracked = untracked
+        self._jobs = max(1, jobs)
+
+    @classmethod
+    def name(cls) -> str:
+        return "gc"
+
+    @classmethod
+    def description(cls) -> str:
+        return "Delete the containers, images, and volumes of stale environments"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "-d",
+            "--days",
+            type=float,
+            help="Also delete environments that haven't been used for this many days "
+            "(by default only environments whose directory was deleted are removed)",
+        )
+        parser.add_argument(
+            "-u",
+            "--untracked",
+            action="store_true",
+            help="Also delete environments with generated names that bluepill has "
+            "no record of (e.g. created by an older version)",
+        )
+        parser.add_argument(
+            "-n",
+            "--dry-run",
+            action="store_true",
+            help="Only show what would be deleted and how much space it would free",
+        )
+        parser.add_argument(
+            "-y", "--yes", action="store_true", help="Don't ask for confirmation"
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=4,
+            help="Maximum number of concurrent deletes (default %(default)s)",
+        )
+
+    def find_stale(self, inventory: Inventory) -> List[StaleEnvironment]:
+        if not self._dry_run:
+            self.environments.refresh(inventory)
+        records = self.environments.entries
+        cutoff = None if self._days is None else time.time() - self._days * 86400
+        stale = []
+        for name in sorted(set(records) | inventory.generated_names()):
+            if not inventory.has(name):
+                continue
+            container = inventory.containers.get(name)
+            record = records.get(name)
+            directory = "" if record is None else record["directory"]
+            if not directory:
+                if not self._untracked:
+                    continue
+                reason = "untracked"
+            elif not os.path.isdir(directory):
+                reason = "directory deleted"
+            elif (
+                record is not None
+                and cutoff is not None
+                and record["last_used"] < cutoff
+            ):
+                if container is not None and container.get("State") == "running":
+                    continue
+                days = (time.time() - record["last_used"]) / 86400
+                reason = f"unused for {days:.0f} days"
+            else:
+                continue
+            stale.append(
+                StaleEnvironment(
+                    name,
+                    reason,
+                    directory,
+                    inventory.size(name),
+                    container,
+                    inventory.images.get(name),
+                    inventory.volumes.get(name, []),
+                )
+            )
+        return stale
+
+    def run(self) -> None:
+        # system/df is the only endpoint that reports sizes for everything
+        df = self.client.df()
+        stale = self.find_stale(Inventory.from_df(df))
+        # Untagged images that other images are built on aren't dangling
+        parents = {image.get("ParentId") for image in df.get("Images") or []}
+        dangling = [
+            image
+            for image in df.get("Images") or []
+            if not image.get("RepoTags")
+            and image["Id"] not in parents
+            and MANAGED_LABEL in (image.get("Labels") or {})
+        ]
+        dangling_size = sum(max(0, image["Size"]) for image in dangling)
+        user_layers = self.find_unused_user_layers(df, stale)
+        if not stale and not dangling and not user_layers:
+            print("Nothing to clean up")
+            return
+        self.print_report(stale, len(dangling), dangling_size, user_layers)
+        if self._dry_run:
+            return
+        if not self._yes and not confirm("Delete these?", False):
+            return
+        with ThreadPoolExecutor(self._jobs) as executor:
+            errors = [e for e in executor.map(self.delete, stale) if e is not None]
+        errors.extend(self.untag_user_layers(user_layers))
+        if dangling or stale or user_layers:
+            # Only prune the layers left behind by bluepill's own builds
+            result = self.client.api.prune_images(
+                filters={"dangling": True, "label": MANAGED_LABEL}
+            )
+            print(
+                "Pruned dangling images, "
+                f"freed {format_bytes(result.get('SpaceReclaimed') or 0)}"
+            )
+        for error in errors:
+            sys.stderr.write(error + "\n")
+        if errors:
+            sys.exit(1)
+
+    def find_unused_user_layers(
+        self, df: Dict[str, Any], stale: Sequence[StaleEnvironment]
+    ) -> List[Dict[str, Any]]:
+        """Find the user layers that no image or container is built on anymore
+
+        Images and containers that aren't being deleted count as using a user
+        layer if its layers are the first of theirs. Everything built on a user
+        layer inherits its managed label, so only those have to be inspected.
+        """
+        prefix = USER_LAYER_REPOSITORY + ":"
+        deleted_tags = {f"{env.name}:{DEFAULT_TAG}" for env in stale if env.image}
+        deleted_containers = {env.container["Id"] for env in stale if env.container}
+        user_layers = []
+        used = set()
+        for image in df.get("Images") or []:
+            tags = image.get("RepoTags") or []
+            if any(tag.startswith(prefix) for tag in tags):
+                user_layers.append(image)
+            if MANAGED_LABEL in (image.get("Labels") or {}) and any(
+                not tag.startswith(prefix) and tag not in deleted_tags for tag in tags
+            ):
+                used.add(image["Id"])
+        for container in df.get("Containers") or []:
+            if container["Id"] not in deleted_containers and MANAGED_LABEL in (
+                container.get("Labels") or {}
+            ):
+                used.add(container["ImageID"])
+        user_layers = [image for image in user_layers if image["Id"] not in used]
+        if not user_layers:
+            return []
+        ids = sorted(used) + [image["Id"] for image in user_layers]
+        inspected = self.concurrently(
+            *(partial(self.client.api.inspect_image, image_id) for image_id in ids)
+        )
+        chains = [image["RootFS"]["Layers"] for image in inspected[: len(used)]]
+        unused = []
+        for image, info in zip(user_layers, inspected[len(used) :]):
+            layers = info["RootFS"]["Layers"]
+            if not any(chain[: len(layers)] == layers for chain in chains):
+                unused.append(image)
+        return unused
+
+    def untag_user_layers(self, user_layers: Sequence[Dict[str, Any]]) -> List[str]:
+        """Remove the user layer tags, so that the layers can be pruned
+
+        Returns the error messages for the ones that couldn't be removed.
+        """
+        from docker.errors import APIError
+
+        errors = []
+        for image in user_layers:
+            for tag in image.get("RepoTags") or []:
+                if not tag.startswith(USER_LAYER_REPOSITORY + ":"):
+                    continue
+                try:
+                    self.client.api.remove_image(tag)
+                except APIError as e:
+                    errors.append(f"Error deleting {tag}: {e}")
+                else:
+                    print(f"Deleted {tag}")
+        return errors
+
+    def print_report(
+        self,
+        stale: Sequence[StaleEnvironment],
+        dangling: int,
+        dangling_size: int,
+        user_layers: Sequence[Dict[str, Any]] = (),
+    ) -> None:
+        rows = [
+            (env.name, env.reason, format_bytes(env.size), env.directory)
+            for env in stale
+        ]
+        if dangling:
+            rows.append(
+                (f"{dangling} dangling images", "", format_bytes(dangling_size), "")
+            )
+        # Layers that are shared with other images won't be freed
+        user_layers_size = sum(
+            max(0, image["Size"] - max(0, image.get("SharedSize") or 0))
+            for image in user_layers
+        )
+        if user_layers:
+            rows.append(
+                (
+                    f"{len(user_layers)} unused user layers",
+                    "",
+                    format_bytes(user_layers_size),
+                    "",
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(3)]
+        for row in rows:
+            print(
+                f"{row[0]:<{widths[0]}}  {row[1]:<{widths[1]}}  "
+                f"{row[2]:>{widths[2]}}  {row[3]}".rstrip()
+            )
+        total = sum(env.size for env in stale) + dangling_size + user_layers_size
+        print(f"Reclaimable: {format_bytes(total)}")
+
+    def delete(self, env: StaleEnvironment) -> Optional[str]:
+        """Delete an environment. Returns an error message if that failed."""
+        from docker.errors import APIError
+
+        try:
+            if env.container is not None:
+                self.client.api.remove_container(env.container["Id"], force=True)
+            if env.image is not None:
+                self.client.api.remove_image(f"{env.name}:{DEFAULT_TAG}")
+            for volume in env.volumes:
+                self.client.api.remove_volume(volume["Name"])
+        except APIError as e:
+            return f"Error deleting {env.name}: {e}"
+        self.environments.delete(env.name)
+        print(f"Deleted {env.name}")
+        return None
@@ -1,16 +1,17 @@
 from argparse import ArgumentParser
-from typing import Any, Optional
-
-from docker import DockerClient
+from typing import TYPE_CHECKING, Any, Optional
 
 from ..config import Config
 from .base import Command
 
+if TYPE_CHECKING:
+    from docker import DockerClient
+
 
 class HelpCmd(Command):
     def __init__(
         self,
-        client: DockerClient,
+        client: Optional["DockerClient"],
         config: Config,
         root_parser: ArgumentParser,
         cmd: Optional[str] = None,
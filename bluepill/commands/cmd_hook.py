@@ -0,0 +1,77 @@
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Any, Optional
+
+from ..config import Config
+from .base import Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+PREWARM = "command bluepill prewarm --background --quiet"
+
+HOOKS = {
+    "bash": f"""\
+_bluepill_prewarm() {{
+  if [ "$PWD" != "${{_BLUEPILL_LAST_DIR:-}}" ]; then
+    _BLUEPILL_LAST_DIR="$PWD"
+    {PREWARM} 2>/dev/null
+  fi
+}}
+case ";${{PROMPT_COMMAND:-}};" in
+  *";_bluepill_prewarm;"*) ;;
+  *) PROMPT_COMMAND="_bluepill_prewarm${{PROMPT_COMMAND:+;$PROMPT_COMMAND}}" ;;
+esac
+""",
+    "zsh": f"""\
+_bluepill_prewarm() {{
+  {PREWARM} 2>/dev/null
+}}
+autoload -Uz add-zsh-hook
+add-zsh-hook chpwd _bluepill_prewarm
+_bluepill_prewarm
+""",
+    "direnv": f"""\
+# bluepill: start this directory's container in the background
+if has bluepill; then
+  {PREWARM} || true
+fi
+""",
+}
+
+USAGE = {
+    "bash": 'Add this to your ~/.bashrc:  eval "$(bluepill hook bash)"',
+    "zsh": 'Add this to your ~/.zshrc:  eval "$(bluepill hook zsh)"',
+    "direnv": "Add the output to the .envrc of each project:  "
+    "bluepill hook direnv >> .envrc",
+}
+
+
+class HookCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        shell: str = "bash",
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._shell = shell
+
+    @classmethod
+    def name(cls) -> str:
+        return "hook"
+
+    @classmethod
+    def description(cls) -> str:
+        return (
+            "Print a shell snippet that runs 'bluepill prewarm' in the background "
+            "when you cd into a directory. "
+            + " ".join(f"{usage}." for usage in USAGE.values())
+        )
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument("shell", choices=sorted(HOOKS), help="Shell to hook into")
+
+    def run(self) -> None:
+        print(HOOKS[self._shell], end="")
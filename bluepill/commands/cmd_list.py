@@ -0,0 +1,102 @@
+import os
+import time
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from ..config import Config
+from ..daemon import DaemonUnavailable
+from ..environments import EnvironmentRecord, Inventory
+from ..util import format_bytes
+from .base import Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+def format_age(seconds: float) -> str:
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return f"{seconds / size:.0f}{unit} ago"
+    return "just now"
+
+
+def display_directory(record: EnvironmentRecord) -> str:
+    directory = record["directory"]
+    if not directory:
+        return record["name"]
+    if not os.path.isdir(directory):
+        directory += " (deleted)"
+    home = os.path.expanduser("~")
+    if directory.startswith(home + os.sep):
+        directory = "~" + directory[len(home) :]
+    return directory
+
+
+def container_state(record: EnvironmentRecord, states: Optional[Dict[str, str]]) -> str:
+    if states is None:
+        return "yes" if record["container_id"] else "no"
+    return states.get(record["name"], "no")
+
+
+class ListCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        refresh: bool = False,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._refresh = refresh
+
+    @classmethod
+    def name(cls) -> str:
+        return "ls"
+
+    @classmethod
+    def description(cls) -> str:
+        return "List bluepill environments"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "-r",
+            "--refresh",
+            action="store_true",
+            help="Update the list and sizes from docker first. Without this, the "
+            "list comes from bluepill's own records and may be out of date.",
+        )
+
+    def run(self) -> None:
+        # The daemon knows which containers are running, and may have a docker
+        # connection ready for the refresh
+        states: Optional[Dict[str, str]] = None
+        try:
+            if self._refresh:
+                self.call_daemon("refresh", timeout=None)
+            states = self.call_daemon("containers")
+        except DaemonUnavailable:
+            if self._refresh:
+                self.environments.refresh(Inventory.from_df(self.client.df()))
+        records = sorted(
+            self.environments.entries.values(), key=lambda r: -r["last_used"]
+        )
+        if not records:
+            print("No environments")
+            return
+        now = time.time()
+        rows = [("DIRECTORY", "IMAGE", "CONTAINER", "LAST USED", "SIZE")]
+        for record in records:
+            size = record["size"]
+            rows.append(
+                (
+                    display_directory(record),
+                    record["source_image"] or "",
+                    container_state(record, states),
+                    format_age(now - record["last_used"]),
+                    "?" if size is None else format_bytes(size),
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print("  ".join(f"{col:<{w}}" for col, w in zip(row, widths)).rstrip())
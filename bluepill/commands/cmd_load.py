@@ -0,0 +1,182 @@
+import io
+import os
+import re
+import sys
+import tarfile
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, cast
+
+from ..archive import (
+    ARCHIVE_VERSION,
+    IMAGE_PREFIX,
+    METADATA_FILE,
+    VOLUMES_PREFIX,
+    Meter,
+    TarPipe,
+    open_file,
+    open_reader,
+    read_json,
+)
+from ..config import Config
+from ..images import DEFAULT_TAG
+from ..profile import phase
+from ..progress import StreamError
+from .base import CacheVolume, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+# The archive is saved by image ID, so the daemon reports the ID when loading it
+LOADED_RE = re.compile(r"^Loaded image ID: (\S+)")
+
+
+def _strip_prefix(member: tarfile.TarInfo, prefix: str, new_prefix: str = "") -> None:
+    member.name = new_prefix + member.name[len(prefix) :]
+    if member.islnk():
+        member.linkname = new_prefix + member.linkname[len(prefix) :]
+
+
+class LoadCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        file: str = "-",
+        name: Optional[str] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._file = file
+        self._name = self.get_unique_dir_name(name)
+        self._printer = self.get_printer(self._name)
+
+    @classmethod
+    def name(cls) -> str:
+        return "load"
+
+    @classmethod
+    def description(cls) -> str:
+        return "Load an environment from an archive created by 'bluepill save'"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument("file", help="Archive to load, or '-' for stdin")
+        parser.add_argument(
+            "name",
+            nargs="?",
+            help="Name of the image (if omitted, will use a unique name generated from the current directory)",
+        )
+
+    def run(self) -> None:
+        with open_file(self._file, "r") as ifile:
+            meter = Meter(ifile, self._printer, "Loading")
+            stream = io.BufferedReader(cast(Any, meter))
+            with open_reader(stream) as tar:
+                member = tar.next()
+                if member is None or member.name != METADATA_FILE:
+                    raise ValueError(f"{self._file} is not a bluepill archive")
+                metadata = read_json(tar, member)
+                if metadata.get("version") != ARCHIVE_VERSION:
+                    raise ValueError(
+                        f"Unsupported archive version {metadata.get('version')}"
+                    )
+                self.check_skipped_layers(metadata)
+                member = tar.next()
+                loader = TarPipe(self.load_image)
+                with phase("load image"), loader as pipe:
+                    while member is not None and member.name.startswith(IMAGE_PREFIX):
+                        fileobj = tar.extractfile(member) if member.isfile() else None
+                        _strip_prefix(member, IMAGE_PREFIX)
+                        pipe.addfile(member, fileobj)
+                        member = tar.next()
+                image_id = loader.result or metadata["image"]
+                self.client.api.tag(image_id, self._name, DEFAULT_TAG)
+                if member is not None:
+                    with phase("load volumes"):
+                        self.load_volumes(tar, member, image_id)
+        self.environments.record(
+            self._name, source_image=metadata.get("source_image"), image_id=image_id
+        )
+        self._printer.line(f"Loaded {self._name}: {meter.summary()}")
+        container = self.get_container(self._name)
+        if container is not None and container.attrs["Image"] != image_id:
+            self._printer.line(
+                "The existing container uses the old image. "
+                "Run 'bluepill rm' to recreate it from the loaded one."
+            )
+
+    def check_skipped_layers(self, metadata: Dict[str, Any]) -> None:
+        """Make sure that the daemon has the layers that were left out"""
+        from docker.errors import ImageNotFound
+
+        skipped = set(metadata.get("skipped_layers") or [])
+        if not skipped:
+            return
+        for image in metadata.get("skip_layers_of") or []:
+            try:
+                skipped.difference_update(
+                    self.client.api.inspect_image(image)["RootFS"]["Layers"]
+                )
+            except ImageNotFound:
+                pass
+        if skipped:
+            images = ", ".join(metadata.get("skip_layers_of") or [])
+            sys.stderr.write(
+                f"The archive was saved without the layers of {images}, "
+                f"and {len(skipped)} of them are missing here. "
+                "Pull or load that image first.\n"
+            )
+            sys.exit(1)
+
+    def load_image(self, chunks: Iterator[bytes]) -> Optional[str]:
+        """Load a 'docker save' tar stream and return the ID of the image"""
+        log: List[Dict[str, Any]] = []
+        image_id = None
+        for event in self.client.api.load_image(chunks):
+            log.append(event)
+            if "error" in event:
+                raise StreamError(event["error"], log)
+            match = LOADED_RE.match(event.get("stream", ""))
+            if match:
+                image_id = match.group(1)
+        return image_id
+
+    def load_volumes(
+        self, tar: tarfile.TarFile, member: Optional[tarfile.TarInfo], image_id: str
+    ) -> None:
+        targets: Dict[str, CacheVolume] = {
+            volume.name[len(self._name) + 1 :]: volume
+            for volume in self.get_cache_volumes(self._name)
+            if volume.project == self._name
+        }
+        self.create_volumes(self._name)
+        with self.volume_container(image_id, list(targets.values())) as container_id:
+            while member is not None:
+                if not member.name.startswith(VOLUMES_PREFIX):
+                    raise ValueError(f"Unexpected file in archive: {member.name}")
+                key = member.name[len(VOLUMES_PREFIX) :].split("/", 1)[0]
+                prefix = VOLUMES_PREFIX + key
+                volume = targets.get(key)
+                if volume is None:
+                    self._printer.line(
+                        f"Skipping volume '{key}' that isn't configured here"
+                    )
+                    while member is not None and (
+                        member.name == prefix or member.name.startswith(prefix + "/")
+                    ):
+                        member = tar.next()
+                    continue
+                dest = os.path.dirname(volume.path)
+
+                def put_archive(chunks: Iterator[bytes]) -> None:
+                    self.client.api.put_archive(container_id, dest, chunks)
+
+                with TarPipe(put_archive) as pipe:
+                    while member is not None and (
+                        member.name == prefix or member.name.startswith(prefix + "/")
+                    ):
+                        fileobj = tar.extractfile(member) if member.isfile() else None
+                        _strip_prefix(member, prefix, os.path.basename(volume.path))
+                        pipe.addfile(member, fileobj)
+                        member = tar.next()
+                self._printer.line(f"Loaded volume {volume.name}")
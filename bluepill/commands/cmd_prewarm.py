@@ -0,0 +1,120 @@
+import fcntl
+import os
+import time
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Any, Optional
+
+from ..config import Config
+from ..profile import phase
+from .base import MODE_LABEL, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+class PrewarmCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        name: Optional[str] = None,
+        image: Optional[str] = None,
+        background: bool = False,
+        quiet: bool = False,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._explicit_name = name is not None
+        self._container_name = self.get_unique_dir_name(name)
+        self._image_name = self.get_unique_dir_name(name)
+        self._hostname = self.get_hostname(name)
+        self._source_image = image
+        self._background = background
+        self._quiet = quiet
+
+    @classmethod
+    def name(cls) -> str:
+        return "prewarm"
+
+    @classmethod
+    def description(cls) -> str:
+        return "Start the container for a directory so that the next enter is instant"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "name",
+            nargs="?",
+            help="Name of the container/image (if omitted, will use a unique name "
+            "generated from the current directory, but only if bluepill has been "
+            "used in this directory before)",
+        )
+        parser.add_argument(
+            "-i",
+            "--image",
+            help="Source image to build from if the image is missing "
+            "(default: the image it was built from before)",
+        )
+        parser.add_argument(
+            "-b",
+            "--background",
+            action="store_true",
+            help="Return immediately and do the work in a background process. "
+            "Its output goes to prewarm.log in the bluepill cache dir.",
+        )
+        parser.add_argument(
+            "-q",
+            "--quiet",
+            action="store_true",
+            help="Don't print anything if this isn't a bluepill directory",
+        )
+
+    def run(self) -> None:
+        # Shell hooks call this on every directory change, so bail out before
+        # talking to docker (or even importing it) if there is nothing to do
+        record = self.environments.get(self._container_name)
+        if record is None and not self._explicit_name:
+            if not self._quiet:
+                print("bluepill hasn't been used in this directory")
+            return
+        source_image = (
+            self._source_image
+            or (record and record["source_image"])
+            or self.config.default_image
+        )
+        if self._background and not self.detach("prewarm.log"):
+            return
+        lock_file = os.path.join(
+            Config.get_cache_dir(), "locks", f"prewarm-{self._container_name}"
+        )
+        os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+        with open(lock_file, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another prewarm for this directory is already running
+                return
+            self.prewarm(source_image)
+
+    def prewarm(self, source_image: str) -> None:
+        start = time.perf_counter()
+        # Passing through a directory doesn't count as using it
+        container = self.get_or_create_container(
+            self._container_name,
+            self._image_name,
+            self._hostname,
+            source_image,
+            used=False,
+        )
+        if container.labels.get(MODE_LABEL) != "exec":
+            # Containers from older versions of bluepill start when attached to
+            return
+        self.ensure_running(container)
+        # The first login shell reads the shell's startup files from disk, so run
+        # one now to warm the page cache for the real one
+        with phase("warm shell"):
+            self.exec_command(container, ["true"], lambda out, err: None, login=True)
+        print(
+            f"{time.strftime('%Y-%m-%d %H:%M:%S')} Prewarmed "
+            f"{self._container_name} in {time.perf_counter() - start:.1f}s"
+        )
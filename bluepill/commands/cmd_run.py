@@ -0,0 +1,110 @@
+import sys
+from argparse import REMAINDER, Action, ArgumentParser, Namespace
+from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple
+
+from ..config import Config
+from .base import Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+def split_name(args: Sequence[str]) -> Tuple[Optional[str], List[str]]:
+    """Split '[name] -- cmd args...' into the name and the command"""
+    if "--" not in args:
+        return None, list(args)
+    idx = list(args).index("--")
+    if idx > 1:
+        raise ValueError("Expected at most one name before '--'")
+    return (args[0] if idx == 1 else None), list(args[idx + 1 :])
+
+
+class NameAndCommandAction(Action):
+    """Check '[name] -- cmd args...' while parsing, so that errors print usage"""
+
+    def __call__(
+        self,
+        parser: ArgumentParser,
+        namespace: Namespace,
+        values: Any,
+        option_string: Optional[str] = None,
+    ) -> None:
+        try:
+            split_name(values)
+        except ValueError as e:
+            parser.error(str(e))
+        setattr(namespace, self.dest, values)
+
+
+class RunCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        args: Sequence[str] = (),
+        image: str = "",
+        login: bool = False,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        name, self._cmd = split_name(args)
+        self._container_name = self.get_unique_dir_name(name)
+        self._image_name = self.get_unique_dir_name(name)
+        self._hostname = self.get_hostname(name)
+        self._source_image = image
+        self._login = login
+
+    @classmethod
+    def name(cls) -> str:
+        return "run"
+
+    @classmethod
+    def description(cls) -> str:
+        return "Run a command in the docker container without a tty"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.usage = "%(prog)s [-h] [-i IMAGE] [-l] [name] -- cmd [args ...]"
+        parser.add_argument(
+            "-i",
+            "--image",
+            help="Source image to use if image is not created yet (default %(default)s)",
+            default=config.default_image,
+        )
+        parser.add_argument(
+            "-l",
+            "--login",
+            action="store_true",
+            help="Run the command in a login shell, so that it sees the same "
+            "environment as 'bluepill enter'",
+        )
+        parser.add_argument(
+            "args",
+            nargs=REMAINDER,
+            action=NameAndCommandAction,
+            metavar="[name] -- cmd",
+            help="Name of the container/image (if omitted, will use a unique name "
+            "generated from the current directory) and the command to run",
+        )
+
+    def run(self) -> None:
+        if not self._cmd:
+            sys.stderr.write("No command to run\n")
+            sys.exit(2)
+        container = self.get_or_create_container(
+            self._container_name, self._image_name, self._hostname, self._source_image
+        )
+        self.ensure_running(container)
+        exit_code = self.exec_command(
+            container, self._cmd, self.write_output, self._login
+        )
+        if exit_code:
+            sys.exit(exit_code)
+
+    def write_output(self, stdout: Optional[bytes], stderr: Optional[bytes]) -> None:
+        if stdout:
+            sys.stdout.buffer.write(stdout)
+            sys.stdout.buffer.flush()
+        if stderr:
+            sys.stderr.buffer.write(stderr)
+            sys.stderr.buffer.flush()
@@ -0,0 +1,225 @@
+import hashlib
+import io
+import os
+import sys
+import tarfile
+import tempfile
+from argparse import ArgumentParser
+from typing import IO, TYPE_CHECKING, Any, List, Optional, Sequence, Set, Tuple, cast
+
+from ..archive import (
+    ARCHIVE_VERSION,
+    COMPRESSIONS,
+    IMAGE_PREFIX,
+    METADATA_FILE,
+    VOLUMES_PREFIX,
+    IterReader,
+    Meter,
+    add_json,
+    default_compression,
+    open_file,
+    open_writer,
+)
+from ..config import Config
+from ..images import DEFAULT_TAG
+from ..profile import phase
+from ..progress import ProgressPrinter
+from ..util import format_bytes
+from .base import CacheVolume, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+# Layers bigger than this are spooled to disk while checking their digest
+SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def layer_digest(name: str) -> Optional[str]:
+    """The digest of a layer in the output of 'docker save', if it's named by it"""
+    if name.startswith("blobs/sha256/"):
+        return "sha256:" + os.path.basename(name)
+    return None
+
+
+class SaveCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        name: Optional[str] = None,
+        output: Optional[str] = None,
+        compression: Optional[str] = None,
+        volumes: bool = False,
+        skip_layers_of: Sequence[str] = (),
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._name = self.get_unique_dir_name(name)
+        if compression is None:
+            compression = default_compression(output or "")
+        ext = "zst" if compression == "zstd" else "gz"
+        self._output = output or f"{os.path.basename(os.getcwd())}.tar.{ext}"
+        self._compression = compression
+        self._volumes = volumes
+        self._skip_layers_of = list(skip_layers_of or [])
+        # stdout may be the archive
+        self._printer = ProgressPrinter(self._name, sys.stderr)
+
+    @classmethod
+    def name(cls) -> str:
+        return "save"
+
+    @classmethod
+    def description(cls) -> str:
+        return "Save an environment to a compressed archive"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "name",
+            nargs="?",
+            help="Name of the image (if omitted, will use a unique name generated from the current directory)",
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            help="File to write, or '-' for stdout "
+            "(default <directory name>.tar.zst or .tar.gz)",
+        )
+        parser.add_argument(
+            "-c",
+            "--compression",
+            choices=COMPRESSIONS,
+            help="Compression to use (default from the file extension, or zstd "
+            "if the zstandard package is installed)",
+        )
+        parser.add_argument(
+            "-v",
+            "--volumes",
+            action="store_true",
+            help="Also save the contents of the home and cache volumes",
+        )
+        parser.add_argument(
+            "-s",
+            "--skip-layers-of",
+            action="append",
+            metavar="IMAGE",
+            help="Leave out the layers that this image has, because the machine "
+            "that will load the archive has it too (e.g. the source image). "
+            "Can be repeated.",
+        )
+
+    def run(self) -> None:
+        from docker.errors import ImageNotFound
+
+        try:
+            image = self.client.api.inspect_image(f"{self._name}:{DEFAULT_TAG}")
+        except ImageNotFound:
+            sys.stderr.write(
+                f"No image for {self._name}. "
+                "Create one with 'bluepill build' or 'bluepill commit'\n"
+            )
+            sys.exit(1)
+        layers: List[str] = image["RootFS"]["Layers"]
+        skipped: Set[str] = set()
+        for other in self._skip_layers_of:
+            skipped.update(self.client.api.inspect_image(other)["RootFS"]["Layers"])
+        skipped.intersection_update(layers)
+        volumes = self.get_saved_volumes() if self._volumes else []
+        record = self.environments.get(self._name)
+        metadata = {
+            "version": ARCHIVE_VERSION,
+            "name": self._name,
+            "image": image["Id"],
+            "source_image": None if record is None else record["source_image"],
+            "layers": layers,
+            "skipped_layers": sorted(skipped),
+            "skip_layers_of": self._skip_layers_of,
+            "volumes": [key for key, _ in volumes],
+        }
+        with open_file(self._output, "w") as ofile:
+            meter = Meter(ofile, self._printer, "Saving")
+            with open_writer(cast(IO[bytes], meter), self._compression) as tar:
+                add_json(tar, METADATA_FILE, metadata)
+                with phase("save image"):
+                    left_out = self.copy_image(tar, image["Id"], skipped)
+                if volumes:
+                    with phase("save volumes"), self.volume_container(
+                        image["Id"], [volume for _, volume in volumes]
+                    ) as container_id:
+                        for key, volume in volumes:
+                            self.copy_volume(tar, container_id, key, volume)
+        message = f"Saved {self._name} to {self._output}: {meter.summary()}"
+        if left_out:
+            message += f", left out {left_out} layers"
+        self._printer.line(message)
+
+    def get_saved_volumes(self) -> List[Tuple[str, CacheVolume]]:
+        """The volumes that belong only to this project, by their name suffix"""
+        existing = set(self.get_project_volumes(self._name))
+        return [
+            (volume.name[len(self._name) + 1 :], volume)
+            for volume in self.get_cache_volumes(self._name)
+            if volume.project == self._name and volume.name in existing
+        ]
+
+    def copy_image(self, tar: tarfile.TarFile, image_id: str, skipped: Set[str]) -> int:
+        """Copy the output of 'docker save' into the archive
+
+        Returns the number of layers that were left out
+        """
+        left_out = 0
+        chunks = self.client.api.get_image(image_id)
+        stream = io.BufferedReader(IterReader(chunks))
+        with tarfile.open(fileobj=stream, mode="r|") as saved:
+            for member in saved:
+                fileobj = saved.extractfile(member) if member.isfile() else None
+                if fileobj is not None and skipped:
+                    digest = layer_digest(member.name)
+                    if digest is None and member.name.endswith("/layer.tar"):
+                        # Older versions of docker name layers by a v1 ID, so
+                        # hash them to find out which layer they are
+                        fileobj, digest = self.spool_layer(fileobj)
+                    if digest in skipped:
+                        left_out += 1
+                        continue
+                member.name = IMAGE_PREFIX + member.name
+                if member.islnk():
+                    member.linkname = IMAGE_PREFIX + member.linkname
+                tar.addfile(member, fileobj)
+        return left_out
+
+    def spool_layer(self, fileobj: IO[bytes]) -> Tuple[IO[bytes], str]:
+        sha = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        while True:
+            chunk = fileobj.read(1024 * 1024)
+            if not chunk:
+                break
+            sha.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+        return cast(IO[bytes], spool), "sha256:" + sha.hexdigest()
+
+    def copy_volume(
+        self, tar: tarfile.TarFile, container_id: str, key: str, volume: CacheVolume
+    ) -> None:
+        """Copy the contents of a volume into the archive under volumes/<key>"""
+        chunks, _ = self.client.api.get_archive(container_id, volume.path)
+        stream = io.BufferedReader(IterReader(chunks))
+        size = 0
+        with tarfile.open(fileobj=stream, mode="r|") as data:
+            for member in data:
+                fileobj = data.extractfile(member) if member.isfile() else None
+                # The first path component is the name of the volume's directory
+                member.name = volume_path(key, member.name)
+                if member.islnk():
+                    member.linkname = volume_path(key, member.linkname)
+                size += member.size
+                tar.addfile(member, fileobj)
+        self._printer.line(f"Saved volume {volume.name} ({format_bytes(size)})")
+
+
+def volume_path(key: str, name: str) -> str:
+    rest = name.partition("/")[2]
+    return f"{VOLUMES_PREFIX}{key}/{rest}" if rest else f"{VOLUMES_PREFIX}{key}"
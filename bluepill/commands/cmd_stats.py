@@ -0,0 +1,214 @@
+import time
+from argparse import ArgumentParser
+from functools import partial
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, cast
+
+from ..activity import Activity, ActivityCache, cpu_usage, is_busy, resident_memory
+from ..config import Config
+from ..environments import EnvironmentRecord
+from ..util import format_bytes
+from .base import MODE_LABEL, Command
+from .cmd_list import display_directory, format_age
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+class EnvironmentStats(NamedTuple):
+    name: str
+    record: EnvironmentRecord
+    state: str
+    # Resident memory, if it's running
+    memory: Optional[int]
+    # Seconds since it was last active, if it's running
+    idle: Optional[float]
+    activity: Activity
+
+
+class StatsCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        stop_idle: bool = False,
+        timeout: Optional[float] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._stop_idle = stop_idle
+        self._timeout = timeout
+        self._activity: Optional[ActivityCache] = None
+
+    @classmethod
+    def name(cls) -> str:
+        return "stats"
+
+    @classmethod
+    def description(cls) -> str:
+        return (
+            "Show how much memory each running environment holds and when it was "
+            "last active, and stop the idle ones"
+        )
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "-s",
+            "--stop-idle",
+            action="store_true",
+            help="Stop containers that have been idle for longer than the timeout. "
+            "'bluepill daemon' does this on its own.",
+        )
+        parser.add_argument(
+            "-t",
+            "--timeout",
+            type=float,
+            help="Minutes without activity before a container counts as idle "
+            f"(default {config.idle_timeout_minutes or 'never'})",
+        )
+
+    @property
+    def activity(self) -> ActivityCache:
+        if self._activity is None:
+            self._activity = ActivityCache()
+        return self._activity
+
+    def run(self) -> None:
+        stats = self.collect()
+        if self._stop_idle:
+            timeout = self._timeout
+            if timeout is None:
+                timeout = self.config.idle_timeout_minutes
+            if timeout > 0:
+                stats = self.stop_idle(stats, timeout)
+        self.print_report(stats)
+
+    def collect(self) -> List[EnvironmentStats]:
+        """Sample every environment container and record its activity
+
+        Only containers that run shells with exec are included. The others stop
+        when their shell exits, so they are never idle.
+        """
+        records = self.environments.entries
+        containers = self.client.api.containers(
+            all=True, filters={"label": f"{MODE_LABEL}=exec"}
+        )
+        calls = []
+        for container in containers:
+            name = container["Names"][0].lstrip("/")
+            record = records.get(name)
+            if record is None:
+                # Not created by bluepill, or by an older version
+                continue
+            calls.append(partial(self.sample, container, record))
+        return self.concurrently(*calls)
+
+    def sample(
+        self, container: Dict[str, Any], record: EnvironmentRecord
+    ) -> EnvironmentStats:
+        name = record["name"]
+        entry = cast(Activity, dict(self.activity.get(name) or {}))
+        if container["State"] != "running":
+            return EnvironmentStats(name, record, container["State"], None, None, entry)
+        now = time.time()
+        attrs = self.client.api.inspect_container(container["Id"])
+        stats = self.get_stats(container["Id"])
+        cpu = cpu_usage(stats)
+        # Starting the container doesn't count, because 'bluepill prewarm' does
+        # that whenever you cd into the directory
+        active = max(entry.get("active", 0), record["last_used"])
+        if (
+            "cpu" not in entry
+            or is_busy(entry, cpu, now)
+            or self.has_running_exec(attrs)
+        ):
+            # When there's no earlier sample, there's no telling what the
+            # container has been doing, so it gets a full timeout from now
+            active = now
+        entry["active"] = active
+        entry["cpu"] = cpu
+        entry["sampled"] = now
+        self.activity.set(name, entry)
+        return EnvironmentStats(
+            name, record, "running", resident_memory(stats), now - active, entry
+        )
+
+    def get_stats(self, container_id: str) -> Dict[str, Any]:
+        from docker.utils import version_gte
+
+        # Without one_shot, docker waits a second to sample the CPU usage twice
+        if version_gte(self.client.api.api_version, "1.41"):
+            stats = self.client.api.stats(container_id, stream=False, one_shot=True)
+        else:
+            stats = self.client.api.stats(container_id, stream=False)
+        return stats
+
+    def has_running_exec(self, attrs: Dict[str, Any]) -> bool:
+        """True if someone has a shell (or runs a command) in the container"""
+        from docker.errors import NotFound
+
+        for exec_id in attrs.get("ExecIDs") or []:
+            try:
+                if self.client.api.exec_inspect(exec_id)["Running"]:
+                    return True
+            except NotFound:
+                pass
+        return False
+
+    def stop_idle(
+        self, stats: List[EnvironmentStats], timeout: float
+    ) -> List[EnvironmentStats]:
+        """Stop the containers that have been idle for timeout minutes
+
+        'bluepill enter' starts them again. Returns the updated stats.
+        """
+        result = []
+        for env in stats:
+            if env.idle is None or env.idle < timeout * 60:
+                result.append(env)
+                continue
+            # Someone may have entered it since it was sampled
+            if self.has_running_exec(self.client.api.inspect_container(env.name)):
+                result.append(env)
+                continue
+            self.client.api.stop(env.name, timeout=1)
+            freed = env.memory or 0
+            entry = env.activity
+            entry["stopped"] = time.time()
+            entry["reclaimed"] = freed
+            entry["reclaimed_total"] = entry.get("reclaimed_total", 0) + freed
+            self.activity.set(env.name, entry)
+            print(
+                f"Stopped {display_directory(env.record)} after "
+                f"{env.idle / 60:.0f} minutes idle, freeing {format_bytes(freed)}"
+            )
+            result.append(env._replace(state="exited", memory=None, idle=None))
+        return result
+
+    def print_report(self, stats: List[EnvironmentStats]) -> None:
+        if not stats:
+            print("No environments")
+            return
+        now = time.time()
+        rows = [("DIRECTORY", "STATE", "MEMORY", "LAST ACTIVE", "RECLAIMED")]
+        for env in sorted(stats, key=lambda e: (e.memory is None, -(e.memory or 0))):
+            active = env.activity.get("active")
+            reclaimed = env.activity.get("reclaimed_total")
+            rows.append(
+                (
+                    display_directory(env.record),
+                    env.state,
+                    "-" if env.memory is None else format_bytes(env.memory),
+                    "?" if active is None else format_age(now - active),
+                    format_bytes(reclaimed) if reclaimed else "-",
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print("  ".join(f"{col:<{w}}" for col, w in zip(row, widths)).rstrip())
+        held = sum(env.memory or 0 for env in stats)
+        reclaimed_total = sum(env.activity.get("reclaimed_total", 0) for env in stats)
+        print(
+            f"\nRunning environments hold {format_bytes(held)}. "
+            f"Stopping idle ones has freed {format_bytes(reclaimed_total)}."
+        )
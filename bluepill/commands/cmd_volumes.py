@@ -0,0 +1,76 @@
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from ..config import Config
+from ..environments import PROJECT_LABEL
+from ..util import format_bytes
+from .base import VOLUME_LABEL, Command
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+
+class VolumesCmd(Command):
+    def __init__(
+        self,
+        client: Optional["DockerClient"],
+        config: Config,
+        name: Optional[str] = None,
+        all: bool = False,  # pylint: disable=redefined-builtin
+        **kwargs: Any,
+    ):
+        super().__init__(client, config, **kwargs)
+        self._project = self.get_unique_dir_name(name)
+        self._all = all
+
+    @classmethod
+    def name(cls) -> str:
+        return "volumes"
+
+    @classmethod
+    def description(cls) -> str:
+        return "List the home and cache volumes and their sizes"
+
+    @classmethod
+    def configure(cls, config: Config, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "name",
+            nargs="?",
+            help="Name of the container/image (if omitted, will use a unique name generated from the current directory)",
+        )
+        parser.add_argument(
+            "-a",
+            "--all",
+            action="store_true",
+            help="List the volumes of all projects",
+        )
+
+    def run(self) -> None:
+        # The volume list doesn't include sizes, so this has to use 'df'
+        volumes: List[Dict[str, Any]] = []
+        for volume in self.client.df().get("Volumes") or []:
+            labels = volume.get("Labels") or {}
+            if VOLUME_LABEL not in labels:
+                continue
+            project = labels.get(PROJECT_LABEL, "")
+            if self._all or project in ("", self._project):
+                volumes.append(volume)
+        if not volumes:
+            print("No volumes")
+            return
+        rows = [("NAME", "PATH", "SIZE")]
+        total = 0
+        for volume in sorted(volumes, key=lambda v: v["Name"]):
+            size = (volume.get("UsageData") or {}).get("Size", -1)
+            total += max(0, size)
+            rows.append(
+                (
+                    volume["Name"],
+                    volume["Labels"][VOLUME_LABEL],
+                    format_bytes(size) if size >= 0 else "?",
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(2)]
+        for row in rows:
+            print(f"{row[0]:<{widths[0]}}  {row[1]:<{widths[1]}}  {row[2]}")
+        print(f"Total: {format_bytes(total)}")
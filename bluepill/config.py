@@ -1,14 +1,53 @@
 import json
 import logging
 import os
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Sequence
 
 logger = logging.getLogger(__name__)
 
+# Paths (relative to the home directory) that are kept in named volumes so that
+# downloaded packages and build caches survive recreating the container
+DEFAULT_CACHE_VOLUMES = ["~/.cache", "~/.npm", "~/.cargo/registry"]
+# Paths whose new files 'bluepill commit --exclude' leaves out of the commit,
+# because they only hold caches and scratch files that would bloat the image
+DEFAULT_COMMIT_EXCLUDE = ["/tmp", "/var/tmp", "/var/lib/apt/lists", "~/.cache"]
+
 
 class Config:
-    def __init__(self, default_image: str = "ubuntu:latest"):
+    def __init__(
+        self,
+        default_image: str = "ubuntu:latest",
+        user_layer: str = "apt",
+        static_sudo: Optional[str] = None,
+        cache_volumes: Optional[Sequence[str]] = None,
+        home_volume: bool = False,
+        share_volumes: bool = False,
+        commit_exclude: Optional[Sequence[str]] = None,
+        squash_depth: int = 10,
+        squash_size_mb: int = 2048,
+        resources: Optional[Dict[str, Any]] = None,
+        idle_timeout_minutes: int = 120,
+    ):
         self.default_image = default_image
+        self.user_layer = user_layer
+        self.static_sudo = static_sudo
+        self.cache_volumes: List[str] = list(
+            DEFAULT_CACHE_VOLUMES if cache_volumes is None else cache_volumes
+        )
+        self.home_volume = home_volume
+        self.share_volumes = share_volumes
+        self.commit_exclude: List[str] = list(
+            DEFAULT_COMMIT_EXCLUDE if commit_exclude is None else commit_exclude
+        )
+        # Commits are squashed into one layer when they stack more than this
+        # many layers, or this much data, on top of the original image
+        self.squash_depth = squash_depth
+        self.squash_size_mb = squash_size_mb
+        # Default resource limits for containers. See bluepill/resources.py
+        self.resources: Dict[str, Any] = dict(resources or {})
+        # 'bluepill daemon' stops containers that have been idle for this long
+        # (0 to never stop them)
+        self.idle_timeout_minutes = idle_timeout_minutes
 
     @staticmethod
     def get_config_file() -> str:
@@ -42,7 +81,19 @@ class Config:
                 return cls()
 
     def asdict(self) -> Dict[str, Any]:
-        return {"default_image": self.default_image}
+        return {
+            "default_image": self.default_image,
+            "user_layer": self.user_layer,
+            "static_sudo": self.static_sudo,
+            "cache_volumes": self.cache_volumes,
+            "home_volume": self.home_volume,
+            "share_volumes": self.share_volumes,
+            "commit_exclude": self.commit_exclude,
+            "squash_depth": self.squash_depth,
+            "squash_size_mb": self.squash_size_mb,
+            "resources": self.resources,
+            "idle_timeout_minutes": self.idle_timeout_minutes,
+        }
 
     def save(self) -> None:
         file = self.get_config_file()
@@ -50,3 +101,41 @@ class Config:
         os.makedirs(dir, exist_ok=True)
         with open(file, "w") as ofile:
             json.dump(self.asdict(), ofile)
+
+
+class ProjectConfig:
+    """Settings for one project, from a .bluepill.json in its directory"""
+
+    filename = ".bluepill.json"
+
+    def __init__(
+        self,
+        resources: Optional[Dict[str, Any]] = None,
+        provision: Optional[Sequence[Any]] = None,
+    ):
+        self.resources: Dict[str, Any] = dict(resources or {})
+        # Steps that are run to set up the project image. See bluepill/provision.py
+        self.provision: List[Any] = list(provision or [])
+
+    @classmethod
+    def get_config_file(cls, directory: Optional[str] = None) -> str:
+        return os.path.join(os.path.abspath(directory or os.curdir), cls.filename)
+
+    @classmethod
+    def load(cls, directory: Optional[str] = None) -> "ProjectConfig":
+        file = cls.get_config_file(directory)
+        if not os.path.exists(file):
+            return cls()
+        with open(file, "r") as ifile:
+            try:
+                data = json.load(ifile)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Error loading project config {file}: {e}")
+        if not isinstance(data, dict):
+            raise ValueError(f"Project config {file} must be a json object")
+        unknown = set(data) - {"resources", "provision"}
+        if unknown:
+            raise ValueError(
+                f"Unknown keys in project config {file}: {', '.join(sorted(unknown))}"
+            )
+        return cls(**data)
@@ -0,0 +1,76 @@
+import json
+import os
+import socket
+from typing import Any, Dict, Optional
+
+from .config import Config
+
+# Bumped when requests or responses change, so that the CLI doesn't talk to a
+# daemon that was started by a different version of bluepill
+PROTOCOL_VERSION = 2
+SOCKET_NAME = "daemon.sock"
+# Lookups should take milliseconds. If the daemon is that slow, something is
+# wrong with it and it's better to do the work directly.
+DEFAULT_TIMEOUT = 10.0
+
+
+class DaemonUnavailable(Exception):
+    """There is no usable daemon, so the caller should do the work itself"""
+
+
+class DaemonError(Exception):
+    """The daemon failed to handle a request"""
+
+
+def get_socket_path() -> str:
+    return os.path.join(Config.get_cache_dir(), SOCKET_NAME)
+
+
+def encode_message(data: Dict[str, Any]) -> bytes:
+    return json.dumps(data).encode("utf-8") + b"\n"
+
+
+class DaemonClient:
+    """Client for 'bluepill daemon'
+
+    Each request is a line of json on a new connection to a unix socket in the
+    cache dir, and so is the response.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @classmethod
+    def connect(cls) -> Optional["DaemonClient"]:
+        """Get a client if a daemon may be running, without talking to it yet"""
+        if os.environ.get("BLUEPILL_NO_DAEMON"):
+            return None
+        path = get_socket_path()
+        if not os.path.exists(path):
+            return None
+        return cls(path)
+
+    def call(
+        self, method: str, timeout: Optional[float] = DEFAULT_TIMEOUT, **params: Any
+    ) -> Any:
+        request = {"version": PROTOCOL_VERSION, "method": method, "params": params}
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.path)
+            sock.sendall(encode_message(request))
+            with sock.makefile("rb") as rfile:
+                line = rfile.readline()
+        except OSError as e:
+            # This includes timeouts, and the socket of a daemon that has died
+            raise DaemonUnavailable(f"Could not reach the bluepill daemon: {e}")
+        finally:
+            sock.close()
+        if not line:
+            raise DaemonUnavailable("The daemon closed the connection")
+        response = json.loads(line)
+        if response.get("unavailable"):
+            raise DaemonUnavailable(response["error"])
+        if "error" in response:
+            raise DaemonError(response["error"])
+        return response.get("result")
@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import closing
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Set, cast
+
+from .config import Config
+
+if sys.version_info < (3, 8):
+    from typing_extensions import TypedDict
+else:
+    from typing import TypedDict
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# Names generated by Command.get_unique_dir_name
+GENERATED_NAME_RE = re.compile(r"^bluepill-.*-[0-9a-f]{32}$")
+# Label with the name of the environment that a volume belongs to
+PROJECT_LABEL = "bluepill.project"
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS environments (
+    name TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    source_image TEXT,
+    image_id TEXT,
+    container_id TEXT,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS environments_directory ON environments (directory);
+"""
+FIELDS = (
+    "name",
+    "directory",
+    "source_image",
+    "image_id",
+    "container_id",
+    "created",
+    "last_used",
+    "size",
+)
+
+
+class EnvironmentRecord(TypedDict):
+    name: str
+    # Empty for environments that were found in docker but not created by bluepill
+    directory: str
+    source_image: Optional[str]
+    image_id: Optional[str]
+    container_id: Optional[str]
+    created: float
+    last_used: float
+    # Bytes on disk as of the last refresh, if known
+    size: Optional[int]
+
+
+class Inventory(NamedTuple):
+    """The containers, images, and volumes in docker, by environment name"""
+
+    containers: Dict[str, Dict[str, Any]]
+    images: Dict[str, Dict[str, Any]]
+    volumes: Dict[str, List[Dict[str, Any]]]
+
+    @classmethod
+    def from_df(cls, df: Dict[str, Any]) -> "Inventory":
+        """Build from the output of the docker 'system/df' endpoint"""
+        containers: Dict[str, Dict[str, Any]] = {}
+        for container in df.get("Containers") or []:
+            for name in container.get("Names") or []:
+                containers[name.lstrip("/")] = container
+        images: Dict[str, Dict[str, Any]] = {}
+        for image in df.get("Images") or []:
+            for tag in image.get("RepoTags") or []:
+                images[tag.rsplit(":", 1)[0]] = image
+        volumes: Dict[str, List[Dict[str, Any]]] = {}
+        for volume in df.get("Volumes") or []:
+            project = (volume.get("Labels") or {}).get(PROJECT_LABEL)
+            if project:
+                volumes.setdefault(project, []).append(volume)
+        return cls(containers, images, volumes)
+
+    def generated_names(self) -> Set[str]:
+        names = {n for n in self.containers if GENERATED_NAME_RE.match(n)}
+        names.update(n for n in self.images if GENERATED_NAME_RE.match(n))
+        return names
+
+    def has(self, name: str) -> bool:
+        return name in self.containers or name in self.images or name in self.volumes
+
+    def size(self, name: str) -> int:
+        """Bytes that deleting an environment would free"""
+        size = 0
+        container = self.containers.get(name)
+        if container is not None:
+            size += max(0, container.get("SizeRw") or 0)
+        # Deleting the name of an image that has other names only untags it, and
+        # layers that are shared with other images won't be freed
+        image = self.images.get(name)
+        if image is not None and len(image.get("RepoTags") or []) <= 1:
+            shared = max(0, image.get("SharedSize") or 0)
+            size += max(0, image["Size"] - shared)
+        for volume in self.volumes.get(name, []):
+            size += max(0, (volume.get("UsageData") or {}).get("Size", 0))
+        return size
+
+
+class Environments:
+    """SQLite index of environments (image + container) and their directories
+
+    The generated names only contain a hash of the directory, so this is the
+    only way to tell which directory an environment belongs to.
+    """
+
+    filename = "environments.db"
+    _lock = threading.Lock()
+
+    def __init__(self, db_file: Optional[str] = None):
+        self.db_file = db_file or os.path.join(Config.get_cache_dir(), self.filename)
+        self._initialized = False
+
+    def _connect(self) -> "sqlite3.Connection":
+        import sqlite3
+
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        conn = sqlite3.connect(self.db_file, timeout=10)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                with conn:
+                    conn.execute("DROP TABLE IF EXISTS environments")
+                    conn.executescript(SCHEMA)
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._initialized = True
+        return conn
+
+    def _query(self, sql: str, *args: Any) -> List[EnvironmentRecord]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, args).fetchall()
+        return [cast(EnvironmentRecord, dict(row)) for row in rows]
+
+    def _execute(self, sql: str, *args: Any) -> int:
+        with self._lock, closing(self._connect()) as conn, conn:
+            return conn.execute(sql, args).rowcount
+
+    @property
+    def entries(self) -> Dict[str, EnvironmentRecord]:
+        return {
+            record["name"]: record
+            for record in self._query("SELECT * FROM environments ORDER BY name")
+        }
+
+    def get(self, name: str) -> Optional[EnvironmentRecord]:
+        records = self._query("SELECT * FROM environments WHERE name = ?", name)
+        return records[0] if records else None
+
+    def find(self, directory: str) -> List[EnvironmentRecord]:
+        """Get the environments that were created for a directory"""
+        return self._query(
+            "SELECT * FROM environments WHERE directory = ?",
+            os.path.realpath(directory),
+        )
+
+    def record(
+        self,
+        name: str,
+        directory: Optional[str] = None,
+        source_image: Optional[str] = None,
+        image_id: Optional[str] = None,
+        container_id: Optional[str] = None,
+    ) -> None:
+        """Record that an environment was created (or re-created) for a directory
+
+        Fields that are None keep their previous values
+        """
+        now = time.time()
+        directory = os.path.realpath(directory or os.getcwd())
+        with self._lock, closing(self._connect()) as conn, conn:
+            updated = conn.execute(
+                "UPDATE environments SET directory = ?, "
+                "source_image = COALESCE(?, source_image), "
+                "image_id = COALESCE(?, image_id), "
+                "container_id = COALESCE(?, container_id), "
+                "last_used = ? WHERE name = ?",
+                (directory, source_image, image_id, container_id, now, name),
+            ).rowcount
+            if not updated:
+                conn.execute(
+                    f"INSERT INTO environments ({', '.join(FIELDS)}) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, NULL)",
+                    (name, directory, source_image, image_id, container_id, now, now),
+                )
+
+    def touch(
+        self,
+        name: str,
+        directory: Optional[str] = None,
+        container_id: Optional[str] = None,
+    ) -> None:
+        """Record that an environment was just used"""
+        updated = self._execute(
+            "UPDATE environments SET last_used = ? WHERE name = ?", time.time(), name
+        )
+        if not updated:
+            self.record(name, directory, container_id=container_id)
+
+    def update(self, name: str, **fields: Any) -> None:
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError(f"Unknown environment field '{field}'")
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        self._execute(
+            f"UPDATE environments SET {assignments} WHERE name = ?",
+            *fields.values(),
+            name,
+        )
+
+    def delete(self, name: str) -> None:
+        self._execute("DELETE FROM environments WHERE name = ?", name)
+
+    def refresh(self, inventory: Inventory) -> None:
+        """Reconcile the index with what is in docker
+
+        This adds environments with generated names that aren't in the index,
+        updates the IDs and sizes of the rest, and forgets environments that no
+        longer exist.
+        """
+        records = self.entries
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            for name in set(records) | inventory.generated_names():
+                if not inventory.has(name):
+                    conn.execute("DELETE FROM environments WHERE name = ?", (name,))
+                    continue
+                container = inventory.containers.get(name)
+                image = inventory.images.get(name)
+                container_id = None if container is None else container["Id"]
+                image_id = None if image is None else image["Id"]
+                size = inventory.size(name)
+                if name in records:
+                    conn.execute(
+                        "UPDATE environments SET image_id = ?, container_id = ?, "
+                        "size = ? WHERE name = ?",
+                        (image_id, container_id, size, name),
+                    )
+                    continue
+                created = (container or image or {}).get("Created") or now
+                conn.execute(
+                    f"INSERT INTO environments ({', '.join(FIELDS)}) "
+                    "VALUES (?, '', NULL, ?, ?, ?, ?, ?)",
+                    (name, image_id, container_id, created, created, size),
+                )
@@ -0,0 +1,295 @@
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Set
+
+from .config import Config
+from .util import read_json, write_json_atomic
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOMAIN = "docker.io"
+DEFAULT_TAG = "latest"
+INDEX_VERSION = 1
+# The daemon only keeps a limited backlog of events, so don't trust an index
+# that hasn't been rebuilt in a while
+MAX_INDEX_AGE = 60 * 60
+# Image events that can change the set of local images or their tags
+IMAGE_MUTATING_EVENTS = {"pull", "tag", "untag", "delete", "import", "load", "build"}
+
+
+class ImageRef(NamedTuple):
+    """A parsed docker image reference
+
+    The repository is stored in the familiar form that the docker daemon uses
+    for RepoTags (e.g. 'ubuntu' instead of 'docker.io/library/ubuntu').
+    """
+
+    repository: str
+    tag: Optional[str] = None
+    digest: Optional[str] = None
+
+    @property
+    def domain(self) -> str:
+        first, sep, _ = self.repository.partition("/")
+        if sep and _is_domain(first):
+            return first
+        return DEFAULT_DOMAIN
+
+    @property
+    def path(self) -> str:
+        first, sep, rest = self.repository.partition("/")
+        if sep and _is_domain(first):
+            return rest
+        if sep:
+            return self.repository
+        return "library/" + self.repository
+
+    @property
+    def is_pinned(self) -> bool:
+        return self.digest is not None
+
+    def tagged(self) -> str:
+        """Reference with an explicit tag (defaults to 'latest')"""
+        return f"{self.repository}:{self.tag or DEFAULT_TAG}"
+
+    def __str__(self) -> str:
+        ret = self.repository
+        if self.tag is not None:
+            ret += ":" + self.tag
+        if self.digest is not None:
+            ret += "@" + self.digest
+        return ret
+
+
+def _is_domain(component: str) -> bool:
+    return "." in component or ":" in component or component == "localhost"
+
+
+def parse_image_ref(ref: str) -> ImageRef:
+    """Parse an image reference such as 'registry:5000/img:tag' or 'img@sha256:...'"""
+    name, _, digest = ref.partition("@")
+    tag = None
+    # The tag separator is the last ':' that comes after the last '/'. Any
+    # earlier ':' is part of a registry host port.
+    slash = name.rfind("/")
+    colon = name.rfind(":")
+    if colon > slash:
+        name, tag = name[:colon], name[colon + 1 :]
+    first, sep, rest = name.partition("/")
+    if sep and first in (DEFAULT_DOMAIN, "index.docker.io"):
+        name = rest
+    if name.startswith("library/") and name.count("/") == 1:
+        name = name[len("library/") :]
+    return ImageRef(name, tag or None, digest or None)
+
+
+def is_image_id(name: str) -> bool:
+    hexid = name[len("sha256:") :] if name.startswith("sha256:") else name
+    if len(hexid) < 12 or len(hexid) > 64:
+        return False
+    try:
+        int(hexid, 16)
+    except ValueError:
+        return False
+    return True
+
+
+class ImageIndex:
+    """Persistent index of local images
+
+    The index is cached in a file and refreshed by asking the daemon for any
+    image events that have happened since the last refresh. If nothing has
+    changed, a lookup costs a single (cheap) events request, and subsequent
+    lookups in the same process cost nothing.
+    """
+
+    def __init__(self, client: "DockerClient", cache_file: Optional[str] = None):
+        self.client = client
+        self.cache_file = cache_file or os.path.join(
+            Config.get_cache_dir(), "images.json"
+        )
+        self._since: float = 0
+        self._images: Dict[str, Dict[str, List[str]]] = {}
+        self._by_ref: Dict[str, str] = {}
+        self._by_digest: Dict[str, str] = {}
+        self._by_repo: Dict[str, Set[str]] = {}
+        self._loaded = False
+        self._fresh = False
+        self._rebuilt = False
+        self._lock = threading.RLock()
+
+    def invalidate(self) -> None:
+        """Check the daemon for changes before the next lookup"""
+        self._fresh = False
+
+    def _load(self) -> None:
+        self._loaded = True
+        data: Dict[str, Any] = read_json(self.cache_file, {})
+        if data.get("version") != INDEX_VERSION:
+            return
+        self._since = data["since"]
+        self._set_images(data["images"])
+
+    def _save(self) -> None:
+        write_json_atomic(
+            self.cache_file,
+            {
+                "version": INDEX_VERSION,
+                "since": self._since,
+                "images": self._images,
+            },
+        )
+
+    def _set_images(self, images: Dict[str, Dict[str, List[str]]]) -> None:
+        self._images = images
+        self._by_ref = {}
+        self._by_digest = {}
+        self._by_repo = {}
+        for image_id, refs in images.items():
+            for tag in refs["tags"]:
+                ref = parse_image_ref(tag)
+                self._by_ref[ref.tagged()] = image_id
+                self._by_repo.setdefault(ref.repository, set()).add(image_id)
+            for repo_digest in refs["digests"]:
+                ref = parse_image_ref(repo_digest)
+                self._by_digest[str(ref)] = image_id
+                if ref.digest is not None:
+                    self._by_digest[ref.digest] = image_id
+                self._by_repo.setdefault(ref.repository, set()).add(image_id)
+
+    def rebuild(self) -> None:
+        """Rebuild the index from a full image listing"""
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        since = time.time()
+        images: Dict[str, Dict[str, List[str]]] = {}
+        for image in self.client.api.images():
+            images[image["Id"]] = {
+                "tags": [
+                    t for t in image.get("RepoTags") or [] if t != "<none>:<none>"
+                ],
+                "digests": [
+                    d for d in image.get("RepoDigests") or [] if d != "<none>@<none>"
+                ],
+            }
+        self._since = since
+        self._set_images(images)
+        self._fresh = True
+        self._rebuilt = True
+        self._save()
+
+    def _has_changed(self) -> bool:
+        now = time.time()
+        events = self.client.api.events(
+            since=int(self._since),
+            until=int(now),
+            filters={"type": "image"},
+            decode=True,
+        )
+        changed = False
+        for event in events:
+            if event.get("Action", event.get("status")) in IMAGE_MUTATING_EVENTS:
+                changed = True
+        return changed
+
+    def refresh(self) -> None:
+        """Make sure the index reflects the current state of the daemon"""
+        with self._lock:
+            if self._fresh:
+                return
+            if not self._loaded:
+                self._load()
+            if time.time() - self._since > MAX_INDEX_AGE or self._has_changed():
+                logger.debug("Rebuilding image index")
+                self._rebuild()
+            else:
+                self._fresh = True
+
+    def get(self, name: str) -> Optional[str]:
+        """Get the ID of the image with an exact reference, digest, or ID"""
+        self.refresh()
+        image_id = self._lookup(name)
+        if image_id is None and not self._rebuilt:
+            # A miss usually means we're about to do something expensive (pull
+            # or build), so it's worth one full listing to make sure
+            with self._lock:
+                if not self._rebuilt:
+                    self._rebuild()
+            image_id = self._lookup(name)
+        return image_id
+
+    def verify(self, name: str) -> Optional[str]:
+        """Like get, but make sure that the image still exists
+
+        Changes can fall out of the daemon's event backlog before the index
+        sees them, so use this before building on or tagging an image. It
+        costs one inspect request.
+        """
+        from docker.errors import ImageNotFound
+
+        image_id = self.get(name)
+        if image_id is None:
+            return None
+        try:
+            actual: Optional[str] = self.client.api.inspect_image(name)["Id"]
+        except ImageNotFound:
+            actual = None
+        if actual != image_id:
+            logger.debug("Image index is out of date, rebuilding")
+            with self._lock:
+                self._rebuild()
+        return actual
+
+    def _lookup(self, name: str) -> Optional[str]:
+        if name in self._images:
+            return name
+        if name in self._by_digest:
+            return self._by_digest[name]
+        ref = parse_image_ref(name)
+        if ref.digest is not None:
+            return self._by_digest.get(f"{ref.repository}@{ref.digest}")
+        image_id = self._by_ref.get(ref.tagged())
+        if image_id is None and is_image_id(name):
+            image_id = self._find_id_prefix(name)
+        return image_id
+
+    def _find_id_prefix(self, name: str) -> Optional[str]:
+        prefix = name if name.startswith("sha256:") else "sha256:" + name
+        for image_id in self._images:
+            if image_id.startswith(prefix):
+                return image_id
+        return None
+
+    def get_digests(self, image_id: str, repository: Optional[str] = None) -> Set[str]:
+        """Get the registry digests of an image, optionally only for one repository"""
+        self.refresh()
+        digests = set()
+        for repo_digest in self._images.get(image_id, {}).get("digests", []):
+            ref = parse_image_ref(repo_digest)
+            if ref.digest is not None and (
+                repository is None or ref.repository == repository
+            ):
+                digests.add(ref.digest)
+        return digests
+
+    def get_repository(self, repository: str) -> Set[str]:
+        """Get the IDs of all images in a repository"""
+        self.refresh()
+        return set(self._by_repo.get(parse_image_ref(repository).repository, ()))
+
+    def has(self, name: str) -> bool:
+        """Check for an image by ID, digest, or reference
+
+        If the reference has no tag or digest, matches any tag in the repository
+        """
+        ref = parse_image_ref(name)
+        if ref.tag is None and ref.digest is None and self.get_repository(name):
+            return True
+        return self.get(name) is not None
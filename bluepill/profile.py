@@ -0,0 +1,182 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+VERSION_PREFIX_RE = re.compile(r"^/v\d+\.\d+(?=/)")
+ID_RE = re.compile(r"(sha256:)?[0-9a-f]{12,64}\b")
+
+_profiler: Optional["Profiler"] = None
+
+
+class Profiler:
+    """Record bluepill phases and docker API requests as a Chrome trace
+
+    Timestamps are in microseconds relative to when the profiler was created
+    """
+
+    def __init__(self, origin: Optional[float] = None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._threads: Dict[int, Tuple[int, str]] = {}
+
+    def _tid(self) -> int:
+        ident = threading.get_ident()
+        if ident not in self._threads:
+            name = threading.current_thread().name
+            self._threads[ident] = (len(self._threads) + 1, name)
+        return self._threads[ident][0]
+
+    def add(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        category: str = "phase",
+        args: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Add a complete event, with perf_counter start and end times"""
+        with self._lock:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": self._tid(),
+                    "args": args or {},
+                }
+            )
+
+    @contextmanager
+    def phase(self, name: str, **args: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter(), args=args)
+
+    def instrument(self, client: "DockerClient") -> None:
+        """Record every HTTP request that a docker client sends"""
+        api = client.api
+        send = api.send
+
+        def profiled_send(request: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            status: Optional[int] = None
+            size: Optional[int] = None
+            try:
+                response = send(request, **kwargs)
+                status = response.status_code
+                if kwargs.get("stream"):
+                    # The body hasn't been read yet, so this only measures the
+                    # time until the headers arrived
+                    length = response.headers.get("Content-Length")
+                    size = int(length) if length is not None else None
+                else:
+                    size = len(response.content)
+                return response
+            finally:
+                path = request.path_url.split("?", 1)[0]
+                endpoint = ID_RE.sub("{id}", VERSION_PREFIX_RE.sub("", path))
+                self.add(
+                    f"{request.method} {endpoint}",
+                    start,
+                    time.perf_counter(),
+                    "http",
+                    {
+                        "method": request.method,
+                        "url": request.path_url,
+                        "status": status,
+                        "bytes": size,
+                        "stream": bool(kwargs.get("stream")),
+                    },
+                )
+
+        api.send = profiled_send
+
+    def trace(self) -> Dict[str, Any]:
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in self._threads.values()
+        ]
+        return {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}
+
+    def write(self, file: str) -> None:
+        dirname = os.path.dirname(file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(file, "w") as ofile:
+            json.dump(self.trace(), ofile)
+
+    def print_summary(self, out: TextIO = sys.stderr, top: int = 10) -> None:
+        total = (time.perf_counter() - self.origin) * 1000
+        phases = [e for e in self.events if e["cat"] == "phase"]
+        requests = [e for e in self.events if e["cat"] == "http"]
+        api_ms = sum(e["dur"] for e in requests) / 1000
+        out.write(
+            f"Total {total:.1f}ms, {len(requests)} docker API requests "
+            f"({api_ms:.1f}ms)\n"
+        )
+        phases.sort(key=lambda e: (e["ts"], -e["dur"]))
+        for event in phases:
+            # Indent phases by how many other phases they are nested inside
+            depth = sum(
+                1
+                for other in phases
+                if other is not event
+                and other["tid"] == event["tid"]
+                and other["ts"] <= event["ts"]
+                and other["ts"] + other["dur"] >= event["ts"] + event["dur"]
+            )
+            out.write(
+                f"  {event['dur'] / 1000:9.1f}ms  {'  ' * depth}{event['name']}\n"
+            )
+        endpoints: Dict[str, List[float]] = defaultdict(list)
+        for event in requests:
+            endpoints[event["name"]].append(event["dur"] / 1000)
+        if endpoints:
+            out.write("Slowest endpoints:\n")
+        ranked = sorted(endpoints.items(), key=lambda item: -sum(item[1]))
+        for endpoint, durations in ranked[:top]:
+            out.write(
+                f"  {sum(durations):9.1f}ms  {len(durations):3}x  "
+                f"max {max(durations):7.1f}ms  {endpoint}\n"
+            )
+
+
+def enable(origin: Optional[float] = None) -> Profiler:
+    global _profiler  # pylint: disable=global-statement
+    _profiler = Profiler(origin)
+    return _profiler
+
+
+def get_profiler() -> Optional[Profiler]:
+    return _profiler
+
+
+@contextmanager
+def phase(name: str, **args: Any) -> Iterator[None]:
+    """Time a block of bluepill's own work. Does nothing unless profiling."""
+    if _profiler is None:
+        yield
+        return
+    with _profiler.phase(name, **args):
+        yield
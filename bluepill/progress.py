@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, TextIO
+
+from .config import Config
+from .util import format_bytes
+
+logger = logging.getLogger(__name__)
+
+STEP_RE = re.compile(r"^Step (\d+)/(\d+) : (.*)$")
+
+
+class TimingLog:
+    """Appends machine-readable timing records to a json lines file"""
+
+    _lock = threading.Lock()
+
+    def __init__(self, file: Optional[str] = None):
+        self.file = file or os.path.join(Config.get_cache_dir(), "timings.jsonl")
+
+    def record(self, records: Iterable[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        if not lines:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            with open(self.file, "a") as ofile:
+                ofile.write(lines)
+
+
+class ProgressPrinter:
+    """Print progress, with a live updating status line when attached to a tty"""
+
+    def __init__(
+        self, name: str, out: TextIO = sys.stdout, live: Optional[bool] = None
+    ):
+        self.name = name
+        self.out = out
+        self.live = out.isatty() if live is None else live
+        self._status_len = 0
+
+    def status(self, text: str) -> None:
+        """Transient status that will be replaced by the next status or line"""
+        if not self.live:
+            return
+        text = text.replace("\n", " ")[:120]
+        self.out.write("\r" + text.ljust(self._status_len))
+        self.out.flush()
+        self._status_len = len(text)
+
+    def line(self, text: str) -> None:
+        if self.live:
+            self.out.write("\r" + text.ljust(self._status_len) + "\n")
+        else:
+            self.out.write(f"[{self.name}] {text}\n")
+        self._status_len = 0
+        self.out.flush()
+
+
+class StreamError(Exception):
+    """The daemon reported an error in the middle of a streaming response"""
+
+    def __init__(self, message: str, log: List[Dict[str, Any]]):
+        super().__init__(message)
+        self.log = log
+
+
+def follow_pull(
+    events: Iterable[Dict[str, Any]],
+    image: str,
+    printer: ProgressPrinter,
+    timings: Optional[TimingLog] = None,
+) -> None:
+    """Render the decoded event stream of a pull and record per-layer timings"""
+    start = time.time()
+    layers: Dict[str, Dict[str, Any]] = {}
+    log: List[Dict[str, Any]] = []
+    for event in events:
+        log.append(event)
+        if "error" in event:
+            raise StreamError(event["error"], log)
+        layer_id = event.get("id")
+        status = event.get("status", "")
+        if layer_id is None or status.startswith("Pulling from"):
+            continue
+        layer = layers.setdefault(
+            layer_id,
+            {"start": time.time(), "bytes": 0, "total": 0, "cache": "miss"},
+        )
+        detail = event.get("progressDetail") or {}
+        if status == "Already exists":
+            layer["cache"] = "hit"
+            layer["end"] = time.time()
+        elif status == "Downloading":
+            layer["bytes"] = detail.get("current", layer["bytes"])
+            layer["total"] = detail.get("total", layer["total"])
+        elif status == "Pull complete":
+            layer["end"] = time.time()
+            layer["bytes"] = max(layer["bytes"], layer["total"])
+            printer.line(
+                f"Pulled layer {layer_id} "
+                f"({format_bytes(layer['bytes'])}, {layer['end'] - layer['start']:.1f}s)"
+            )
+        done = sum(1 for layer in layers.values() if "end" in layer)
+        current = sum(layer["bytes"] for layer in layers.values())
+        total = sum(layer["total"] for layer in layers.values())
+        printer.status(
+            f"Pulling {image}: {done}/{len(layers)} layers, "
+            f"{format_bytes(current)}/{format_bytes(total)}"
+        )
+    end = time.time()
+    total_bytes = sum(layer["bytes"] for layer in layers.values())
+    printer.line(f"Pulled {image} ({format_bytes(total_bytes)}, {end - start:.1f}s)")
+    if timings is not None:
+        records = [
+            {
+                "time": layer["start"],
+                "kind": "pull",
+                "image": image,
+                "step": layer_id,
+                "duration": layer.get("end", end) - layer["start"],
+                "bytes": layer["bytes"],
+                "cache": layer["cache"],
+            }
+            for layer_id, layer in layers.items()
+        ]
+        records.append(
+            {
+                "time": start,
+                "kind": "pull",
+                "image": image,
+                "step": None,
+                "duration": end - start,
+                "bytes": total_bytes,
+                "cache": "hit" if not total_bytes else "miss",
+            }
+        )
+        timings.record(records)
+
+
+def follow_build(
+    events: Iterable[Dict[str, Any]],
+    tag: str,
+    printer: ProgressPrinter,
+    timings: Optional[TimingLog] = None,
+) -> str:
+    """Render the decoded event stream of a build and record per-step timings
+
+    Returns the ID of the built image
+    """
+    start = time.time()
+    steps: List[Dict[str, Any]] = []
+    log: List[Dict[str, Any]] = []
+    image_id: Optional[str] = None
+
+    def finish_step() -> None:
+        if steps and "duration" not in steps[-1]:
+            step = steps[-1]
+            step["duration"] = time.time() - step["time"]
+            cached = " (cached)" if step["cache"] == "hit" else ""
+            printer.line(
+                f"Step {step['step']}: {step['instruction']} "
+                f"[{step['duration']:.1f}s]{cached}"
+            )
+
+    for event in events:
+        log.append(event)
+        if "error" in event:
+            raise StreamError(event["error"], log)
+        if "aux" in event and "ID" in event["aux"]:
+            image_id = event["aux"]["ID"]
+        text = event.get("stream", "")
+        for output in text.splitlines():
+            match = STEP_RE.match(output)
+            if match:
+                finish_step()
+                steps.append(
+                    {
+                        "time": time.time(),
+                        "kind": "build",
+                        "image": tag,
+                        "step": f"{match.group(1)}/{match.group(2)}",
+                        "instruction": match.group(3),
+                        "bytes": 0,
+                        "cache": "miss",
+                    }
+                )
+                printer.status(f"Step {steps[-1]['step']}: {match.group(3)}")
+            elif output.strip() == "---> Using cache" and steps:
+                steps[-1]["cache"] = "hit"
+            elif output.strip():
+                printer.status(output.strip())
+                logger.debug("%s: %s", tag, output)
+    finish_step()
+    end = time.time()
+    printer.line(f"Built {tag} ({end - start:.1f}s)")
+    if timings is not None:
+        records = steps + [
+            {
+                "time": start,
+                "kind": "build",
+                "image": tag,
+                "step": None,
+                "duration": end - start,
+                "bytes": 0,
+                "cache": "hit" if all(s["cache"] == "hit" for s in steps) else "miss",
+            }
+        ]
+        timings.record(records)
+    if image_id is None:
+        raise StreamError(f"Build of {tag} did not produce an image", log)
+    return image_id
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+from .userlayer import UserSpec
+
+# Label on project images with the digest of the steps they were provisioned with
+PROVISION_LABEL = "bluepill.provision"
+
+# Keep the packages that apt downloads, so that they end up in the cache mount
+# instead of being deleted after every install
+APT_KEEP_CACHE = (
+    "if [ -d /etc/apt/apt.conf.d ]; then "
+    "rm -f /etc/apt/apt.conf.d/docker-clean && "
+    "echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' "
+    "> /etc/apt/apt.conf.d/keep-cache; fi"
+)
+
+
+class ProvisionStep(NamedTuple):
+    run: str
+    # Run as the user instead of root
+    user: bool = False
+
+
+def parse_steps(data: Sequence[Any]) -> List[ProvisionStep]:
+    """Parse the 'provision' list of a project config
+
+    Each step is a shell command, a list of commands that are run together, or
+    an object with a 'run' command (or list) and optionally '"user": true'.
+    """
+    steps = []
+    for i, entry in enumerate(data):
+        user = False
+        if isinstance(entry, dict):
+            unknown = set(entry) - {"run", "user"}
+            if "run" not in entry or unknown:
+                raise ValueError(
+                    f"Provisioning step {i + 1} must have a 'run' key "
+                    "and optionally 'user'"
+                )
+            user = bool(entry.get("user"))
+            entry = entry["run"]
+        commands = entry if isinstance(entry, list) else [entry]
+        if not commands or not all(
+            isinstance(command, str) and command.strip() for command in commands
+        ):
+            raise ValueError(f"Provisioning step {i + 1} is not a command")
+        if any("\n" in command for command in commands):
+            raise ValueError(
+                f"Provisioning step {i + 1} has more than one line. "
+                "Use a list for multiple commands."
+            )
+        steps.append(ProvisionStep(" && \\\n  ".join(commands), user))
+    return steps
+
+
+def steps_digest(steps: Sequence[ProvisionStep]) -> str:
+    encoded = json.dumps([list(step) for step in steps]).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def cache_mounts(spec: UserSpec, home: str, user: bool) -> str:
+    """BuildKit cache mounts for the apt, pip, and npm download caches"""
+    mounts = [
+        "type=cache,id=bluepill-apt-cache,target=/var/cache/apt,sharing=locked",
+        "type=cache,id=bluepill-apt-lists,target=/var/lib/apt/lists,sharing=locked",
+    ]
+    if user:
+        owner = f"uid={spec.uid},gid={spec.gid}"
+        mounts.append(
+            f"type=cache,id=bluepill-pip-{spec.uid},target={home}/.cache/pip,{owner}"
+        )
+        mounts.append(
+            f"type=cache,id=bluepill-npm-{spec.uid},target={home}/.npm,{owner}"
+        )
+    else:
+        mounts.append("type=cache,id=bluepill-pip-0,target=/root/.cache/pip")
+        mounts.append("type=cache,id=bluepill-npm-0,target=/root/.npm")
+    return " ".join(f"--mount={mount}" for mount in mounts)
+
+
+def make_dockerfile(
+    base_image: str,
+    steps: Sequence[ProvisionStep],
+    spec: UserSpec,
+    home: str,
+    buildkit: bool,
+) -> str:
+    """Dockerfile that runs each step in its own layer on top of base_image
+
+    The layers are cached by their instruction and the layer below, so editing
+    a step only rebuilds from that step onwards.
+    """
+    lines = [f"FROM {base_image}", "USER root"]
+    if buildkit:
+        lines.append(f"RUN {APT_KEEP_CACHE}")
+    current_user = False
+    for step in steps:
+        if step.user != current_user:
+            lines.append(f"USER {spec.uid}:{spec.gid}" if step.user else "USER root")
+            current_user = step.user
+        mounts = cache_mounts(spec, home, step.user) + " " if buildkit else ""
+        lines.append(f"RUN {mounts}{step.run}")
+    if current_user:
+        lines.append("USER root")
+    return "\n".join(lines) + "\n"
+
+
+def has_buildkit() -> bool:
+    """True if the docker CLI can build with BuildKit, into the docker daemon
+
+    Only builders with the 'docker' driver can use the daemon's images (like
+    the user layer) in FROM. Others run BuildKit in a separate container that
+    would try to pull them from a registry.
+    """
+    if os.environ.get("DOCKER_BUILDKIT") == "0":
+        return False
+    docker = shutil.which("docker")
+    if docker is None:
+        return False
+    try:
+        result = subprocess.run(
+            [docker, "buildx", "inspect"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=10,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    if result.returncode != 0:
+        return False
+    for line in result.stdout.decode("utf-8", "replace").splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() == "Driver":
+            return value.strip() == "docker"
+    return False
+
+
+def build_with_cli(
+    dockerfile: str,
+    tag: str,
+    labels: Optional[Dict[str, str]] = None,
+    quiet: bool = False,
+) -> str:
+    """Build a Dockerfile without a context using BuildKit, and return the image ID
+
+    The docker API only supports the legacy builder, so this goes through the
+    docker CLI. It prints its own progress, unless quiet is set, in which case
+    the output is only printed if the build fails.
+    """
+    with tempfile.TemporaryDirectory(prefix="bluepill-") as tmpdir:
+        iidfile = os.path.join(tmpdir, "iid")
+        cmd = ["docker", "buildx", "build", "--load", "-t", tag, "--iidfile", iidfile]
+        for key, value in (labels or {}).items():
+            cmd.extend(["--label", f"{key}={value}"])
+        if quiet:
+            # Plain progress is readable when it's printed after a failure
+            cmd.append("--progress=plain")
+        cmd.append("-")
+        result = subprocess.run(
+            cmd,
+            input=dockerfile.encode("utf-8"),
+            stdout=subprocess.PIPE if quiet else None,
+            stderr=subprocess.STDOUT if quiet else None,
+        )
+        if result.returncode != 0:
+            if result.stdout:
+                # One write, so that the logs of concurrent builds don't mix
+                sys.stderr.write(result.stdout.decode("utf-8", errors="replace"))
+                sys.stderr.flush()
+            raise ValueError(
+                f"Provisioning {tag} failed: "
+                f"'{' '.join(shlex.quote(arg) for arg in cmd)}' "
+                f"exited with {result.returncode}"
+            )
+        with open(iidfile, "r") as ifile:
+            return ifile.read().strip()
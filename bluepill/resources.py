@@ -0,0 +1,117 @@
+import os
+from typing import Any, Dict, List, Sequence, Tuple
+
+from .util import format_bytes
+
+# Settings that can go under "resources" in the config or a project's
+# .bluepill.json. They are named after the 'docker run' flags.
+RESOURCE_KEYS = (
+    "cpus",
+    "cpuset_cpus",
+    "memory",
+    "memory_swap",
+    "shm_size",
+    "pids_limit",
+    "tmpfs",
+    "ulimits",
+)
+# tmpfs mounts are noexec and owned by root unless told otherwise, which is no
+# good for build directories. Options from the settings are added after these,
+# so they can still override them.
+DEFAULT_TMPFS_OPTIONS = "exec,mode=1777"
+
+
+def merge_resources(*layers: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine resource settings, where later layers override earlier ones
+
+    tmpfs mounts and ulimits are merged by path and name, so that a project can
+    add one without repeating the rest.
+    """
+    merged: Dict[str, Any] = {}
+    for layer in layers:
+        for key, value in layer.items():
+            if key in ("tmpfs", "ulimits") and isinstance(value, dict):
+                merged[key] = {
+                    name: item
+                    for name, item in {**merged.get(key, {}), **value}.items()
+                    if item is not None
+                }
+            else:
+                merged[key] = value
+    # null disables an inherited setting
+    return {key: value for key, value in merged.items() if value is not None}
+
+
+def _parse_ulimit(name: str, value: Any) -> Tuple[int, int]:
+    if isinstance(value, int):
+        return value, value
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        return int(value[0]), int(value[1])
+    raise ValueError(
+        f"ulimit '{name}' must be a number or a [soft, hard] pair, not {value!r}"
+    )
+
+
+def make_resource_args(resources: Dict[str, Any], home: str) -> Dict[str, Any]:
+    """Convert resource settings to arguments for containers.create()"""
+    args: Dict[str, Any] = {}
+    for key, value in resources.items():
+        if key not in RESOURCE_KEYS:
+            raise ValueError(
+                f"Unknown resource setting '{key}' "
+                f"(expected one of {', '.join(RESOURCE_KEYS)})"
+            )
+        if key in ("tmpfs", "ulimits") and not isinstance(value, dict):
+            raise ValueError(f"Resource setting '{key}' must be a json object")
+        if key == "cpus":
+            args["nano_cpus"] = int(float(value) * 1e9)
+        elif key == "cpuset_cpus":
+            args["cpuset_cpus"] = str(value)
+        elif key == "memory":
+            args["mem_limit"] = value
+        elif key == "memory_swap":
+            args["memswap_limit"] = value
+        elif key == "shm_size":
+            args["shm_size"] = value
+        elif key == "pids_limit":
+            args["pids_limit"] = int(value)
+        elif key == "tmpfs":
+            tmpfs = {}
+            for path, options in value.items():
+                if path == "~" or path.startswith("~/"):
+                    path = os.path.join(home, path[2:])
+                elif not os.path.isabs(path):
+                    raise ValueError(f"tmpfs path '{path}' is not absolute")
+                tmpfs[path] = ",".join(filter(None, [DEFAULT_TMPFS_OPTIONS, options]))
+            args["tmpfs"] = tmpfs
+        elif key == "ulimits":
+            ulimits = []
+            for name, limit in value.items():
+                soft, hard = _parse_ulimit(name, limit)
+                ulimits.append({"name": name, "soft": soft, "hard": hard})
+            args["ulimits"] = ulimits
+    return args
+
+
+def describe_limits(host_config: Dict[str, Any]) -> List[str]:
+    """Human-readable resource limits from a container's HostConfig"""
+    limits = []
+    if host_config.get("NanoCpus"):
+        limits.append(f"{host_config['NanoCpus'] / 1e9:g} CPUs")
+    if host_config.get("CpusetCpus"):
+        limits.append(f"cpuset {host_config['CpusetCpus']}")
+    if host_config.get("Memory"):
+        limits.append(f"memory {format_bytes(host_config['Memory'])}")
+        swap = host_config.get("MemorySwap") or 0
+        if swap > host_config["Memory"]:
+            limits.append(f"swap {format_bytes(swap - host_config['Memory'])}")
+    if host_config.get("ShmSize"):
+        limits.append(f"/dev/shm {format_bytes(host_config['ShmSize'])}")
+    if host_config.get("PidsLimit"):
+        limits.append(f"pids {host_config['PidsLimit']}")
+    for path, options in sorted((host_config.get("Tmpfs") or {}).items()):
+        limits.append(f"tmpfs {path} ({options})" if options else f"tmpfs {path}")
+    ulimits: Sequence[Dict[str, Any]] = host_config.get("Ulimits") or []
+    for ulimit in ulimits:
+        limits.append(f"{ulimit['Name']} {ulimit['Soft']}:{ulimit['Hard']}")
+    return limits
@@ -0,0 +1,185 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+from typing import IO, Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+
+class HashingWriter:
+    """File wrapper that computes the sha256 of everything written to it"""
+
+    def __init__(self, fileobj: IO[bytes]):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.sha.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def digest(self) -> str:
+        return "sha256:" + self.sha.hexdigest()
+
+
+def _normpath(name: str) -> str:
+    name = name[2:] if name.startswith("./") else name
+    return name.rstrip("/")
+
+
+def _ancestors(path: str) -> Iterator[str]:
+    while "/" in path:
+        path = path.rsplit("/", 1)[0]
+        yield path
+
+
+def _is_excluded(path: str, exclude: Sequence[str]) -> bool:
+    return any(path.startswith(prefix + "/") for prefix in exclude)
+
+
+def merge_layers(
+    layers: Sequence[tarfile.TarFile], out: IO[bytes], exclude: Sequence[str] = ()
+) -> Tuple[str, int]:
+    """Merge layer tars (oldest first) into a single layer
+
+    Files from newer layers replace older ones, and whiteouts hide files from
+    older layers. Whiteouts are kept in the merged layer because they may
+    refer to files in the layers below it. New and changed files inside the
+    directories in exclude are left out, but their whiteouts are kept so that
+    deleted files stay deleted. Returns the diff ID (the sha256 of the
+    uncompressed tar) and the number of entries that were left out.
+    """
+    exclude = [_normpath(path.lstrip("/")) for path in exclude]
+    seen: Set[str] = set()
+    skipped = 0
+    deleted: Set[str] = set()
+    opaque: Set[str] = set()
+    keep: List[List[tarfile.TarInfo]] = [[] for _ in layers]
+    # Decide what to keep from the newest layer to the oldest, then write the
+    # kept files oldest first so that hard links come after their targets
+    for idx in reversed(range(len(layers))):
+        layer_seen: Set[str] = set()
+        layer_deleted: Set[str] = set()
+        layer_opaque: Set[str] = set()
+        for member in layers[idx].getmembers():
+            path = _normpath(member.name)
+            if not path or path in seen:
+                continue
+            if _is_excluded(path, exclude) and not path.rpartition("/")[2].startswith(
+                WHITEOUT_PREFIX
+            ):
+                skipped += 1
+                continue
+            if path in deleted or any(
+                a in deleted or a in opaque for a in _ancestors(path)
+            ):
+                continue
+            layer_seen.add(path)
+            keep[idx].append(member)
+            dirname, _, basename = path.rpartition("/")
+            if basename == OPAQUE_WHITEOUT:
+                layer_opaque.add(dirname)
+            elif basename.startswith(WHITEOUT_PREFIX):
+                target = basename[len(WHITEOUT_PREFIX) :]
+                layer_deleted.add(f"{dirname}/{target}" if dirname else target)
+        seen |= layer_seen
+        deleted |= layer_deleted
+        opaque |= layer_opaque
+
+    writer = HashingWriter(out)
+    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as merged:  # type: ignore
+        for layer, members in zip(layers, keep):
+            for member in members:
+                fileobj = layer.extractfile(member) if member.isfile() else None
+                merged.addfile(member, fileobj)
+    return writer.digest(), skipped
+
+
+def _add_file(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def squash_image(
+    saved: tarfile.TarFile,
+    base_layers: int,
+    tag: str,
+    out: IO[bytes],
+    workdir: str,
+    comment: Optional[str] = None,
+    exclude: Sequence[str] = (),
+) -> Tuple[str, int]:
+    """Squash the layers of a saved image above the first base_layers into one
+
+    saved is the output of 'docker save' for a single image. Writes a tar for
+    'docker load' to out that contains only the new layer, because the daemon
+    already has the base layers. Changes inside the directories in exclude are
+    left out of the new layer. Returns the ID of the new image and the number
+    of entries that were left out.
+    """
+    manifest = json.load(_extract(saved, "manifest.json"))[0]
+    config: Dict[str, Any] = json.load(_extract(saved, manifest["Config"]))
+    layer_paths: List[str] = manifest["Layers"]
+    if len(layer_paths) <= base_layers:
+        raise ValueError("There are no layers to squash")
+    layers = [
+        tarfile.open(fileobj=_extract(saved, path), mode="r:")
+        for path in layer_paths[base_layers:]
+    ]
+    layer_file = os.path.join(workdir, "layer.tar")
+    with open(layer_file, "wb") as ofile:
+        diff_id, skipped = merge_layers(layers, ofile, exclude)
+
+    diff_ids = config["rootfs"]["diff_ids"][:base_layers] + [diff_id]
+    # Keep the history of the base, which has one entry per layer plus entries
+    # for instructions that didn't create a layer
+    history: List[Dict[str, Any]] = []
+    count = 0
+    for entry in config.get("history") or []:
+        if not entry.get("empty_layer"):
+            if count == base_layers:
+                break
+            count += 1
+        history.append(entry)
+    history.append(
+        {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "created_by": "bluepill commit (squashed)",
+            "comment": comment or f"Squashed {len(layers)} layers",
+        }
+    )
+    config["rootfs"]["diff_ids"] = diff_ids
+    config["history"] = history
+    config["created"] = history[-1]["created"]
+    config_data = json.dumps(config).encode("utf-8")
+    image_id = "sha256:" + hashlib.sha256(config_data).hexdigest()
+
+    config_name = f"{image_id[len('sha256:'):]}.json"
+    layer_name = f"{diff_id[len('sha256:'):]}/layer.tar"
+    new_manifest = {
+        "Config": config_name,
+        "RepoTags": [tag],
+        # The daemon skips reading layers that it already has, so the base
+        # layers don't need to be in the archive
+        "Layers": layer_paths[:base_layers] + [layer_name],
+    }
+    with tarfile.open(fileobj=out, mode="w|") as load:
+        _add_file(load, config_name, config_data)
+        load.add(layer_file, layer_name)
+        _add_file(load, "manifest.json", json.dumps([new_manifest]).encode("utf-8"))
+    return image_id, skipped
+
+
+def _extract(tar: tarfile.TarFile, name: str) -> IO[bytes]:
+    fileobj = tar.extractfile(name)
+    if fileobj is None:
+        raise ValueError(f"'{name}' is missing from the saved image")
+    return fileobj
@@ -0,0 +1,278 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from types import TracebackType
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from .util import JsonCache
+
+if sys.version_info < (3, 8):
+    from typing_extensions import TypedDict
+else:
+    from typing import TypedDict
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+USER_LAYER_REPOSITORY = "bluepill/user-layer"
+# Bump this when the way the user layer is generated changes
+USER_LAYER_VERSION = 1
+# 'apt' installs sudo and creates the user with a package manager. 'files' writes
+# the user database files directly, which works on any image.
+USER_LAYER_MODES = ("apt", "files")
+USER_LAYER_ARCHIVE = "bluepill-user.tar"
+
+
+class UserSpec(NamedTuple):
+    uid: int
+    gid: int
+    user: str
+
+
+def user_layer_key(source_image_id: str, spec: UserSpec, mode: str = "apt") -> str:
+    """Content-addressed key for the user layer built on top of an image"""
+    data = json.dumps(
+        [USER_LAYER_VERSION, source_image_id, spec.uid, spec.gid, spec.user, mode]
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def user_layer_tag(key: str) -> str:
+    return f"{USER_LAYER_REPOSITORY}:{key[:32]}"
+
+
+class UserLayerCache(JsonCache[str]):
+    """Records which image was built for each user layer key"""
+
+    filename = "user_layers.json"
+
+
+class ImageUsers(TypedDict):
+    users: Dict[str, int]
+    gids: List[int]
+
+
+class ImageUsersCache(JsonCache[ImageUsers]):
+    """Records the users and groups that exist in each image"""
+
+    filename = "image_users.json"
+
+
+class ImageFiles:
+    """Read files out of an image through a container that is never started"""
+
+    def __init__(self, client: "DockerClient", image: str):
+        self.client = client
+        self.image = image
+        self._container_id: Optional[str] = None
+
+    def __enter__(self) -> "ImageFiles":
+        # The entrypoint doesn't need to exist because the container never runs
+        container = self.client.api.create_container(
+            self.image, entrypoint=["/bluepill-noop"], network_disabled=True
+        )
+        self._container_id = container["Id"]
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self._container_id is not None:
+            self.client.api.remove_container(self._container_id, force=True)
+            self._container_id = None
+
+    def read_tar(self, path: str) -> Optional[tarfile.TarFile]:
+        """Fetch a file or directory as an in-memory tar archive"""
+        from docker.errors import NotFound
+
+        try:
+            stream, _ = self.client.api.get_archive(self._container_id, path)
+        except NotFound:
+            return None
+        data = b"".join(stream)
+        return tarfile.open(fileobj=io.BytesIO(data), mode="r:")
+
+    def read_member(self, path: str) -> Optional[Tuple[tarfile.TarInfo, bytes]]:
+        """Fetch a regular file along with its metadata"""
+        tar = self.read_tar(path)
+        if tar is None:
+            return None
+        with tar:
+            for member in tar:
+                if member.isfile():
+                    fileobj = tar.extractfile(member)
+                    if fileobj is not None:
+                        return member, fileobj.read()
+        return None
+
+    def read_file(self, path: str) -> Optional[bytes]:
+        member = self.read_member(path)
+        return None if member is None else member[1]
+
+
+def _parse_db(data: Optional[bytes]) -> List[List[str]]:
+    if data is None:
+        return []
+    return [
+        line.split(":")
+        for line in data.decode("utf-8").splitlines()
+        if line and not line.startswith("#")
+    ]
+
+
+def read_image_users(files: ImageFiles) -> ImageUsers:
+    users = {}
+    for entry in _parse_db(files.read_file("/etc/passwd")):
+        if len(entry) > 2 and entry[2].isdigit():
+            users[entry[0]] = int(entry[2])
+    gids = [
+        int(entry[2])
+        for entry in _parse_db(files.read_file("/etc/group"))
+        if len(entry) > 2 and entry[2].isdigit()
+    ]
+    return {"users": users, "gids": gids}
+
+
+def _format_db(entries: List[List[str]]) -> bytes:
+    return "".join(":".join(entry) + "\n" for entry in entries).encode("utf-8")
+
+
+def _add_entry(
+    entries: List[List[str]], entry: List[str], id_field: Optional[int] = None
+) -> None:
+    """Add an entry, replacing any with the same name
+
+    If another entry has the same ID, put ours first so that lookups by ID find it
+    """
+    entries[:] = [e for e in entries if e[0] != entry[0]]
+    if id_field is not None:
+        for i, existing in enumerate(entries):
+            if len(existing) > id_field and existing[id_field] == entry[id_field]:
+                entries.insert(i, entry)
+                return
+    entries.append(entry)
+
+
+def _add_file(
+    tar: tarfile.TarFile,
+    name: str,
+    data: bytes,
+    mode: int = 0o644,
+    template: Optional[tarfile.TarInfo] = None,
+) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    if template is not None:
+        # Preserve the permissions and ownership of the file we're replacing
+        info.mode = template.mode
+        info.uid = template.uid
+        info.gid = template.gid
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_dir(tar: tarfile.TarFile, name: str, uid: int, gid: int) -> None:
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.uid = uid
+    info.gid = gid
+    info.mtime = int(time.time())
+    tar.addfile(info)
+
+
+class UserArchive(NamedTuple):
+    data: bytes
+    shell: str
+
+
+def make_user_archive(
+    files: ImageFiles, spec: UserSpec, static_sudo: Optional[str] = None
+) -> UserArchive:
+    """Create a tar archive that adds the user to an image's root filesystem
+
+    This writes the passwd, group, shadow, and sudoers entries directly so that
+    it doesn't depend on any tools (or package manager) inside the image.
+    """
+    uid, gid, user = spec
+    home = f"/home/{user}"
+    originals = {
+        name: files.read_member(f"/etc/{name}")
+        for name in ("passwd", "group", "shadow")
+    }
+    passwd, group, shadow = [
+        _parse_db(None if member is None else member[1])
+        for member in originals.values()
+    ]
+
+    shell = "/bin/sh"
+    for entry in passwd:
+        if entry[0] == "root" and len(entry) >= 7 and entry[6]:
+            shell = entry[6]
+    _add_entry(passwd, [user, "x", str(uid), str(gid), user, home, shell], 2)
+    if not any(len(entry) > 2 and entry[2] == str(gid) for entry in group):
+        _add_entry(group, [user, "x", str(gid), ""], 2)
+    days = str(int(time.time() // 86400))
+    _add_entry(shadow, [user, "*", days, "0", "99999", "7", "", "", ""])
+
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        for name, entries in (("passwd", passwd), ("group", group)):
+            template = originals[name]
+            _add_file(
+                tar,
+                f"etc/{name}",
+                _format_db(entries),
+                template=None if template is None else template[0],
+            )
+        shadow_member = originals["shadow"]
+        if shadow_member is not None:
+            _add_file(tar, "etc/shadow", _format_db(shadow), template=shadow_member[0])
+        sudoers = f"{user} ALL = (ALL) NOPASSWD: ALL\n".encode("utf-8")
+        _add_file(tar, "etc/sudoers.d/bluepill", sudoers, 0o440)
+        if static_sudo is not None:
+            with open(static_sudo, "rb") as ifile:
+                _add_file(tar, "usr/local/bin/sudo", ifile.read(), 0o4755)
+            if files.read_file("/etc/sudoers") is None:
+                default_sudoers = b"root ALL = (ALL) ALL\n#includedir /etc/sudoers.d\n"
+                _add_file(tar, "etc/sudoers", default_sudoers, 0o440)
+
+        _add_dir(tar, home.lstrip("/"), uid, gid)
+        skel = files.read_tar("/etc/skel")
+        if skel is not None:
+            with skel:
+                for member in skel:
+                    _, _, rel = member.name.partition("/")
+                    if not rel:
+                        continue
+                    fileobj = skel.extractfile(member) if member.isfile() else None
+                    member.name = os.path.join(home.lstrip("/"), rel)
+                    member.uid = uid
+                    member.gid = gid
+                    member.uname = ""
+                    member.gname = ""
+                    tar.addfile(member, fileobj)
+    return UserArchive(output.getvalue(), shell)
+
+
+def make_files_build_context(source_image: str, archive: UserArchive) -> io.BytesIO:
+    """Build context that adds a user archive (see make_user_archive) to an image"""
+    # ADD extracts local tar archives, preserving ownership and permissions
+    dockerfile = f"""FROM {source_image}
+ADD {USER_LAYER_ARCHIVE} /
+ENTRYPOINT ["{archive.shell}", "-l"]
+""".encode("utf-8")
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode="w") as tar:
+        _add_file(tar, "Dockerfile", dockerfile)
+        _add_file(tar, USER_LAYER_ARCHIVE, archive.data)
+    context.seek(0)
+    return context
@@ -1,4 +1,9 @@
-from typing import Any, Callable, Optional, TypeVar, cast
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar, cast
+
+from .config import Config
 
 NO_DEFAULT = object()
 
@@ -36,3 +41,68 @@ def confirm(msg: str, default: Optional[bool] = None) -> bool:
             return False
         elif not response and default is not None:
             return default
+
+
+def write_json_atomic(file: str, data: Any) -> None:
+    """Write a json file so that readers never see a partially written file"""
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmpfile = f"{file}.{os.getpid()}.tmp"
+    with open(tmpfile, "w") as ofile:
+        json.dump(data, ofile)
+    os.replace(tmpfile, file)
+
+
+def read_json(file: str, default: T) -> T:
+    """Read a json file, returning the default if it is missing or corrupt"""
+    try:
+        with open(file, "r") as ifile:
+            return cast(T, json.load(ifile))
+    except (OSError, ValueError):
+        return default
+
+
+def format_bytes(num: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024:
+            return f"{num:.1f}{unit}"
+        num /= 1024
+    return f"{num:.1f}TB"
+
+
+class JsonCache(Generic[T]):
+    """A small json dict stored in the cache directory"""
+
+    filename = ""
+    _lock = threading.Lock()
+
+    def __init__(self, cache_file: Optional[str] = None):
+        self.cache_file = cache_file or os.path.join(
+            Config.get_cache_dir(), self.filename
+        )
+        self._entries: Optional[Dict[str, T]] = None
+
+    def _read(self) -> Dict[str, T]:
+        entries: Dict[str, T] = read_json(self.cache_file, {})
+        return entries
+
+    @property
+    def entries(self) -> Dict[str, T]:
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, key: str) -> Optional[T]:
+        return self.entries.get(key)
+
+    def set(self, key: str, value: T) -> None:
+        # Re-read the file in case another process has added entries
+        with self._lock:
+            self._entries = self._read()
+            self._entries[key] = value
+            write_json_atomic(self.cache_file, self._entries)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries = self._read()
+            if self._entries.pop(key, None) is not None:
+                write_json_atomic(self.cache_file, self._entries)
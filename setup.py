@@ -10,7 +10,8 @@ CHANGES = open(os.path.join(HERE, "CHANGES.md")).read()
 REQUIREMENTS_TEST = open(os.path.join(HERE, "requirements_test.txt")).readlines()
 
 REQUIREMENTS = [
-    "docker",
+    # one_shot stats (see StatsCmd.get_stats) were added in 6.0
+    "docker>=6.0",
     "dockerpty",
 ]
 
@@ -27,7 +28,6 @@ if __name__ == "__main__":
         classifiers=[
             "Programming Language :: Python",
             "Programming Language :: Python :: 3",
-            "Programming Language :: Python :: 3.6",
             "Programming Language :: Python :: 3.7",
             "Programming Language :: Python :: 3.8",
             "Programming Language :: Python :: 3.9",
@@ -43,10 +43,11 @@ if __name__ == "__main__":
         platforms="any",
         zip_safe=False,
         include_package_data=True,
-        python_requires=">=3.6",
+        python_requires=">=3.7",
         entry_points={"console_scripts": ["bluepill = bluepill:main"]},
         packages=find_packages(exclude=("tests",)),
         install_requires=REQUIREMENTS,
+        extras_require={"zstd": ["zstandard"]},
         tests_require=REQUIREMENTS + REQUIREMENTS_TEST,
         test_suite="tests",
     )